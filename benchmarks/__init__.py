@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for xtdiff.
+
+generate builds synthetic trees and revisions of them with a given
+shape and rate of change, run times each stage of diffing them and
+writes the results as JSON, and compare compares two sets of results:
+
+    $ python -m benchmarks.run --suite scaling --output before.json
+    $ python -m benchmarks.run --suite scaling --output after.json
+    $ python -m benchmarks.compare before.json after.json
+
+run can also diff pairs of real documents, given a directory with old
+and new subdirectories holding documents with the same names.
+"""
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Compare two sets of benchmark results.
+
+    $ python -m benchmarks.compare before.json after.json
+
+Prints the change in time and peak memory of every stage of every case
+the two have in common, and exits with status 1 if any stage got slower
+than the threshold allows.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import sys
+
+
+def _load(path):
+    with open(path) as results_file:
+        results = json.load(results_file)['results']
+    return dict(((r['case'], r['stage']), r) for r in results)
+
+
+def _ratio(old, new):
+    if old is None or new is None or old == 0:
+        return None
+    return new / old
+
+
+def compare(old, new, threshold=1.2):
+    """ Return a row for each (case, stage) in both sets of results:
+        the case, stage, old and new times, their ratio, the ratio of
+        peak memory, and whether the time regressed past the
+        threshold. """
+    rows = []
+    for key in sorted(set(old) & set(new)):
+        old_result, new_result = old[key], new[key]
+        time_ratio = _ratio(old_result['seconds'], new_result['seconds'])
+        memory_ratio = _ratio(old_result.get('peak_bytes'),
+                              new_result.get('peak_bytes'))
+        regressed = time_ratio is not None and time_ratio > threshold
+        rows.append(key + (old_result['seconds'], new_result['seconds'],
+                           time_ratio, memory_ratio, regressed))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='the ratio of new to old time that counts '
+                             'as a regression')
+    args = parser.parse_args(argv)
+
+    rows = compare(_load(args.old), _load(args.new), args.threshold)
+
+    def ratio(value):
+        return '-' if value is None else '%.2fx' % value
+
+    print('%-60s %-12s %10s %10s %8s %8s' % (
+        'case', 'stage', 'old', 'new', 'time', 'memory'))
+    for case, stage, old, new, time_ratio, memory_ratio, regressed in rows:
+        print('%-60s %-12s %9.4fs %9.4fs %8s %8s%s' % (
+            case, stage, old, new, ratio(time_ratio), ratio(memory_ratio),
+            '  REGRESSED' if regressed else ''))
+
+    if any(row[-1] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic trees for benchmarks.
+"""
+
+from __future__ import unicode_literals
+
+from copy import deepcopy
+from random import Random
+
+from lxml import etree
+
+from xtdiff.tree import is_element
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua ut '
+         'enim ad minim veniam quis nostrud exercitation ullamco laboris '
+         'nisi aliquip ex ea commodo consequat').split()
+
+# The parameters of a case, and their defaults
+DEFAULTS = {
+    'depth': 3,
+    'fanout': 10,
+    'text_length': 40,
+    'tags': 10,
+    'change_rate': 0.05,
+    'move_rate': 0.01,
+    'insert_rate': 0.01,
+    'delete_rate': 0.01,
+    'seed': 0,
+}
+
+
+def size(depth, fanout):
+    """ Return the number of nodes generate() makes for the given depth
+        and fan-out. """
+    return sum(fanout ** level for level in range(depth + 1))
+
+
+def _text(random, length):
+    """ Return random words, about length characters of them. """
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(random.choice(WORDS))
+    return ' '.join(words)
+
+
+def generate(depth=3, fanout=10, text_length=40, tags=10, seed=0):
+    """ Return the root of a tree the given number of levels deep below
+        the root, where every element above the leaves has fanout
+        children. Elements are given one of the given number of tags,
+        leaves are given about text_length characters of text, and a
+        few elements are given ids and attributes. """
+
+    random = Random(seed)
+    root = etree.Element('root')
+    level = [root]
+    for depth_level in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                child = etree.SubElement(
+                    parent, 'tag%d' % random.randrange(tags))
+                if random.random() < 0.1:
+                    child.set('id', 'id%d' % random.randrange(1 << 30))
+                if random.random() < 0.1:
+                    child.set('class', random.choice(WORDS))
+                next_level.append(child)
+        level = next_level
+    for leaf in level:
+        leaf.text = _text(random, text_length)
+    return root
+
+
+def revise(root, change_rate=0.05, move_rate=0.01, insert_rate=0.01,
+           delete_rate=0.01, text_length=40, tags=10, seed=0):
+    """ Return a changed copy of the tree. Each rate is the share of its
+        elements that are changed in that way: the text of leaves is
+        edited, elements are moved to another parent, new leaves are
+        inserted, and elements are deleted. """
+
+    random = Random(seed + 1)
+    revision = deepcopy(root)
+    elements = [n for n in revision.iter() if is_element(n)][1:]
+    count = len(elements)
+
+    for node in elements:
+        if len(node) == 0 and random.random() < change_rate:
+            words = (node.text or '').split()
+            if len(words) > 0:
+                words[random.randrange(len(words))] = random.choice(WORDS)
+            words.append(random.choice(WORDS))
+            node.text = ' '.join(words)
+
+    parents = [n for n in elements if len(n) > 0] or [revision]
+    for i in range(int(count * move_rate)):
+        node = random.choice(elements)
+        parent = random.choice(parents)
+        if node.getparent() is None or node is parent or \
+                node in parent.iterancestors():
+            continue
+        parent.insert(random.randint(0, len(parent)), node)
+
+    for i in range(int(count * insert_rate)):
+        parent = random.choice(parents)
+        leaf = etree.Element('tag%d' % random.randrange(tags))
+        leaf.text = _text(random, text_length)
+        parent.insert(random.randint(0, len(parent)), leaf)
+
+    for node in random.sample(elements, int(count * delete_rate)):
+        parent = node.getparent()
+        if parent is not None:
+            parent.remove(node)
+
+    return revision
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Time each stage of diffing, for synthetic cases or a corpus of
+documents, and write the results as JSON.
+
+    $ python -m benchmarks.run --suite scaling --output results.json
+    $ python -m benchmarks.run --corpus path/to/corpus --output results.json
+
+Each stage is timed on its own, taking the best of --repeat runs, and
+then run once more under tracemalloc for its peak memory, which only
+counts memory allocated by Python (not by libxml2).
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+from copy import deepcopy
+
+from lxml import etree
+
+from xtdiff.diff import (INSERT, UPDATE, MOVE, DELETE, diff, editscript,
+                         simplematch, fastmatch, transform)
+from xtdiff.tree import is_element
+from xtdiff.xsl import toxsl
+
+from .generate import DEFAULTS, generate, revise, size
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    from time import perf_counter as clock
+except ImportError:  # Python 2
+    from time import time as clock
+
+
+# Cases varying one parameter from the defaults at a time. Scaling
+# goes from about 1,000 to about 100,000 nodes.
+_MEDIUM = {'fanout': 21}
+SUITES = {
+    'quick': [{}],
+    'scaling': [{'fanout': fanout} for fanout in (10, 14, 21, 31, 46)],
+    'changes': [dict(_MEDIUM, change_rate=rate)
+                for rate in (0.0, 0.01, 0.05, 0.2, 0.5)],
+    'moves': [dict(_MEDIUM, move_rate=rate)
+              for rate in (0.0, 0.01, 0.05, 0.1)],
+    'tags': [dict(_MEDIUM, tags=tags) for tags in (1, 10, 100, 1000)],
+    'text': [dict(_MEDIUM, text_length=length)
+             for length in (10, 100, 1000)],
+    'shape': [{'depth': 2, 'fanout': 100}, {'depth': 4, 'fanout': 6},
+              {'depth': 9, 'fanout': 2}],
+}
+
+STAGES = ('simplematch', 'fastmatch', 'editscript', 'diff', 'transform',
+          'toxsl')
+
+ACTIONS = (('insert', INSERT), ('update', UPDATE), ('move', MOVE),
+           ('delete', DELETE))
+
+
+def synthetic_case(params):
+    """ Return the name, parameters and pair of trees of a synthetic
+        case with the given parameters, with defaults for the rest. """
+    params = dict(DEFAULTS, **params)
+    left = generate(params['depth'], params['fanout'],
+                    params['text_length'], params['tags'], params['seed'])
+    right = revise(left, params['change_rate'], params['move_rate'],
+                   params['insert_rate'], params['delete_rate'],
+                   params['text_length'], params['tags'], params['seed'])
+    name = 'd{depth}-f{fanout}-t{text_length}-g{tags}-c{change_rate}-' \
+           'm{move_rate}-i{insert_rate}-x{delete_rate}'.format(**params)
+    return name, params, left, right
+
+
+def corpus_cases(directory):
+    """ Yield the name, parameters and pair of trees for each document
+        in the old subdirectory of the given directory that has a
+        namesake in its new subdirectory. """
+    old_directory = os.path.join(directory, 'old')
+    new_directory = os.path.join(directory, 'new')
+    for name in sorted(os.listdir(old_directory)):
+        new_path = os.path.join(new_directory, name)
+        if not os.path.exists(new_path):
+            continue
+        left = etree.parse(os.path.join(old_directory, name)).getroot()
+        right = etree.parse(new_path).getroot()
+        yield name, {'corpus': directory}, left, right
+
+
+def _count(root):
+    return sum(1 for node in root.iter() if is_element(node))
+
+
+def _stages(left, right):
+    """ Return a list of (stage, setup, function) for the pair, where
+        setup() returns the arguments function is called with, so that
+        setting up isn't timed. """
+    matches = simplematch(left, right)
+    script = editscript(left, right, matches)
+    return [
+        ('simplematch', lambda: (left, right), simplematch),
+        ('fastmatch', lambda: (left, right), fastmatch),
+        ('editscript', lambda: (left, right, matches), editscript),
+        ('diff', lambda: (left, right), diff),
+        ('transform', lambda: (deepcopy(left), script), transform),
+        ('toxsl', lambda: (script,), toxsl),
+    ]
+
+
+def _time(setup, function, repeat):
+    """ Return the best time of repeat calls of the function, and what
+        it returned. """
+    best = None
+    result = None
+    for i in range(repeat):
+        args = setup()
+        gc.collect()
+        start = clock()
+        result = function(*args)
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def _peak(setup, function):
+    """ Return the peak memory allocated by Python during a call of the
+        function, in bytes, or None if it can't be measured. """
+    if tracemalloc is None:
+        return None
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _actions(result):
+    """ Return the number of each kind of action in an edit script. """
+    return dict((name, sum(1 for a in result if type(a) == action_type))
+                for name, action_type in ACTIONS)
+
+
+def run_case(name, params, left, right, stages=STAGES, repeat=3,
+             memory=True, log=None):
+    """ Return a result for each of the given stages of diffing the
+        pair. """
+    results = []
+    nodes = [_count(left), _count(right)]
+    for stage, setup, function in _stages(left, right):
+        if stage not in stages:
+            continue
+        seconds, result = _time(setup, function, repeat)
+        peak = _peak(setup, function) if memory else None
+        actions = _actions(result) if stage in ('editscript', 'diff') \
+            else None
+        results.append({'case': name, 'params': params, 'nodes': nodes,
+                        'stage': stage, 'seconds': seconds,
+                        'peak_bytes': peak, 'actions': actions})
+        if log is not None:
+            log('%-60s %-12s %9.4fs %s' % (
+                name, stage, seconds,
+                '' if peak is None else '%8.1f MB' % (peak / 1048576.0)))
+    return results
+
+
+def _metadata():
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'lxml': '.'.join(str(n) for n in etree.LXML_VERSION),
+        'libxml2': '.'.join(str(n) for n in etree.LIBXML_VERSION),
+        'machine': platform.machine(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--suite', action='append', choices=sorted(SUITES),
+                        help='a suite of synthetic cases (the default is '
+                             'quick), may be given more than once')
+    parser.add_argument('--corpus', action='append', default=[],
+                        help='a directory with old and new subdirectories '
+                             'of documents to diff')
+    parser.add_argument('--stage', action='append', choices=STAGES,
+                        help='a stage to time (the default is all of '
+                             'them), may be given more than once')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the number of times each stage is timed')
+    parser.add_argument('--max-nodes', type=int, default=None,
+                        help='skip synthetic cases larger than this')
+    parser.add_argument('--no-memory', action='store_true',
+                        help="don't measure peak memory")
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args(argv)
+
+    def log(line):
+        print(line, file=sys.stderr)
+
+    suites = args.suite or ([] if args.corpus else ['quick'])
+    stages = args.stage or STAGES
+    results = []
+    for suite in suites:
+        for params in SUITES[suite]:
+            full = dict(DEFAULTS, **params)
+            if args.max_nodes is not None and \
+                    size(full['depth'], full['fanout']) > args.max_nodes:
+                continue
+            case = synthetic_case(params)
+            results.extend(run_case(*case, stages=stages,
+                                    repeat=args.repeat,
+                                    memory=not args.no_memory, log=log))
+    for directory in args.corpus:
+        for case in corpus_cases(directory):
+            results.extend(run_case(*case, stages=stages,
+                                    repeat=args.repeat,
+                                    memory=not args.no_memory, log=log))
+
+    output = json.dumps({'metadata': _metadata(), 'results': results},
+                        indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
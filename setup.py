@@ -2,7 +2,44 @@
 # -*- coding: utf-8 -*-
 
 import os
-from setuptools import setup
+import platform
+import sys
+from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+# setuptools provides distutils where Python doesn't any more
+from distutils.errors import CCompilerError, DistutilsExecError, \
+    DistutilsPlatformError
+
+
+# The native text similarity ratios are optional, xtdiff falls back on
+# difflib without them. They're only built for CPython 3, and not at all
+# if XTDIFF_NO_EXTENSIONS is set.
+ext_modules = []
+if sys.version_info[0] >= 3 and \
+        platform.python_implementation() == 'CPython' and \
+        not os.environ.get('XTDIFF_NO_EXTENSIONS'):
+    ext_modules.append(Extension('xtdiff._similarity',
+                                 ['xtdiff/_similarity.c']))
+
+
+class optional_build_ext(build_ext):
+    """ Build the extensions if possible, and carry on without them if
+        they can't be built. """
+
+    errors = (CCompilerError, DistutilsExecError, DistutilsPlatformError,
+              IOError, OSError)
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except self.errors as error:
+            self.warn('Not building the native extensions: %s' % error)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except self.errors as error:
+            self.warn('Not building %s: %s' % (ext.name, error))
 
 
 setup(
@@ -15,11 +52,13 @@ setup(
     version='0.1.0',
     description='This implements "Change detection in hierarchically structured information", by Sudarshan S. Chawathe, Anand Rajaraman, Hector Garcia-Molina, and Jennifer Widom.',
 
-    long_description=open('README.md').read() 
+    long_description=open('README.md').read()
             if os.path.exists('README.md') else '',
 
     packages=['xtdiff', ],
     include_package_data=True,
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': optional_build_ext},
     install_requires=[
         'lxml',
     ],
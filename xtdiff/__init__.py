@@ -12,10 +12,15 @@ information." In ACM SIGMOD Record, vol. 25, no. 2, pp. 493-504. ACM,
 1996.
 """
 
-from .diff import diff, transform, simplematch, fastmatch
-from .diff import INSERT, UPDATE, MOVE, DELETE, Match
-from .xsl import toxsl, xsldiff
+from .diff import diff, iterdiff, transform, simplematch, fastmatch
+from .diff import hashmatch, equal, changed, summary, PreparedTree, Budget
+from .diff import INSERT, UPDATE, MOVE, DELETE, Match, KeyMatch
+from .xsl import toxsl, toxslt, xsldiff
+from .parallel import diff_many
+from .instrument import Instrumentation
 
-__all__ = ['diff', 'transform', 'simplematch', 'fastmatch',
-           'INSERT', 'UPDATE', 'MOVE', 'DELETE', 'Match',
-           'toxsl', 'xsldiff']
+__all__ = ['diff', 'iterdiff', 'transform', 'simplematch', 'fastmatch',
+           'hashmatch', 'KeyMatch', 'equal', 'changed', 'summary',
+           'PreparedTree', 'Budget', 'INSERT', 'UPDATE', 'MOVE', 'DELETE',
+           'Match', 'toxsl', 'toxslt', 'xsldiff', 'diff_many',
+           'Instrumentation']
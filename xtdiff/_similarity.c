@@ -0,0 +1,442 @@
+/*
+ * A native implementation of the text similarity ratios xtdiff compares
+ * texts with (see similarity.py).
+ *
+ * These are exactly the ratios difflib.SequenceMatcher gives, without a
+ * junk function and with its autojunk heuristic, which ignores
+ * characters that make up more than 1% of a second text of 200 or more
+ * characters when looking for matches. The matching blocks are found
+ * the same way, by recursively taking the longest match, with the same
+ * tie breaking, so the ratios are the same to the last bit. The work is
+ * done on copies of the texts without holding the GIL.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* The state of matching a text against a second text, b */
+typedef struct {
+    /* The distinct characters of b, in an open addressing hash table
+       of ids */
+    Py_ssize_t mask;
+    Py_UCS4 *keys;
+    Py_ssize_t *ids;
+    Py_ssize_t distinct;
+
+    /* For each id, the number of times it's in b, whether it's
+       popular, and where its positions in b start in positions */
+    Py_ssize_t *counts;
+    char *popular;
+    Py_ssize_t *starts;
+    Py_ssize_t *positions;
+
+    /* The length of the match ending at each position of b in the
+       previous and current rows of the search for the longest match,
+       and the rows they were found in */
+    Py_ssize_t *previous_length;
+    Py_ssize_t *previous_row;
+    Py_ssize_t *current_length;
+    Py_ssize_t *current_row;
+    Py_ssize_t row;
+} matcher;
+
+static void
+matcher_free(matcher *m)
+{
+    free(m->keys);
+    free(m->ids);
+    free(m->counts);
+    free(m->popular);
+    free(m->starts);
+    free(m->positions);
+    free(m->previous_length);
+    free(m->previous_row);
+    free(m->current_length);
+    free(m->current_row);
+}
+
+static Py_ssize_t
+matcher_slot(const matcher *m, Py_UCS4 c)
+{
+    Py_UCS4 hash = c * 2654435761u;
+    Py_ssize_t slot = (Py_ssize_t)(hash ^ (hash >> 16)) & m->mask;
+
+    while (m->ids[slot] >= 0 && m->keys[slot] != c)
+        slot = (slot + 1) & m->mask;
+    return slot;
+}
+
+static Py_ssize_t
+matcher_id(const matcher *m, Py_UCS4 c)
+{
+    return m->ids[matcher_slot(m, c)];
+}
+
+/* Index b. Returns -1 if memory runs out. */
+static int
+matcher_init(matcher *m, const Py_UCS4 *b, Py_ssize_t lb)
+{
+    Py_ssize_t size = 8, slot, id, j, start;
+    Py_ssize_t n = lb + 1;
+
+    memset(m, 0, sizeof(matcher));
+    while (size < 2 * lb)
+        size *= 2;
+    m->mask = size - 1;
+    m->keys = malloc(size * sizeof(Py_UCS4));
+    m->ids = malloc(size * sizeof(Py_ssize_t));
+    m->counts = calloc(n, sizeof(Py_ssize_t));
+    m->popular = calloc(n, 1);
+    m->starts = malloc(n * sizeof(Py_ssize_t));
+    m->positions = malloc(n * sizeof(Py_ssize_t));
+    m->previous_length = malloc(n * sizeof(Py_ssize_t));
+    m->previous_row = malloc(n * sizeof(Py_ssize_t));
+    m->current_length = malloc(n * sizeof(Py_ssize_t));
+    m->current_row = malloc(n * sizeof(Py_ssize_t));
+    if (m->keys == NULL || m->ids == NULL || m->counts == NULL ||
+            m->popular == NULL || m->starts == NULL ||
+            m->positions == NULL || m->previous_length == NULL ||
+            m->previous_row == NULL || m->current_length == NULL ||
+            m->current_row == NULL) {
+        matcher_free(m);
+        return -1;
+    }
+
+    for (slot = 0; slot < size; slot++)
+        m->ids[slot] = -1;
+    for (j = 0; j < lb; j++) {
+        slot = matcher_slot(m, b[j]);
+        if (m->ids[slot] < 0) {
+            m->ids[slot] = m->distinct++;
+            m->keys[slot] = b[j];
+        }
+        m->counts[m->ids[slot]]++;
+    }
+
+    /* The positions of each character, in order, like
+       SequenceMatcher's b2j. current_length is borrowed for the next
+       position of each. */
+    start = 0;
+    for (id = 0; id < m->distinct; id++) {
+        m->starts[id] = m->current_length[id] = start;
+        start += m->counts[id];
+    }
+    for (j = 0; j < lb; j++)
+        m->positions[m->current_length[matcher_id(m, b[j])]++] = j;
+
+    /* Popular characters aren't used to find matches */
+    if (lb >= 200) {
+        Py_ssize_t ntest = lb / 100 + 1;
+        for (id = 0; id < m->distinct; id++)
+            m->popular[id] = m->counts[id] > ntest;
+    }
+
+    for (j = 0; j < n; j++)
+        m->previous_row[j] = m->current_row[j] = -1;
+    m->row = 0;
+    return 0;
+}
+
+/* SequenceMatcher.find_longest_match() */
+static void
+longest_match(matcher *m, const Py_UCS4 *a, const Py_UCS4 *b,
+              Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi,
+              Py_ssize_t *besti, Py_ssize_t *bestj, Py_ssize_t *bestsize)
+{
+    Py_ssize_t i, j, k, p, end, id, *swap;
+    Py_ssize_t bi = alo, bj = blo, bs = 0;
+
+    /* Skip a row, so nothing from the last search is taken to be from
+       the previous row. */
+    m->row++;
+
+    for (i = alo; i < ahi; i++) {
+        m->row++;
+        id = matcher_id(m, a[i]);
+        if (id >= 0 && !m->popular[id]) {
+            end = m->starts[id] + m->counts[id];
+            for (p = m->starts[id]; p < end; p++) {
+                j = m->positions[p];
+                if (j < blo)
+                    continue;
+                if (j >= bhi)
+                    break;
+                if (j > 0 && m->previous_row[j - 1] == m->row - 1)
+                    k = m->previous_length[j - 1] + 1;
+                else
+                    k = 1;
+                m->current_length[j] = k;
+                m->current_row[j] = m->row;
+                if (k > bs) {
+                    bi = i - k + 1;
+                    bj = j - k + 1;
+                    bs = k;
+                }
+            }
+        }
+        swap = m->previous_length;
+        m->previous_length = m->current_length;
+        m->current_length = swap;
+        swap = m->previous_row;
+        m->previous_row = m->current_row;
+        m->current_row = swap;
+    }
+
+    /* Extend the match with any equal characters around it, popular
+       ones included. */
+    while (bi > alo && bj > blo && a[bi - 1] == b[bj - 1]) {
+        bi--;
+        bj--;
+        bs++;
+    }
+    while (bi + bs < ahi && bj + bs < bhi && a[bi + bs] == b[bj + bs])
+        bs++;
+
+    *besti = bi;
+    *bestj = bj;
+    *bestsize = bs;
+}
+
+/* The number of characters in SequenceMatcher.get_matching_blocks().
+   Returns -1 if memory runs out. */
+static Py_ssize_t
+matching(matcher *m, const Py_UCS4 *a, Py_ssize_t la, const Py_UCS4 *b,
+         Py_ssize_t lb)
+{
+    Py_ssize_t *stack, *grown, capacity = 64, depth = 0, matches = 0;
+    Py_ssize_t alo, ahi, blo, bhi, i, j, k;
+
+    stack = malloc(capacity * 4 * sizeof(Py_ssize_t));
+    if (stack == NULL)
+        return -1;
+    stack[0] = 0;
+    stack[1] = la;
+    stack[2] = 0;
+    stack[3] = lb;
+    depth = 1;
+
+    while (depth > 0) {
+        depth--;
+        alo = stack[depth * 4];
+        ahi = stack[depth * 4 + 1];
+        blo = stack[depth * 4 + 2];
+        bhi = stack[depth * 4 + 3];
+        longest_match(m, a, b, alo, ahi, blo, bhi, &i, &j, &k);
+        if (k == 0)
+            continue;
+        matches += k;
+
+        if (depth + 2 > capacity) {
+            capacity *= 2;
+            grown = realloc(stack, capacity * 4 * sizeof(Py_ssize_t));
+            if (grown == NULL) {
+                free(stack);
+                return -1;
+            }
+            stack = grown;
+        }
+        if (alo < i && blo < j) {
+            stack[depth * 4] = alo;
+            stack[depth * 4 + 1] = i;
+            stack[depth * 4 + 2] = blo;
+            stack[depth * 4 + 3] = j;
+            depth++;
+        }
+        if (i + k < ahi && j + k < bhi) {
+            stack[depth * 4] = i + k;
+            stack[depth * 4 + 1] = ahi;
+            stack[depth * 4 + 2] = j + k;
+            stack[depth * 4 + 3] = bhi;
+            depth++;
+        }
+    }
+
+    free(stack);
+    return matches;
+}
+
+/* SequenceMatcher.quick_ratio()'s number of matches. Returns -1 if
+   memory runs out. */
+static Py_ssize_t
+quick_matching(const matcher *m, const Py_UCS4 *a, Py_ssize_t la)
+{
+    Py_ssize_t i, id, matches = 0;
+    Py_ssize_t *available = malloc((m->distinct + 1) * sizeof(Py_ssize_t));
+
+    if (available == NULL)
+        return -1;
+    memcpy(available, m->counts, m->distinct * sizeof(Py_ssize_t));
+    for (i = 0; i < la; i++) {
+        id = matcher_id(m, a[i]);
+        if (id >= 0 && available[id] > 0) {
+            available[id]--;
+            matches++;
+        }
+    }
+    free(available);
+    return matches;
+}
+
+static double
+calculate_ratio(Py_ssize_t matches, Py_ssize_t length)
+{
+    if (length)
+        return 2.0 * matches / length;
+    return 1.0;
+}
+
+/* The ratio of the texts, or if there's a threshold and a bound on the
+   ratio falls short of it, the bound. Returns -1 if memory runs
+   out. */
+static int
+text_ratio(const Py_UCS4 *a, Py_ssize_t la, const Py_UCS4 *b,
+           Py_ssize_t lb, int quick, int has_threshold, double threshold,
+           double *result)
+{
+    matcher m;
+    Py_ssize_t matches;
+    double bound;
+
+    if (has_threshold) {
+        bound = calculate_ratio(la < lb ? la : lb, la + lb);
+        if (bound < threshold) {
+            *result = bound;
+            return 0;
+        }
+    }
+
+    if (matcher_init(&m, b, lb) < 0)
+        return -1;
+    if (quick || has_threshold) {
+        matches = quick_matching(&m, a, la);
+        if (matches < 0) {
+            matcher_free(&m);
+            return -1;
+        }
+        bound = calculate_ratio(matches, la + lb);
+        if (quick || bound < threshold) {
+            matcher_free(&m);
+            *result = bound;
+            return 0;
+        }
+    }
+
+    matches = matching(&m, a, la, b, lb);
+    matcher_free(&m);
+    if (matches < 0)
+        return -1;
+    *result = calculate_ratio(matches, la + lb);
+    return 0;
+}
+
+static int
+parse_threshold(PyObject *object, int *has_threshold, double *threshold)
+{
+    *has_threshold = object != Py_None;
+    if (*has_threshold) {
+        *threshold = PyFloat_AsDouble(object);
+        if (*threshold == -1.0 && PyErr_Occurred())
+            return -1;
+    }
+    return 0;
+}
+
+/* The ratio of a pair of str objects */
+static PyObject *
+pair_ratio(PyObject *a, PyObject *b, int quick, int has_threshold,
+           double threshold)
+{
+    Py_UCS4 *a_chars, *b_chars;
+    Py_ssize_t la = PyUnicode_GET_LENGTH(a), lb = PyUnicode_GET_LENGTH(b);
+    double result = 0.0;
+    int status;
+
+    /* The bound on the lengths doesn't need copies of the texts */
+    if (has_threshold) {
+        result = calculate_ratio(la < lb ? la : lb, la + lb);
+        if (result < threshold)
+            return PyFloat_FromDouble(result);
+    }
+
+    a_chars = PyUnicode_AsUCS4Copy(a);
+    if (a_chars == NULL)
+        return NULL;
+    b_chars = PyUnicode_AsUCS4Copy(b);
+    if (b_chars == NULL) {
+        PyMem_Free(a_chars);
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = text_ratio(a_chars, la, b_chars, lb, quick, has_threshold,
+                        threshold, &result);
+    Py_END_ALLOW_THREADS
+
+    PyMem_Free(a_chars);
+    PyMem_Free(b_chars);
+    if (status < 0)
+        return PyErr_NoMemory();
+    return PyFloat_FromDouble(result);
+}
+
+PyDoc_STRVAR(ratio_doc,
+"ratio(a, b, threshold=None)\n\n"
+"Return difflib.SequenceMatcher's ratio() for the given texts. If a\n"
+"threshold is given and an upper bound on the ratio already falls\n"
+"short of it, the bound is returned instead.");
+
+static PyObject *
+similarity_ratio(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *keywords[] = {"a", "b", "threshold", NULL};
+    PyObject *a, *b, *threshold_object = Py_None;
+    double threshold = 0.0;
+    int has_threshold;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "UU|O:ratio", keywords,
+                                     &a, &b, &threshold_object))
+        return NULL;
+    if (parse_threshold(threshold_object, &has_threshold, &threshold) < 0)
+        return NULL;
+    return pair_ratio(a, b, 0, has_threshold, threshold);
+}
+
+PyDoc_STRVAR(quick_ratio_doc,
+"quick_ratio(a, b)\n\n"
+"Return difflib.SequenceMatcher's quick_ratio() for the given texts.");
+
+static PyObject *
+similarity_quick_ratio(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *keywords[] = {"a", "b", NULL};
+    PyObject *a, *b;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "UU:quick_ratio",
+                                     keywords, &a, &b))
+        return NULL;
+    return pair_ratio(a, b, 1, 0, 0.0);
+}
+
+static PyMethodDef similarity_methods[] = {
+    {"ratio", (PyCFunction)(void(*)(void))similarity_ratio,
+     METH_VARARGS | METH_KEYWORDS, ratio_doc},
+    {"quick_ratio", (PyCFunction)(void(*)(void))similarity_quick_ratio,
+     METH_VARARGS | METH_KEYWORDS, quick_ratio_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef similarity_module = {
+    PyModuleDef_HEAD_INIT,
+    "xtdiff._similarity",
+    "Native text similarity ratios, the same as difflib's.",
+    -1,
+    similarity_methods
+};
+
+PyMODINIT_FUNC
+PyInit__similarity(void)
+{
+    return PyModule_Create(&similarity_module);
+}
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent cache of diffs.
+
+A DiffCache keeps the results of diff() and xsldiff() in an sqlite
+database on disk, so pairs of documents that are diffed over and over,
+by any number of processes, are only diffed once. Results are keyed by
+a digest of the canonical form of each tree together with the match
+function and threshold, so a repeated request costs one serialization
+and hash of each tree. Mapped trees (see the mapped module) are hashed
+as they are in their files instead, so they have different keys from
+the same documents parsed by lxml.
+
+    >>> cache = DiffCache('/var/cache/xtdiff.db')
+    >>> actions = cache.diff(left_root, right_root)
+
+Edit scripts are stored in the binary format of the serialize module
+and XSL stylesheets as XML. Once the entries grow past max_size bytes
+the least recently used are evicted.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import pickle
+import sqlite3
+import time
+import types
+
+from lxml import etree
+
+from .diff import THRESHOLD, simplematch, diff, getpath, _root
+from .serialize import dumps, loads, VERSION
+from .xsl import toxsl
+
+
+# The default size the entries of a cache are kept under, in bytes
+CACHE_SIZE = 256 * 1024 * 1024
+
+# The number of seconds to wait for another process's lock
+TIMEOUT = 30
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+'''
+
+
+def tree_digest(tree):
+    """ Return a digest of the canonical form of the given tree, which
+        may be prepared, including its tail and where its root is in its
+        document. A mapped tree is hashed as it is in its file, without
+        copying it, so its digest differs from that of the same tree
+        parsed by lxml. """
+    root = _root(tree)
+    hasher = hashlib.sha1()
+    hasher.update(getpath(root).encode('utf-8'))
+    hasher.update(b'\0')
+    if hasattr(root, 'hash_source'):
+        hasher.update(b'mapped\0')
+        root.hash_source(hasher)
+    else:
+        hasher.update(etree.tostring(root, method='c14n', with_tail=False))
+    hasher.update(b'\0')
+    hasher.update((root.tail or '').encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def _match_name(match):
+    """ Return the name a match function is known by in keys. Functions
+        are known by their module and name. Other callables, like a
+        KeyMatch or a partial, are known by their type and a digest of
+        their pickle, which holds how they're configured. """
+    if isinstance(match, (types.FunctionType, types.BuiltinFunctionType)):
+        name = getattr(match, '__qualname__', match.__name__)
+        if '<lambda>' in name or '<locals>' in name:
+            raise ValueError('Anonymous match functions can\'t be cached')
+        return '%s.%s' % (match.__module__, name)
+
+    try:
+        data = pickle.dumps(match, 2)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        raise ValueError('Match functions that can\'t be pickled can\'t '
+                         'be cached')
+    return '%s.%s:%s' % (type(match).__module__, type(match).__name__,
+                         hashlib.sha1(data).hexdigest())
+
+
+class DiffCache(object):
+    """ A cache of diffs in the sqlite database at the given path, whose
+        entries are kept under max_size bytes. """
+
+    def __init__(self, path, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.connection = sqlite3.connect(path, timeout=TIMEOUT)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def key(self, kind, left_tree, right_tree, match=simplematch,
+            match_threshold=THRESHOLD):
+        """ Return the key of a diff of the given kind. """
+        return '%s:%d:%s:%r:%s:%s' % (kind, VERSION, _match_name(match),
+                                      match_threshold,
+                                      tree_digest(left_tree),
+                                      tree_digest(right_tree))
+
+    def get(self, key):
+        """ Return the data stored for the key, or None. """
+        with self.connection:
+            row = self.connection.execute(
+                'SELECT data FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                'UPDATE entries SET used = ? WHERE key = ?',
+                (time.time(), key))
+        return bytes(row[0])
+
+    def set(self, key, data):
+        """ Store the data for the key, evicting the least recently used
+            entries if the cache has grown too large. """
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                (key, sqlite3.Binary(data), len(data), time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_size:
+            return
+        evicted = []
+        for key, size in self.connection.execute(
+                'SELECT key, size FROM entries ORDER BY used'):
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        self.connection.executemany('DELETE FROM entries WHERE key = ?',
+                                    evicted)
+
+    def clear(self):
+        """ Remove every entry. """
+        with self.connection:
+            self.connection.execute('DELETE FROM entries')
+
+    def diff(self, left_tree, right_tree, match=simplematch,
+             match_threshold=THRESHOLD, serialized=False):
+        """ Return diff() of the trees, from the cache if it's there.
+            If serialized is True, the edit script is returned in the
+            binary format of the serialize module. """
+        key = self.key('diff', left_tree, right_tree, match,
+                       match_threshold)
+        data = self.get(key)
+        if data is None:
+            data = dumps(diff(left_tree, right_tree, match=match,
+                              match_threshold=match_threshold))
+            self.set(key, data)
+        return data if serialized else loads(data)
+
+    def xsldiff(self, left_tree, right_tree, match=simplematch,
+                match_threshold=THRESHOLD, serialized=False):
+        """ Return xsldiff() of the trees, from the cache if it's there.
+            If serialized is True, the stylesheet is returned as bytes.
+            """
+        key = self.key('xsl', left_tree, right_tree, match,
+                       match_threshold)
+        data = self.get(key)
+        if data is None:
+            data = etree.tostring(toxsl(diff(left_tree, right_tree,
+                                             match=match,
+                                             match_threshold=match_threshold)))
+            self.set(key, data)
+        return data if serialized else etree.fromstring(data)
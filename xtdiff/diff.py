@@ -2,17 +2,39 @@
 
 from __future__ import unicode_literals
 
-from collections import namedtuple
-from copy import deepcopy
-from difflib import SequenceMatcher
-from collections import MutableSet
+import re
+from array import array
+from collections import namedtuple, OrderedDict
+try:
+    from collections.abc import MutableSet
+except ImportError:  # Python 2.7
+    from collections import MutableSet
+try:
+    from time import perf_counter as clock
+except ImportError:  # Python 2
+    from time import time as clock
 
 from lxml import etree
 
+from . import similarity
+from .tree import TreeIndex, WorkingCopy, PathIndex, is_element
+
 
 # The default equality threshold
 THRESHOLD = 0.8
 
+# The number of text comparisons remembered during a single match
+RATIO_CACHE_SIZE = 10000
+
+# How far, in differences, lcs() searches a box for its middle snake
+# before settling for a split: the factor times the square root of the
+# box's size, but at least the minimum
+LCS_COST_FACTOR = 1
+LCS_MIN_COST = 64
+
+# The most comparisons of nodes summary() makes by default
+SUMMARY_COMPARISONS = 10000
+
 # This is a simple definition of our possible edit actions
 INSERT = namedtuple('INSERT', ['node', 'parent', 'index'])
 DELETE = namedtuple('DELETE', ['path'])
@@ -22,6 +44,13 @@ MOVE = namedtuple('MOVE', ['path', 'parent', 'index'])
 # A simple Match between two elements, a and b.
 Match = namedtuple('Match', ['a', 'b'])
 
+# The number of each kind of action it would take to transform one tree
+# into another, how similar they are, and whether the numbers are only
+# estimates
+Summary = namedtuple('Summary', ['inserted', 'updated', 'moved', 'deleted',
+                                 'similarity', 'approximate'])
+Summary.__new__.__defaults__ = (False,)
+
 
 # http://code.activestate.com/recipes/576694-orderedset/
 class OrderedSet(MutableSet):
@@ -91,32 +120,165 @@ class OrderedSet(MutableSet):
         return set(self) == set(other)
 
 
+class EditScript(OrderedSet):
+    """ The edit script of a diff made within a Budget. fallback is the
+        cheaper matching that was fallen back on when the budget ran
+        out (see Budget), or None if it didn't. """
+
+    def __init__(self, iterable=None, fallback=None):
+        super(EditScript, self).__init__(iterable)
+        self.fallback = fallback
+
+
+class MatchSet(OrderedSet):
+    """ An ordered set of Match objects that also indexes each match by
+        both of its nodes, so finding a node's partner doesn't require
+        a scan of the whole set. """
+
+    def __init__(self, iterable=None):
+        self.left = {}                  # a --> b
+        self.right = {}                 # b --> a
+        super(MatchSet, self).__init__(iterable)
+
+    def add(self, key):
+        if key not in self.map:
+            super(MatchSet, self).add(key)
+            a, b = key
+            # Nodes keep the first partner they were matched with
+            self.left.setdefault(a, b)
+            self.right.setdefault(b, a)
+
+    def discard(self, key):
+        if key in self.map:
+            super(MatchSet, self).discard(key)
+            a, b = key
+            if self.left.get(a) is b:
+                del self.left[a]
+                # Fall back to any other match the node is part of
+                for other_a, other_b in self:
+                    if other_a is a:
+                        self.left[a] = other_b
+                        break
+            if self.right.get(b) is a:
+                del self.right[b]
+                for other_a, other_b in self:
+                    if other_b is b:
+                        self.right[b] = other_a
+                        break
+
+    def partner(self, node):
+        """ Return the node matched with the given node, or None. """
+        partner = self.left.get(node)
+        if partner is None:
+            partner = self.right.get(node)
+        return partner
+
+
 def getpath(node):
     """ Return the XPath for the given node. This wraps a couple of lxml
         functions for convenience """
     return node.getroottree().getpath(node)
 
 
-def compare(left_node, right_node):
+class RatioCache(object):
+    """ A bounded memo of text similarity ratios, keyed on the pair of
+        texts compared. Each ratio is stored with whether it's exact or
+        only an upper bound. Once it's full the oldest ratios are
+        forgotten first. """
+
+    def __init__(self, maxsize=RATIO_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.ratios = OrderedDict()
+
+    def get(self, a, b):
+        """ Return (ratio, exact) for the given texts, or None. """
+        return self.ratios.get((a, b))
+
+    def set(self, a, b, ratio, exact=True):
+        if (a, b) in self.ratios:
+            del self.ratios[(a, b)]
+        elif len(self.ratios) >= self.maxsize:
+            self.ratios.popitem(last=False)
+        self.ratios[(a, b)] = (ratio, exact)
+
+
+def text_ratio(a, b, threshold=None, cache=None, instrument=None):
+    """ Return difflib.SequenceMatcher's ratio for the given texts,
+        worked out by the similarity module.
+
+        If a threshold is given and a cheap upper bound on the ratio
+        already falls short of it, the bound is returned instead. If a
+        RatioCache is given, ratios and bounds are remembered in it, and
+        a remembered bound is reused when it falls short of the
+        threshold too. An optional Instrumentation counts cache hits and
+        ratios worked out.
+        """
+
+    if a == b:
+        return 1.0
+
+    if cache is not None:
+        cached = cache.get(a, b)
+        if cached is not None:
+            ratio, exact = cached
+            if exact or (threshold is not None and ratio < threshold):
+                if instrument is not None:
+                    instrument.count('ratio_cache')
+                return ratio
+
+    if instrument is not None:
+        instrument.count('sequence_matcher')
+    ratio = similarity.ratio(a, b, threshold)
+    if cache is not None:
+        # Below the threshold this may only be a bound on the ratio
+        cache.set(a, b, ratio,
+                  exact=threshold is None or ratio >= threshold)
+    return ratio
+
+
+def compare(left_node, right_node, threshold=None, cache=None):
     """
         Evaluate how different left_node's text, tail, and attributes
         are from right_node's text, tail, and attributes. The nodes
         should probably be leaf nodes, but this is enforced.
 
         This will return a number in the range [0,2]
+
+        If a threshold is given, the text is only compared in full when
+        the result could reach threshold * 2. Otherwise the number
+        returned may be an upper bound that's below threshold * 2. An
+        optional RatioCache remembers text comparisons.
     """
 
+    return _compare(left_node.attrib == right_node.attrib,
+                    left_node.text, right_node.text,
+                    threshold=threshold, cache=cache)
+
+
+def _compare(same_attrib, left_text, right_text, threshold=None,
+             cache=None, instrument=None):
+    """ compare() for nodes with the given texts, whose attributes are
+        or aren't the same. """
+
+    if instrument is not None:
+        instrument.count('compare')
+
     # Just use difflib.SequenceMatcher's ratio for this.
     ratio = 0
 
     # Matching attributes add a lot of weight to matching elements
-    if left_node.attrib == right_node.attrib:
+    if same_attrib:
         ratio += 1
 
-    if left_node.text is not None and right_node.text is not None:
-        text_matcher = SequenceMatcher(a=left_node.text, b=right_node.text)
-        ratio += text_matcher.ratio()
-    elif left_node.text is None and right_node.text is None:
+    if left_text is not None and right_text is not None:
+        # The text ratio needed for the total to reach the threshold
+        text_threshold = None
+        if threshold is not None:
+            text_threshold = threshold * 2 - ratio
+        ratio += text_ratio(left_text, right_text,
+                            threshold=text_threshold, cache=cache,
+                            instrument=instrument)
+    elif left_text is None and right_text is None:
         # Both are None
         ratio += 1
 
@@ -133,9 +295,184 @@ def compare(left_node, right_node):
     return ratio
 
 
-def common_descendents(left_node, right_node, threshold=THRESHOLD):
+class BudgetExceeded(Exception):
+    """ Raised when the work of matching exceeds its Budget. """
+
+
+class Budget(object):
+    """
+    A limit on the work of matching a pair of trees: at most the given
+    number of comparisons of nodes, until the given number of seconds
+    from now have passed, or both.
+
+    When the budget runs out the match functions fall back on cheaper
+    matching, so a valid edit script still comes back in bounded time,
+    though it may be longer than it needs to be. If the exact matching
+    of identical subtrees, which comes first, is done, the matches made
+    so far stand and fallback is 'hashmatch'. If time runs out before
+    then, the rest of the nodes beneath matched parents are matched by
+    id or by their position among their siblings with the same tag,
+    and fallback is 'position'.
+
+    Match functions of your own are given the budget as a budget
+    keyword argument and should call spend() for each comparison they
+    make. If BudgetExceeded gets out of one, diff() falls back on
+    hashmatch().
+
+    A budget can be used for more than one diff: diff(), iterdiff() and
+    summary() start it again before they match, so each of them has the
+    whole budget and the fallback of the last.
+    """
+
+    def __init__(self, comparisons=None, seconds=None):
+        self.comparisons = comparisons
+        self.seconds = seconds
+        self.start()
+
+    def start(self):
+        """ Start the budget again: nothing is spent, there's no
+            fallback and the seconds are counted from now. """
+        self.deadline = (None if self.seconds is None
+                         else clock() + self.seconds)
+        self.spent = 0
+        self.fallback = None
+
+    def check(self):
+        """ Raise BudgetExceeded if the deadline has passed. """
+        if self.deadline is not None and clock() > self.deadline:
+            raise BudgetExceeded('The deadline has passed')
+
+    def spend(self, comparisons=1):
+        """ Spend the given number of comparisons, raising
+            BudgetExceeded if the budget has run out. """
+        self.spent += comparisons
+        if self.comparisons is not None and self.spent > self.comparisons:
+            raise BudgetExceeded('%d comparisons have been made' %
+                                 self.comparisons)
+        self.check()
+
+
+class _NoStage(object):
+    """ A stage that isn't timed, used when there's no Instrumentation. """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def _stage(instrument, name):
+    """ Return a context manager timing the stage with the given name, if
+        there's an Instrumentation. """
+    if instrument is None:
+        return _NO_STAGE
+    return instrument.stage(name)
+
+
+class PreparedTree(object):
+    """
+    A tree that's going to be diffed many times, against a series of
+    revisions, say. The tree's index, which holds its subtree hashes,
+    leaves and tag chains, is built once, and text comparisons made
+    while matching it are remembered from one diff to the next.
+
+    A PreparedTree can be given to diff(), iterdiff(), summary() and the
+    match functions on either side in place of its root. The tree must
+    not be changed once it's prepared.
+    """
+
+    def __init__(self, root, ratio_cache_size=RATIO_CACHE_SIZE):
+        self.root = root
+        self.index = TreeIndex(root)
+        self.ratios = RatioCache(ratio_cache_size)
+
+
+def _root(tree):
+    """ Return the root of the given tree, which may be prepared. """
+    if isinstance(tree, PreparedTree):
+        return tree.root
+    return tree
+
+
+class MatchContext(object):
+    """ The state shared by the matching functions while matching a
+        pair of trees: an index of each tree, the matches made so far
+        and a memo of text comparisons. Prepared trees bring their own
+        index and memo.
+
+        The matching functions work on the positions of nodes in the
+        indexes. Each node's partner, or -1, is kept in the left_partner
+        and right_partner arrays, and each match is also added to the
+        matches set of lxml nodes that's returned in the end. An optional
+        Instrumentation and Budget are kept for the matching functions to
+        use. """
+
+    def __init__(self, left_root, right_root, matches=None,
+                 instrument=None, budget=None):
+        # The indexes share their tag symbols so tags can be compared.
+        # A prepared tree's symbols are used for the other tree, unless
+        # it's prepared too with its own, in which case it's indexed
+        # again.
+        left_index = right_index = None
+        if isinstance(left_root, PreparedTree):
+            left_index = left_root.index
+        if isinstance(right_root, PreparedTree) and \
+                (left_index is None or
+                 right_root.index.symbols is left_index.symbols):
+            right_index = right_root.index
+
+        if left_index is not None:
+            symbols = left_index.symbols
+        elif right_index is not None:
+            symbols = right_index.symbols
+        else:
+            symbols = {}
+        with _stage(instrument, 'index'):
+            if left_index is None:
+                left_index = TreeIndex(_root(left_root), symbols)
+            if right_index is None:
+                right_index = TreeIndex(_root(right_root), symbols)
+        self.left = left_index
+        self.right = right_index
+
+        prepared = [tree for tree in (left_root, right_root)
+                    if isinstance(tree, PreparedTree)]
+        self.ratios = prepared[0].ratios if prepared else RatioCache()
+        self.matches = matches if matches is not None else MatchSet()
+        self.left_partner = array('i', [-1]) * len(self.left)
+        self.right_partner = array('i', [-1]) * len(self.right)
+        self.instrument = instrument
+        self.budget = budget
+
+    def add(self, i, j):
+        """ Match the left node at position i with the right node at
+            position j. """
+        self.left_partner[i] = j
+        self.right_partner[j] = i
+        self.matches.add(Match(self.left.nodes[i], self.right.nodes[j]))
+
+
+class _NoMatches(object):
+    """ A match set that doesn't keep its matches, for when only the
+        partners a MatchContext keeps are needed. """
+
+    def add(self, match):
+        pass
+
+
+def common_descendents(left_node, right_node, threshold=THRESHOLD,
+                       context=None):
     """ Return the a ratio of common descendents between the two nodes
-        over the maximum number of descendents between either. """
+        over the maximum number of descendents between either.
+
+        Given a MatchContext, this is the ratio from the Chawathe paper:
+        only leaves are counted, and two leaves are common if they have
+        been matched with each other. Otherwise every pair of
+        descendents that compare() finds equal is counted. """
 
     count = 0.0
 
@@ -144,12 +481,18 @@ def common_descendents(left_node, right_node, threshold=THRESHOLD):
             hasattr(right_node, 'is_text') and right_node.is_text:
         return count
 
+    if context is not None:
+        return _common_descendents(context,
+                                   context.left.position[left_node],
+                                   context.right.position[right_node])
+
     # Cycle over and count children
     left_descendents = left_node.xpath('.//*')
     right_descendents = right_node.xpath('.//*')
     for left_child in left_descendents:
         for right_child in right_descendents:
-            if compare(left_child, right_child) >= (threshold * 2):
+            if compare(left_child, right_child,
+                       threshold=threshold) >= (threshold * 2):
                 count += 1
 
     max_descendents = max(len(left_descendents), len(right_descendents))
@@ -158,8 +501,35 @@ def common_descendents(left_node, right_node, threshold=THRESHOLD):
     return 0.0
 
 
-def equal_match(left_node, right_node, threshold=THRESHOLD):
-    """ Rough equality matching for our matching algorithm. """
+def _common_descendents(context, i, j):
+    """ common_descendents() for the left node at position i and the
+        right node at position j, using the matches in the context. """
+
+    # Count the left leaves whose partners are leaves beneath the right
+    # node.
+    count = 0.0
+    right_end = context.right.end
+    end = right_end[j]
+    left_partner = context.left_partner
+    for k in context.left.descendent_leaves(i):
+        partner = left_partner[k]
+        if j < partner < end and right_end[partner] == partner + 1:
+            count += 1
+
+    max_leaves = max(context.left.leaf_count[i],
+                     context.right.leaf_count[j])
+    if max_leaves > 0:
+        return count / max_leaves
+    return 0.0
+
+
+def equal_match(left_node, right_node, threshold=THRESHOLD, context=None):
+    """ Rough equality matching for our matching algorithm. The optional
+        MatchContext is used to compare internal nodes. """
+
+    if context is not None:
+        return _equal_match(context, context.left.position[left_node],
+                            context.right.position[right_node], threshold)
 
     # If their tags aren't equal, the nodes aren't equal.
     if left_node.tag != right_node.tag:
@@ -175,7 +545,8 @@ def equal_match(left_node, right_node, threshold=THRESHOLD):
     # Compare leaf nodes
     if len(left_node.getchildren()) == 0 and \
             len(right_node.getchildren()) == 0:
-        if compare(left_node, right_node) >= (threshold * 2):
+        if compare(left_node, right_node,
+                   threshold=threshold) >= (threshold * 2):
             return True
 
     # Compare internal nodes
@@ -190,109 +561,673 @@ def equal_match(left_node, right_node, threshold=THRESHOLD):
     return False
 
 
-def lcs(x_sequence, y_sequence, equal_func):
-    """ Myers's Longest Common Subsequence """
+def _equal_match(context, i, j, threshold=THRESHOLD):
+    """ equal_match() for the left node at position i and the right node
+        at position j, using the indexes and matches in the context. """
+
+    left, right = context.left, context.right
+    if context.budget is not None:
+        context.budget.spend()
+
+    # If their tags aren't equal, the nodes aren't equal.
+    if left.tags[i] != right.tags[j]:
+        return False
+
+    # If there's a matching id between the two elements, they are
+    # automatically equal.
+    if left.ids[i] is not None and left.ids[i] == right.ids[j]:
+        return True
 
-    if not len(x_sequence) or not len(y_sequence):
-        return OrderedSet()
+    # Compare leaf nodes
+    if left.is_leaf(i) and right.is_leaf(j):
+        return _compare(left.attrib[i] == right.attrib[j],
+                        left.text[i], right.text[j],
+                        threshold=threshold, cache=context.ratios,
+                        instrument=context.instrument) >= (threshold * 2)
+
+    # Compare internal nodes. At best every leaf of the smaller node is
+    # common, so if that isn't enough we don't need to count.
+    left_count = left.leaf_count[i]
+    right_count = right.leaf_count[j]
+    if min(left_count, right_count) < \
+            threshold * max(left_count, right_count):
+        return False
 
-    # Get the first item of each list and the remainder of each list as
-    # a list.
+    return _common_descendents(context, i, j) >= threshold
+
+
+def _middle_snake(x_sequence, y_sequence, left, top, right, bottom,
+                  equal_func, max_cost=None):
+    """ Find the middle snake of the edit graph bounded by (left, top)
+        and (right, bottom), as described in section 4b of Myers's "An
+        O(ND) Difference Algorithm and Its Variations".
+
+        Returns the end of the box preceding the snake, the start and
+        end of the snake's diagonal, and the start of the box following
+        the snake, each as an (x, y) tuple. """
+
+    width = right - left
+    height = bottom - top
+    delta = width - height
+    odd = delta % 2 != 0
+    limit = (width + height + 1) // 2
+
+    # The furthest reaching x (forward) and y (backward) for each
+    # diagonal. Diagonals range over [-limit - 1, limit + 1], so they're
+    # offset into the lists. The defaults can never satisfy the overlap
+    # checks below.
+    offset = limit + 1
+    forward = [-1] * (2 * offset + 1)
+    backward = [bottom + 1] * (2 * offset + 1)
+    forward[offset + 1] = left
+    backward[offset + 1] = bottom
+
+    for d in range(limit + 1):
+        # Extend the forward d-paths
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                           forward[offset + k - 1] < forward[offset + k + 1]):
+                previous_x = x = forward[offset + k + 1]
+            else:
+                previous_x = forward[offset + k - 1]
+                x = previous_x + 1
+            y = top + (x - left) - k
+            previous_y = y if (d == 0 or x != previous_x) else y - 1
+
+            start_x, start_y = x, y
+            while x < right and y < bottom and \
+                    equal_func(x_sequence[x], y_sequence[y]):
+                x += 1
+                y += 1
+            forward[offset + k] = x
+
+            c = k - delta
+            if odd and -(d - 1) <= c <= d - 1 and \
+                    y >= backward[offset + c]:
+                return ((previous_x, previous_y), (start_x, start_y),
+                        (x, y), (x, y))
+
+        # Extend the backward d-paths
+        for c in range(-d, d + 1, 2):
+            k = c + delta
+            if c == -d or (c != d and backward[offset + c - 1] >
+                           backward[offset + c + 1]):
+                previous_y = y = backward[offset + c + 1]
+            else:
+                previous_y = backward[offset + c - 1]
+                y = previous_y - 1
+            x = left + (y - top) + k
+            previous_x = x if (d == 0 or y != previous_y) else x + 1
+
+            end_x, end_y = x, y
+            while x > left and y > top and \
+                    equal_func(x_sequence[x - 1], y_sequence[y - 1]):
+                x -= 1
+                y -= 1
+            backward[offset + c] = y
+
+            if not odd and -d <= k <= d and x <= forward[offset + k]:
+                return ((x, y), (x, y), (end_x, end_y),
+                        (previous_x, previous_y))
+
+        # If the search is too expensive, split the box at the furthest
+        # point a forward path has reached instead.
+        if max_cost is not None and d >= max_cost:
+            split = None
+            for k in range(-d, d + 1, 2):
+                x = forward[offset + k]
+                y = top + (x - left) - k
+                if left <= x <= right and top <= y <= bottom and \
+                        (split is None or x + y > split[0] + split[1]):
+                    split = (x, y)
+            if split not in (None, (left, top), (right, bottom)):
+                return split, split, split, split
+
+    # The two searches must meet by the time d reaches the limit.
+    raise AssertionError('No middle snake found')
+
+
+def lcs(x_sequence, y_sequence, equal_func, instrument=None):
+    """ Myers's Longest Common Subsequence
+
+        This is the linear space refinement of Myers's O(ND) algorithm,
+        where N is the length of the sequences and D the number of
+        differences between them. Rather than recursing it keeps a stack
+        of the edit graph boxes that remain to be searched, so it works
+        for sequences of any length. equal_func may be any function of
+        an item from each sequence. An optional Instrumentation counts
+        the cells of the edit graph that are visited, that is the calls
+        of equal_func.
+
+        Nearly equal sequences are fast, but dissimilar ones would take
+        time in proportion to N * D. So, as GNU diff does, the search for
+        each box's middle snake gives up past LCS_COST_FACTOR times the
+        square root of the box's size (or LCS_MIN_COST) differences, and
+        the box is split at the furthest point the search reached. The
+        result is then a common subsequence that may not be the longest.
+
+        Returns a list of (x, y) pairs in sequence order. Equal pairs
+        of items at different positions are all kept. """
+
+    x_sequence = list(x_sequence)
+    y_sequence = list(y_sequence)
+
+    if instrument is not None:
+        instrument.count('lcs')
+        cells = [0]
+        uncounted_func = equal_func
+
+        def equal_func(x, y):
+            cells[0] += 1
+            return uncounted_func(x, y)
+
+    pairs = []
+    boxes = [(0, 0, len(x_sequence), len(y_sequence))]
+    while len(boxes) > 0:
+        left, top, right, bottom = boxes.pop()
+
+        # Trim any common prefix and suffix. This is cheap and it's the
+        # entire search when the sequences are nearly the same.
+        while left < right and top < bottom and \
+                equal_func(x_sequence[left], y_sequence[top]):
+            pairs.append((left, top))
+            left += 1
+            top += 1
+        while left < right and top < bottom and \
+                equal_func(x_sequence[right - 1], y_sequence[bottom - 1]):
+            pairs.append((right - 1, bottom - 1))
+            right -= 1
+            bottom -= 1
+
+        # If either side is exhausted there's nothing else in common
+        if left == right or top == bottom:
+            continue
+
+        # Split the box around its middle snake. The snake's diagonal
+        # is common, the boxes on either side of it still need to be
+        # searched.
+        prefix_end, snake_start, snake_end, suffix_start = _middle_snake(
+            x_sequence, y_sequence, left, top, right, bottom, equal_func,
+            max(LCS_MIN_COST,
+                int(LCS_COST_FACTOR * (right - left + bottom - top) ** 0.5)))
+        for i in range(snake_end[0] - snake_start[0]):
+            pairs.append((snake_start[0] + i, snake_start[1] + i))
+        boxes.append((left, top) + prefix_end)
+        boxes.append(suffix_start + (right, bottom))
+
+    if instrument is not None:
+        instrument.count('lcs_cells', cells[0])
+
+    pairs.sort()
+    return [(x_sequence[x], y_sequence[y]) for x, y in pairs]
+
+
+def _hashmatch(context):
+    """ Match every subtree of the left tree that is identical to an
+        unmatched subtree of the right tree. """
+
+    left, right = context.left, context.right
+
+    # Right subtree positions by hash, in document order
+    candidates = {}
+    for j, subtree_hash in enumerate(right.hashes):
+        candidates.setdefault(subtree_hash, []).append(j)
+    for positions in candidates.values():
+        positions.reverse()
+
+    right_taken = [False] * len(right)
+    budget = context.budget
+
+    i = 0
+    while i < len(left):
+        if budget is not None:
+            budget.check()
+        positions = candidates.get(left.hashes[i])
+
+        # Take the first identical right subtree that hasn't had any
+        # part of it matched already. Anything we pass over will never
+        # become available again.
+        j = None
+        while positions:
+            candidate = positions.pop()
+            if not any(right_taken[candidate:right.end[candidate]]):
+                j = candidate
+                break
+
+        if j is None:
+            i += 1
+            continue
+
+        # Identical subtrees have identical shapes, so their nodes pair
+        # up in document order.
+        for offset in range(left.end[i] - i):
+            right_taken[j + offset] = True
+            context.add(i + offset, j + offset)
+
+        # Skip past the subtree we just matched
+        i = left.end[i]
+
+
+def hashmatch(left_root, right_root, threshold=THRESHOLD, instrument=None,
+              budget=None):
+    """ Return a matching of the identical subtrees of the left and
+        right roots. The threshold is ignored, only exact matches are
+        made. An optional Instrumentation times the stages, and an
+        optional Budget limits the time taken (see Budget). """
+
+    matches = MatchSet()
 
-    # NOTE: To support 2.7 we can't use Python3's very nice unpacking
-    # syntax. Leaving it here for future, because the old way is ugly.
-    # x, *x_remaining = x_sequence
-    # y, *y_remaining = y_sequence
-    x, x_remaining = x_sequence[0], x_sequence[1:]
-    y, y_remaining = y_sequence[0], y_sequence[1:]
+    # If their path isn't the same at the root, there are no
+    # matches
+    if getpath(_root(left_root)) != getpath(_root(right_root)):
+        return matches
 
-    if equal_func(x, y):
-        # If x and y are equal according to the given equal funciton,
-        # return them as common and recurse through the rest
-        sequence = set([(x, y), ])
-        sequence.update(lcs(x_remaining, y_remaining, equal_func))
-        return sequence
+    context = MatchContext(left_root, right_root, matches, instrument,
+                           budget)
+    _budgeted(context, lambda: None)
+    return matches
 
-    else:
-        # Otherwise return the largest of the matches of either the
-        # remainder or xs with ys or the remainder of ys with xs
-        return max(lcs(x_sequence, y_remaining, equal_func),
-                   lcs(x_remaining, y_sequence, equal_func),
-                   key=len)
 
+def _positionmatch(context):
+    """ Match the unmatched nodes by id, and the unmatched nodes beneath
+        matched parents by their position among their siblings with the
+        same tag. No nodes are compared, so this is the cheapest
+        matching there is. """
+
+    left, right = context.left, context.right
+    left_partner, right_partner = context.left_partner, context.right_partner
+
+    # The unmatched right nodes by tag and id, and the unmatched
+    # children of each right node by tag, last first
+    right_ids = {}
+    right_children = {}
+    for j in range(len(right)):
+        if right_partner[j] >= 0:
+            continue
+        if right.ids[j] is not None:
+            right_ids.setdefault((right.tags[j], right.ids[j]), j)
+        right_children.setdefault((right.parent[j], right.tags[j]),
+                                  []).append(j)
+    for siblings in right_children.values():
+        siblings.reverse()
+
+    # Going in document order, every node's parent has had its chance
+    # to be matched before the node.
+    for i in range(len(left)):
+        if left_partner[i] >= 0:
+            continue
+
+        tag = left.tags[i]
+        node_id = left.ids[i]
+        if node_id is not None:
+            j = right_ids.get((tag, node_id))
+            if j is not None and right_partner[j] < 0:
+                context.add(i, j)
+                continue
+
+        parent = left.parent[i]
+        right_parent = left_partner[parent] if parent >= 0 else -1
+        if parent >= 0 and right_parent < 0:
+            continue
+        siblings = right_children.get((right_parent, tag))
+        while siblings:
+            j = siblings.pop()
+            if right_partner[j] < 0:
+                context.add(i, j)
+                break
+
+
+def _budgeted(context, match):
+    """ Match identical subtrees and then call the given function to
+        match the rest, falling back on cheaper matching if the context's
+        budget runs out (see Budget). """
+
+    instrument, budget = context.instrument, context.budget
+    try:
+        with _stage(instrument, 'hashmatch'):
+            _hashmatch(context)
+    except BudgetExceeded:
+        budget.fallback = 'position'
+        with _stage(instrument, 'position'):
+            _positionmatch(context)
+        return
+
+    try:
+        match()
+    except BudgetExceeded:
+        budget.fallback = 'hashmatch'
+
+
+def _bucketmatch(context, left_positions, right_positions, threshold,
+                 stage=None):
+    """ Match the nodes at the given left positions against those at the
+        given right positions, in order, making at most one match for
+        each node. Progress is reported as the given stage. """
+
+    left, right = context.left, context.right
+    left_partner, right_partner = context.left_partner, context.right_partner
+    instrument = context.instrument
+
+    # Bucket the unmatched right nodes by tag, and by tag and id.
+    # equal_match never matches nodes with different tags and always
+    # matches nodes with the same id, so we only need to look in the
+    # buckets.
+    right_tags = {}
+    right_ids = {}
+    for j in right_positions:
+        if right_partner[j] >= 0:
+            continue
+        tag = right.tags[j]
+        right_tags.setdefault(tag, []).append(j)
+        node_id = right.ids[j]
+        if node_id is not None:
+            right_ids.setdefault((tag, node_id), j)
+
+    for done, i in enumerate(left_positions):
+        if instrument is not None:
+            instrument.progress(stage, done, len(left_positions))
+
+        # Each node is matched at most once
+        if left_partner[i] >= 0:
+            continue
+
+        tag = left.tags[i]
+        node_id = left.ids[i]
+        if node_id is not None:
+            j = right_ids.get((tag, node_id))
+            if j is not None and right_partner[j] < 0:
+                context.add(i, j)
+                right_tags[tag].remove(j)
+                continue
+
+        bucket = right_tags.get(tag, [])
+        for k, j in enumerate(bucket):
+            if _equal_match(context, i, j, threshold):
+                context.add(i, j)
+                del bucket[k]
+                break
 
-def simplematch(left_root, right_root, threshold=THRESHOLD):
+    if instrument is not None:
+        instrument.progress(stage, len(left_positions), len(left_positions))
+
+
+def simplematch(left_root, right_root, threshold=THRESHOLD,
+                instrument=None, budget=None):
     """ Return a matching of left and right nodes. This is based on the
-        simple matching algorithm. """
+        simple matching algorithm. An optional Instrumentation times the
+        stages and counts the comparisons made, and an optional Budget
+        limits them (see Budget). """
 
-    matches = OrderedSet()
+    matches = MatchSet()
 
     # If their path isn't the same at the root, there are no
     # matches
-    if getpath(left_root) != getpath(right_root):
+    if getpath(_root(left_root)) != getpath(_root(right_root)):
         return matches
 
-    # Get leaf nodes in the left root
-    left_leaves = left_root.xpath('//*[not(child::*)]')
-    right_leaves = right_root.xpath('//*[not(child::*)]')
+    context = MatchContext(left_root, right_root, matches, instrument,
+                           budget)
+    _budgeted(context, lambda: _simplematch(context, threshold,
+                                            hashed=True))
+    return matches
 
-    while len(left_leaves) > 0 and len(right_leaves) > 0:
-        for left_node in left_leaves:
-            for right_node in right_leaves:
-                if equal_match(left_node, right_node, threshold=threshold):
-                    matches.add(Match(left_node, right_node))
 
-        # Parent nodes of previous nodes
-        left_leaves = [n.getparent() for n in left_leaves
-                       if n.getparent() is not None]
-        right_leaves = [n.getparent() for n in right_leaves
-                        if n.getparent() is not None]
+def _simplematch(context, threshold, hashed=False):
+    """ simplematch() for the trees of the given context, whose
+        identical subtrees may have been matched already. """
 
-    return matches
+    left, right = context.left, context.right
+    instrument = context.instrument
+
+    # Start by matching identical subtrees. Matched nodes aren't
+    # compared again below.
+    if not hashed:
+        with _stage(instrument, 'hashmatch'):
+            _hashmatch(context)
 
+    # Match the leaves first
+    with _stage(instrument, 'leaves'):
+        _bucketmatch(context, left.leaves, right.leaves, threshold,
+                     'leaves')
 
-def fastmatch(left_root, right_root, threshold=THRESHOLD):
+    # Then the internal nodes. Going in postorder means that every
+    # node we visit has had its descendents visited first.
+    with _stage(instrument, 'branches'):
+        _bucketmatch(context, left.branches, right.branches, threshold,
+                     'branches')
+
+
+def fastmatch(left_root, right_root, threshold=THRESHOLD, instrument=None,
+              budget=None):
     """ Return a minimum-cost matching of left and right roots. Based on
-        the fast match algorithm. """
+        the fast match algorithm. An optional Instrumentation times the
+        stages and counts the comparisons made, and an optional Budget
+        limits them (see Budget). """
 
-    matches = OrderedSet()
+    matches = MatchSet()
 
     # If their path isn't the same at the root, there are no
     # matches
-    if getpath(left_root) != getpath(right_root):
+    if getpath(_root(left_root)) != getpath(_root(right_root)):
         return matches
 
-    # Get leaf nodes in the left root
-    left_leaves = left_root.xpath('//*[not(child::*)]')
+    # Start by matching identical subtrees. Those nodes are left out
+    # of the chains below.
+    context = MatchContext(left_root, right_root, matches, instrument,
+                           budget)
+    _budgeted(context, lambda: _fastmatch(context, threshold))
+    return matches
 
-    # Get a list of all nodes
-    left_nodes = left_root.xpath('//*')
-    right_nodes = right_root.xpath('//*')
 
-    # Get leaf node tags in the left root. We'll proceed from the
-    # bottom of the root by tags, finding parent tags as we go up.
-    tag_nodes = left_leaves
-    tags = OrderedSet((n.tag for n in tag_nodes))
-    while len(tags) > 0:
-        for tag in tags:
-            # Get a chain of nodes from each side with the given tag
-            left_chain = OrderedSet((n for n in left_nodes if n.tag == tag))
-            right_chain = OrderedSet((n for n in right_nodes if n.tag == tag))
+def _fastmatch(context, threshold):
+    """ fastmatch() for the trees of the given context, whose identical
+        subtrees have been matched already. """
 
-            longest_common = lcs(left_chain, right_chain, equal_match)
-            matches.update((Match(l, r) for l, r in longest_common))
+    left, right = context.left, context.right
+    instrument = context.instrument
 
-        tag_nodes = [n.getparent() for n in tag_nodes if
-                     n.getparent() is not None]
-        tags = OrderedSet((n.tag for n in tag_nodes))
+    # We'll proceed from the bottom of the tree by tags, leaf tags
+    # first and then the tags of internal nodes in the order they
+    # appear going up the tree.
+    tags = OrderedSet(left.tags[i] for i in left.leaves)
+    tags.update(left.tags[i] for i in left.branches)
 
-    return matches
+    with _stage(instrument, 'chains'):
+        for done, tag in enumerate(tags):
+            if instrument is not None:
+                instrument.progress('chains', done, len(tags))
+
+            # Get a chain of the unmatched nodes from each side with the
+            # given tag
+            left_chain = [i for i in left.chain(tag)
+                          if context.left_partner[i] < 0]
+            right_chain = [j for j in right.chain(tag)
+                           if context.right_partner[j] < 0]
+
+            longest_common = lcs(
+                left_chain, right_chain,
+                lambda i, j: _equal_match(context, i, j, threshold),
+                instrument)
+            for i, j in longest_common:
+                context.add(i, j)
+
+        if instrument is not None:
+            instrument.progress('chains', len(tags), len(tags))
+
+
+# A key that's an attribute name, optionally with an @, rather than XPath
+_ATTRIBUTE_KEY = re.compile(r'^@?(\{[^}]*\})?[\w.-]+$')
+
+
+class KeyMatch(object):
+    """
+    A match function for documents whose elements have stable keys, for
+    elements of the tags given. keys maps each tag (in Clark notation if
+    it's namespaced, or '*' for any other tag) to its key: the name of
+    an attribute, with or without an @, an XPath expression evaluated
+    on the element, or a tuple of these.
+
+        >>> match = KeyMatch({'section': 'label', 'p': '@name',
+        ...                   'appendix': 'string(title/@number)'})
+        >>> script = diff(left_root, right_root, match=match)
+
+    Identical subtrees are matched first, as they are by the other match
+    functions. Then elements whose key appears exactly once on each side
+    are matched through dict lookups, without any comparisons. Keys are
+    decisive, so elements with a unique key that doesn't appear on the
+    other side at all aren't matched. The rest, elements without a key
+    or with one that appears more than once on either side, are matched
+    as simplematch() matches them.
+
+    A KeyMatch takes an Instrumentation and a Budget like the other
+    match functions do, and can be used with a DiffCache.
+    """
+
+    def __init__(self, keys):
+        self.keys = dict(keys)
+        self.__name__ = 'KeyMatch(%s)' % ', '.join(
+            '%s=%r' % item for item in sorted(self.keys.items()))
+        self.functions = dict((tag, self._key_function(key))
+                              for tag, key in self.keys.items())
+
+    def __reduce__(self):
+        # The key functions can't be pickled, so a KeyMatch is pickled
+        # as its keys and makes them again, for worker processes.
+        return (KeyMatch, (self.keys,))
+
+    def _key_function(self, key):
+        """ Return a function of an element that returns its key, or
+            None if it doesn't have one, for the given key. """
+        if isinstance(key, (tuple, list)):
+            functions = [self._key_function(k) for k in key]
+
+            def composite_key(node, instrument):
+                values = tuple(f(node, instrument) for f in functions)
+                return None if None in values else values
+            return composite_key
+
+        if _ATTRIBUTE_KEY.match(key):
+            name = key.lstrip('@')
+            return lambda node, instrument: node.get(name)
+
+        xpath = etree.XPath(key)
+
+        def xpath_key(node, instrument):
+            if instrument is not None:
+                instrument.count('xpath')
+            return _key_value(xpath(node))
+        return xpath_key
+
+    def _keyed(self, context, index, partner):
+        """ Return the unmatched positions in the given index of the
+            context by their keys, and the set of every key seen.
+            Positions whose keys appear more than once are left out of
+            the first. """
+        symbols = dict((index.symbols[tag], function)
+                       for tag, function in self.functions.items()
+                       if tag in index.symbols)
+        default = self.functions.get('*')
+
+        keyed = {}
+        repeated = set()
+        for i, node in enumerate(index.nodes):
+            if partner[i] >= 0:
+                continue
+            function = symbols.get(index.tags[i], default)
+            if function is None:
+                continue
+            value = function(node, context.instrument)
+            if value is None:
+                continue
+            key = (index.tags[i], value)
+            if key in keyed:
+                repeated.add(key)
+            keyed[key] = i
+        seen = set(keyed)
+        for key in repeated:
+            del keyed[key]
+        return keyed, seen
+
+    def _match(self, context, threshold):
+        """ Match the keyed elements of the context's trees, then the
+            rest. Identical subtrees have been matched already. """
+
+        left, right = context.left, context.right
+        instrument = context.instrument
+
+        with _stage(instrument, 'keys'):
+            left_keyed, left_seen = self._keyed(context, left,
+                                                context.left_partner)
+            right_keyed, right_seen = self._keyed(context, right,
+                                                  context.right_partner)
+            hashed = len(context.matches)
+            for key, i in sorted(left_keyed.items(),
+                                 key=lambda item: item[1]):
+                j = right_keyed.get(key)
+                if j is not None:
+                    context.add(i, j)
+            if instrument is not None:
+                instrument.count('keyed', len(context.matches) - hashed)
+
+        # Keys are decisive, so elements whose keys don't appear on the
+        # other side are left out of the fuzzy matching. Those whose keys
+        # are repeated on the other side may still match one of them.
+        left_unpartnered = set(i for key, i in left_keyed.items()
+                               if key not in right_seen)
+        right_unpartnered = set(j for key, j in right_keyed.items()
+                                if key not in left_seen)
+
+        for stage in ('leaves', 'branches'):
+            with _stage(instrument, stage):
+                _bucketmatch(
+                    context,
+                    [i for i in getattr(left, stage)
+                     if i not in left_unpartnered],
+                    [j for j in getattr(right, stage)
+                     if j not in right_unpartnered],
+                    threshold, stage)
+
+    def __call__(self, left_root, right_root, threshold=THRESHOLD,
+                 instrument=None, budget=None):
+        """ Return a matching of the left and right roots. """
+
+        matches = MatchSet()
+
+        # If their path isn't the same at the root, there are no
+        # matches
+        if getpath(_root(left_root)) != getpath(_root(right_root)):
+            return matches
+
+        context = MatchContext(left_root, right_root, matches, instrument,
+                               budget)
+        _budgeted(context, lambda: self._match(context, threshold))
+        return matches
+
+
+def _key_value(result):
+    """ Return the key for the result of an XPath key expression, or None
+        if it's empty. """
+    if isinstance(result, list):
+        if len(result) == 0:
+            return None
+        return tuple(item.text if is_element(item) else '%s' % item
+                     for item in result)
+    if isinstance(result, bool):
+        return result
+    # An empty string, or NaN from number()
+    if result == '' or result != result:
+        return None
+    return result
 
 
 # Find a partner for a given node in the matches set
 def matching_partner(matches, node):
     """ Given a set of Match objects, find a Match that contains the
         given node, and return its partner. """
+    # A MatchSet can look the partner up directly
+    if isinstance(matches, MatchSet):
+        return matches.partner(node)
+
     try:
         match, = (m for m in matches if node in m)
     except ValueError:
@@ -302,214 +1237,657 @@ def matching_partner(matches, node):
     return partner
 
 
-def editscript(left_root, right_root, matches):
+def _element_children(node):
+    """ Return the element children of the given node, leaving out any
+        comments or processing instructions. """
+    return [child for child in node if is_element(child)]
+
+
+def _identical(left_node, right_node, partners):
+    """ Return True if the descendents of the two nodes are identical,
+        and each left descendent's partner is its right counterpart. """
+
+    if len(left_node) != len(right_node):
+        return False
+
+    for left_child, right_child in zip(left_node.iterdescendants(),
+                                       right_node.iterdescendants()):
+        if left_child.tag != right_child.tag or \
+                left_child.text != right_child.text or \
+                left_child.tail != right_child.tail or \
+                len(left_child) != len(right_child):
+            return False
+        if is_element(left_child) and (
+                partners.get(left_child) is not right_child or
+                left_child.attrib != right_child.attrib):
+            return False
+
+    return True
+
+
+def _tostring(node):
+    """ Return the given node serialized for an INSERT, without its
+        tail. Elements of mapped documents (see the mapped module) are
+        sliced from their files instead. """
+    if hasattr(node, 'source'):
+        return node.source()
+    return etree.tostring(node, with_tail=False)
+
+
+def _find_position(working, partner, in_order, right_node):
+    """ Return the index at which the partner of the given right node
+        should be placed in its left parent: just after the partner of
+        the nearest sibling to its left that is already in order. This
+        is FindPos from the Chawathe paper. """
+
+    sibling = right_node.getprevious()
+    while sibling is not None:
+        if sibling in in_order:
+            return working.index(partner(sibling)) + 1
+        sibling = sibling.getprevious()
+    return 0
+
+
+def _align_children(working, partner, in_order, left_node, right_node,
+                    instrument=None):
+    """ Move the children of left_node whose partners are children of
+        right_node, so that they're in the same order, yielding the
+        MOVE actions. The longest common subsequence of them is already
+        in order and stays put. This is AlignChildren from the Chawathe
+        paper. """
+
+    left_children = [n for n in working.children(left_node)
+                     if n.is_element and n.partner is not None and
+                     n.partner.getparent() is right_node]
+    right_children = [n for n in _element_children(right_node)
+                      if partner(n) is not None and
+                      partner(n).parent is left_node]
+
+    common_sequence = lcs(left_children, right_children,
+                          lambda l, r: l.partner is r, instrument)
+    for left_child, right_child in common_sequence:
+        in_order.add(left_child)
+        in_order.add(right_child)
+
+    # Go in right order so that every node's left siblings have been
+    # put in order before we need to find its position.
+    for right_child in right_children:
+        if right_child in in_order:
+            continue
+
+        left_child = partner(right_child)
+        index = _find_position(working, partner, in_order, right_child)
+        yield MOVE(working.path(left_child), working.path(left_node), index)
+        working.insert(left_node, index, left_child)
+        in_order.add(left_child)
+        in_order.add(right_child)
+
+
+def editscript(left_root, right_root, matches, instrument=None):
     """
     Return an "edit script", a set of actions that transform the left
     tree into the right tree, for the given pair of trees with the given
     minimum-cost match set.
     """
+    return OrderedSet(iter_editscript(left_root, right_root, matches,
+                                      instrument))
 
-    script = OrderedSet()
 
-    # If the trees don't have the same signature (see function doc for
-    # what that means) We can't transform the left into the right.
-    if getpath(left_root) != getpath(right_root):
-        return script
+def iter_editscript(left_root, right_root, matches, instrument=None):
+    """
+    Yield the actions of the edit script for the given pair of trees and
+    match set (see editscript()) as they're worked out. Inserts, updates
+    and moves come first, visiting the right tree from the root down,
+    followed by the deletes.
+
+    The trees aren't modified. The actions are worked out on a
+    WorkingCopy of the left tree, which only copies the nodes that
+    change. An optional Instrumentation is given the progress through
+    the right tree and counts LCS work.
+    """
 
-    # Add the roots of both if they don't already exist in matches
-    if Match(left_root, right_root) not in matches:
-        matches.add(Match(left_root, right_root))
+    left_root, right_root = _root(left_root), _root(right_root)
 
-    for right_child in right_root.xpath(".//*"):
-        # There's no reason for this not to exist since we're descending
-        # down the tree.
+    # Index the matches so partners can be looked up directly. It's a
+    # new set, because we're going to add to it.
+    matches = MatchSet(matches)
+
+    # If the trees don't have the same signature (see function doc for
+    # what that means) We can't transform the left into the right.
+    if getpath(_root(left_root)) != getpath(_root(right_root)):
+        return
+
+    # The roots are always matched with each other
+    if matches.left.get(left_root) not in (None, right_root) or \
+            matches.right.get(right_root) not in (None, left_root):
+        for match in [m for m in matches
+                      if m.a is left_root or m.b is right_root]:
+            matches.discard(match)
+    matches.add(Match(left_root, right_root))
+    if instrument is not None:
+        instrument.matches(len(matches))
+        visited = 0
+        total = sum(1 for n in right_root.iter(tag=etree.Element))
+
+    working = WorkingCopy(left_root, matches.left)
+
+    # The working copy nodes for right nodes that have been inserted
+    inserted = {}
+
+    def partner(right_node):
+        """ Return the working copy node matched with the right node """
+        node = inserted.get(right_node)
+        if node is None:
+            left_node = matches.right.get(right_node)
+            if left_node is not None:
+                node = working.node(left_node)
+        return node
+
+    # Nodes, left and right, that are known to be in the right place
+    # relative to their siblings.
+    in_order = set([working.root, right_root])
+
+    # Visit the right nodes in document order, so every node's parent
+    # and left siblings are visited before it is.
+    stack = [right_root]
+    while len(stack) > 0:
+        right_child = stack.pop()
         right_parent = right_child.getparent()
+        if instrument is not None:
+            instrument.progress('editscript', visited, total)
+            visited += 1
 
         # See if our right child already has a partner
-        left_child = matching_partner(matches, right_child)
+        left_child = partner(right_child)
 
         # If it does not have a partner, add an INSERT for it
         if left_child is None:
-            # Find the parent's partner, if there is one
-            # Note: this should exist already because we're visiting nodes
-            # from the root down. If it doesn't, something has gone wrong
-            # somewhere.
-            # XXX: We should probably check to make sure it exists.
-            left_parent = matching_partner(matches, right_parent)
-
-            # Get the node's index in its parent
-            index = right_parent.index(right_child)
+            # The parent's partner exists already because we're
+            # visiting nodes from the root down.
+            left_parent = partner(right_parent)
+            index = _find_position(working, partner, in_order, right_child)
+
+            # If nothing beneath the node has a partner we can insert
+            # the whole subtree at once. Otherwise we insert the node by
+            # itself and its children will be inserted or moved into it
+            # as we visit them.
+            whole = not any(n in matches.right for n in
+                            right_child.iterdescendants(tag=etree.Element))
+            if whole:
+                node = right_child
+            else:
+                node = etree.Element(right_child.tag, right_child.attrib,
+                                     nsmap=right_child.nsmap)
+                node.text = right_child.text
 
             # Add the insert for the node to the edit script
-            action = INSERT(etree.tostring(right_child),
-                            getpath(right_parent),
-                            index)
-            script.add(action)
-
-            # Perform the action on our working copy of the left
-            # tree so we'll be able to introspect
-            transform(left_root, set([action, ]))
-
-            # Get the left child so we can use it in alignment later
-            # left_child = etree.fromstring(action.node)
-            left_child = left_root.xpath(getpath(right_child))[0]
-
-            # Add the match to our master set of matching nodes
-            matches.add(Match(left_child, right_child))
-
-        # The right node has a partner already and is not a root node
-        elif right_parent is not None:
-            # This should exist either having been added by a previous
-            # cycle or having already existed
-            left_parent = left_child.getparent()
-
-            # See if the "value" (the text) of the elements differ
-            if right_child.text != left_child.text or \
-                    right_child.tail != left_child.tail or \
-                    right_child.attrib != left_child.attrib:
-
-                # If so, add an update for the node
-                action = UPDATE(getpath(right_child),
-                                right_child.text,
-                                right_child.tail,
-                                frozenset(right_child.attrib.items()))
-                script.add(action)
-
-                # Perform the action on our working copy of the left
-                # tree so we'll be able to introspect
-                transform(left_root, set([action, ]))
-
-            # See if we've got a mis-match between parents or a change
-            # in parental index
-            if (Match(left_parent, right_parent) not in matches) or \
-                    left_parent.index(left_child) != \
-                    right_parent.index(right_child):
-                # Get the left parent's right partner
-                right_parent = matching_partner(matches, left_parent)
-                if right_parent is None:
-                    # The left_parent doesn't have a match (it might be
-                    # deleted). Use what the right_child reports as its
-                    # parent.
-                    # XXX: Can we assume that this will be a valid
-                    # parent here?
-                    right_parent = right_child.getparent()
-
-                # Get the right index
-                index = right_parent.index(right_child)
-
-                # If so, add a move action for the node to the script
-                action = MOVE(getpath(left_child),
-                              getpath(right_parent),
-                              index)
-                script.add(action)
-
-                # Perform the action on our working copy of the left
-                # tree so we'll be able to introspect
-                transform(left_root, set([action, ]))
+            yield INSERT(_tostring(node), working.path(left_parent), index)
+
+            # Perform the action on our working copy of the left tree
+            left_child = working.new_node(right_child, deep=whole)
+            working.insert(left_parent, index, left_child)
+
+            # The node is inserted without its tail, so an update adds
+            # the tail after it
+            if right_child.tail is not None:
+                yield UPDATE(working.path(left_child),
+                             right_child.text,
+                             right_child.tail,
+                             frozenset(right_child.attrib.items()))
+                working.update(left_child, right_child.text,
+                               right_child.tail, right_child.attrib)
+            inserted[right_child] = left_child
+            in_order.add(left_child)
+            in_order.add(right_child)
+
+            # The whole subtree was inserted, there's nothing left to do
+            # for any of it.
+            if not whole:
+                stack.extend(reversed(_element_children(right_child)))
+            elif instrument is not None:
+                visited += sum(1 for n in
+                               right_child.iterdescendants(tag=etree.Element))
+            continue
+
+        # See if the "value" (the text) of the elements differ
+        if right_child.text != left_child.text or \
+                right_child.tail != left_child.tail or \
+                right_child.attrib != left_child.attrib:
+
+            # If so, add an update for the node
+            yield UPDATE(working.path(left_child),
+                         right_child.text,
+                         right_child.tail,
+                         frozenset(right_child.attrib.items()))
+
+            # Perform the action on our working copy of the left tree
+            working.update(left_child, right_child.text, right_child.tail,
+                           right_child.attrib)
+
+        # If the parents aren't partners, move the node to its right
+        # parent's partner.
+        if right_parent is not None:
+            left_parent = partner(right_parent)
+            if left_child.parent is not left_parent:
+                index = _find_position(working, partner, in_order,
+                                       right_child)
+                yield MOVE(working.path(left_child),
+                           working.path(left_parent),
+                           index)
+                working.insert(left_parent, index, left_child)
+                in_order.add(left_child)
+                in_order.add(right_child)
+
+        # If nothing has been done to the left node's subtree yet and
+        # it's the same as the right node's, there's nothing to do for
+        # any of it.
+        if left_child.children is None and \
+                _identical(left_child.element, right_child, matches.left):
+            if instrument is not None:
+                visited += sum(1 for n in
+                               right_child.iterdescendants(tag=etree.Element))
+            continue
 
         # Align the child nodes
-        left_children = left_child.getchildren()
-        right_children = right_child.getchildren()
-
-        # Find all left_child children whose parners are children of
-        # right_child. We'll handle any that aren't in the deletion
-        # phase.
-        left_match_children = [n for n in left_children
-                               if matching_partner(matches, n)
-                               in right_children]
-        common_sequence = lcs(left_child, right_child,
-                              lambda l, r: Match(l, r) in matches)
-
-        for left_child, right_child in \
-                zip(left_match_children, right_children):
-            if (left_child, right_child) in common_sequence:
-                # these are already aligned
-                continue
+        for action in _align_children(working, partner, in_order,
+                                      left_child, right_child, instrument):
+            yield action
 
-            # Get the right index
-            index = right_child.getparent().index(right_child)
+        # Visit the children next, leftmost first
+        stack.extend(reversed(_element_children(right_child)))
 
-            # Add a move action for the node to the script
-            action = MOVE(getpath(left_child), getpath(right_parent), index)
-            script.add(action)
-
-            # Perform the action on our working copy of the left
-            # tree so we'll be able to introspect
-            transform(left_root, set([action, ]))
+    if instrument is not None:
+        instrument.progress('editscript', total, total)
 
     # If there any nodes we've haven't visited in left_tree that we did
     # in right_tree (that don't now have a match in matches), they need
-    # to be deleted.
-    for left_child in reversed(left_root.xpath("//*")):
-        right_child = matching_partner(matches, left_child)
-        if right_child is None:
+    # to be deleted. Only parts of the tree with unmatched nodes in them
+    # need to be looked at.
+    unmatched = set()
+    for left_node in left_root.iter(tag=etree.Element):
+        if left_node not in matches.left:
+            while left_node is not None and left_node not in unmatched:
+                unmatched.add(left_node)
+                left_node = left_node.getparent()
+
+    nodes = []
+    stack = [working.root]
+    while len(stack) > 0:
+        node = stack.pop()
+        nodes.append(node)
+        if node.inserted or \
+                node.children is None and node.element not in unmatched:
+            continue
+        stack.extend(reversed([n for n in working.children(node)
+                               if n.is_element]))
+
+    # Going backwards through document order, children are deleted
+    # before their parents and no two deletes share a path.
+    for left_child in reversed(nodes):
+        if left_child.partner is None:
             # Add a delete action for this node to the script
-            action = DELETE(getpath(left_child))
-            script.add(action)
-
-            # Perform the action on our working copy of the left
-            # tree so we'll be able to introspect
-            transform(left_root, set([action, ]))
-
-    return script
-
-
-def transform(tree, script):
-    """ Transform the tree using the given edit script """
-
-    for action in script:
-        # Perform an insert action. This inserts a node into a given
-        # parent at a given index.
-        if type(action) == INSERT:
-            node = etree.fromstring(action.node)
-            parent = tree.xpath(action.parent)[0]
-            parent.insert(action.index, node)
-
-        # Perform an update action. This updates the text, tail, and
-        # attributes of the given node.
-        if type(action) == UPDATE:
-            node = tree.xpath(action.path)[0]
-            node.text = action.text
-            node.tail = action.tail
-            (node.set(k, v) for k, v in action.attrib)
-
-        # Perform a move action. This moves the given node from its
-        # existing parent to a given index within a new parent.
-        if type(action) == MOVE:
-            node = tree.xpath(action.path)[0]
-            parent = tree.xpath(action.parent)[0]
-
-            # lxml's insert will "move" by default
-            # XXX: What happens to element "tail" text when we move? Is
-            # that something we should be concerned with?
-            parent.insert(action.index, node)
-
-        # Perform a delete action. This removes the given node from its
-        # parent.
-        if type(action) == DELETE:
-            node = tree.xpath(action.path)[0]
-            node.getparent().remove(node)
+            yield DELETE(working.path(left_child))
+            working.remove(left_child)
+
+
+def _transform_insert(paths, action):
+    """ Perform an insert action. This inserts a node into a given
+        parent at a given index. """
+    node = etree.fromstring(action.node)
+    parent = paths.find(action.parent)
+    parent.insert(action.index, node)
+    paths.changed(parent)
+
+
+def _transform_update(paths, action):
+    """ Perform an update action. This updates the text, tail, and
+        attributes of the given node. """
+    node = paths.find(action.path)
+    node.text = action.text
+    node.tail = action.tail
+    node.attrib.clear()
+    for name, value in action.attrib:
+        node.set(name, value)
+
+
+def _transform_move(paths, action):
+    """ Perform a move action. This moves the given node from its
+        existing parent to a given index within a new parent. """
+    node = paths.find(action.path)
+    parent = paths.find(action.parent)
+    paths.changed(node.getparent())
+
+    # lxml's insert will "move" by default
+    # XXX: What happens to element "tail" text when we move? Is
+    # that something we should be concerned with?
+    parent.insert(action.index, node)
+    paths.changed(parent)
+
+
+def _transform_delete(paths, action):
+    """ Perform a delete action. This removes the given node from its
+        parent. """
+    node = paths.find(action.path)
+    parent = node.getparent()
+    parent.remove(node)
+    paths.changed(parent)
+
+
+# The function that performs each type of action
+TRANSFORMS = {
+    INSERT: _transform_insert,
+    UPDATE: _transform_update,
+    MOVE: _transform_move,
+    DELETE: _transform_delete,
+}
+
+
+class _TransformPaths(PathIndex):
+    """ A PathIndex of the tree being transformed that falls back to
+        evaluating any path it can't follow as XPath, counting them in
+        the optional Instrumentation. """
+
+    def __init__(self, tree, instrument=None):
+        self.tree = tree
+        self.instrument = instrument
+        if hasattr(tree, 'getroot'):
+            root = tree.getroot()
+        else:
+            root = tree.getroottree().getroot()
+        super(_TransformPaths, self).__init__(root)
+
+    def find(self, path):
+        node = super(_TransformPaths, self).find(path)
+        if node is None:
+            if self.instrument is not None:
+                self.instrument.count('xpath')
+            node = self.tree.xpath(path)[0]
+        return node
+
+
+def transform(tree, script, instrument=None):
+    """ Transform the tree using the given edit script.
+
+        The actions are applied in order, each to the tree the previous
+        ones left. Their paths are followed down the tree step by step
+        through a PathIndex that's kept up to date as the tree changes,
+        rather than evaluated as XPath over the whole tree. An optional
+        Instrumentation times the transform and counts the paths that
+        have to be evaluated as XPath after all. """
+
+    with _stage(instrument, 'transform'):
+        paths = _TransformPaths(tree, instrument)
+        for action in script:
+            TRANSFORMS[type(action)](paths, action)
 
     return tree
 
 
+def _match(left_tree, right_tree, match, match_threshold, instrument,
+           budget=None):
+    """ Return the match set of the trees made by the match function,
+        which is given the Instrumentation and Budget if there are any.
+        """
+    if instrument is None and budget is None:
+        return match(left_tree, right_tree, threshold=match_threshold)
+
+    keywords = {'threshold': match_threshold}
+    if instrument is not None:
+        keywords['instrument'] = instrument
+    if budget is not None:
+        budget.start()
+        keywords['budget'] = budget
+    with _stage(instrument, 'match'):
+        try:
+            matches = match(left_tree, right_tree, **keywords)
+        except BudgetExceeded:
+            # The match function didn't fall back on anything itself
+            budget.fallback = 'hashmatch'
+            matches = hashmatch(left_tree, right_tree, instrument=instrument)
+    if instrument is not None:
+        instrument.matches(len(matches))
+    return matches
+
+
 def diff(left_tree, right_tree, match=simplematch,
-         match_threshold=THRESHOLD):
+         match_threshold=THRESHOLD, split=None, processes=None,
+         instrument=None, budget=None):
     """ Return difference between the left tree and the right tree as an
         edit script that will transform the left into the right.
 
         Optionally, an element matching function can be provided
         (simplematch and fastmatch are included, simplematch is the
-        default) and a matching threshold. """
-
-    # We're going to need to operate on the left tree, but we want to do
-    # it non-destructively, so we'll make a copy of it.
-    left_tree = deepcopy(left_tree)
+        default) and a matching threshold.
+
+        If split is given, the trees are split into sections at that
+        depth, which must be at least 1, and the sections are diffed in a
+        pool of the given number of processes (see parallel.splitdiff).
+
+        If an Instrumentation is given (see the instrument module) it
+        collects the timings and counters of the diff. It's passed on
+        to the match function as the instrument keyword argument, which
+        match functions of your own need to accept to be used with one.
+        A split diff is only timed as a whole.
+
+        If a Budget is given, matching falls back on cheaper strategies
+        when the budget runs out, and an EditScript is returned whose
+        fallback says which was used (see Budget). A budget can't be
+        used with split. """
+
+    if split is not None:
+        if budget is not None:
+            raise ValueError('A budget can\'t be used with split')
+        # parallel builds on this module, so it's imported when needed
+        from .parallel import splitdiff
+        with _stage(instrument, 'split'):
+            edit_script = splitdiff(_root(left_tree), _root(right_tree),
+                                    match=match,
+                                    match_threshold=match_threshold,
+                                    split=split, processes=processes)
+        _count_actions(instrument, edit_script)
+        return edit_script
 
     # Get the match set
-    matches = match(left_tree, right_tree, threshold=match_threshold)
+    matches = _match(left_tree, right_tree, match, match_threshold,
+                     instrument, budget)
 
     # Get the edit script
-    edit_script = editscript(left_tree, right_tree, matches)
+    with _stage(instrument, 'editscript'):
+        if budget is None:
+            edit_script = editscript(left_tree, right_tree, matches,
+                                     instrument)
+        else:
+            edit_script = EditScript(
+                iter_editscript(left_tree, right_tree, matches, instrument),
+                budget.fallback)
+    _count_actions(instrument, edit_script)
 
     return edit_script
+
+
+def _count_actions(instrument, actions):
+    """ Count the actions of each type, if there's an Instrumentation. """
+    if instrument is None:
+        return
+    for action in actions:
+        instrument.count(type(action).__name__.lower())
+
+
+def iterdiff(left_tree, right_tree, match=simplematch,
+             match_threshold=THRESHOLD, instrument=None, budget=None):
+    """ Yield the actions of the edit script that will transform the left
+        tree into the right tree as they're worked out, rather than
+        returning them all at once like diff(). The trees are matched
+        before the first action is yielded, but nothing more is done
+        than the actions taken, so stopping early is cheap:
+
+            >>> first_ten = list(itertools.islice(iterdiff(left, right), 10))
+            >>> changed = next(iterdiff(left, right), None) is not None
+
+        The trees must not be changed until the generator is done. An
+        optional Instrumentation is used as it is by diff(), except that
+        the time taken by the caller between actions counts towards the
+        'editscript' stage. An optional Budget limits matching as it does
+        for diff(), and its fallback says which fallback was used. """
+
+    matches = _match(left_tree, right_tree, match, match_threshold,
+                     instrument, budget)
+    with _stage(instrument, 'editscript'):
+        for action in iter_editscript(left_tree, right_tree, matches,
+                                      instrument):
+            _count_actions(instrument, (action,))
+            yield action
+
+
+def equal(left_tree, right_tree):
+    """ Return True if the two trees are identical: the same tags, text,
+        tails and attributes, and the same children in the same order,
+        including comments and processing instructions. The trees are
+        walked side by side and the walk stops at the first difference,
+        so this is much cheaper than diff() for telling whether
+        anything changed. """
+
+    left_tree, right_tree = _root(left_tree), _root(right_tree)
+    if left_tree.tail != right_tree.tail:
+        return False
+
+    stack = [(left_tree, right_tree)]
+    while len(stack) > 0:
+        left_node, right_node = stack.pop()
+        if left_node.tag != right_node.tag or \
+                left_node.text != right_node.text or \
+                len(left_node) != len(right_node):
+            return False
+        if is_element(left_node):
+            if left_node.attrib != right_node.attrib:
+                return False
+        elif '%s' % left_node != '%s' % right_node:
+            return False
+
+        children = list(zip(left_node, right_node))
+        for left_child, right_child in children:
+            if left_child.tail != right_child.tail:
+                return False
+        stack.extend(reversed(children))
+
+    return True
+
+
+def changed(left_tree, right_tree):
+    """ Return True if the two trees differ at all (see equal()). """
+    return not equal(left_tree, right_tree)
+
+
+def _children(index):
+    """ Return a dict of the positions of the children of each node in
+        the given TreeIndex, in order. """
+    children = {}
+    for i in range(1, len(index)):
+        children.setdefault(index.parent[i], []).append(i)
+    return children
+
+
+def summary(left_tree, right_tree, match_threshold=THRESHOLD,
+            comparisons=SUMMARY_COMPARISONS, budget=None):
+    """
+    Return a Summary of the differences between the left tree and the
+    right tree: how many nodes an edit script would insert, update, move
+    and delete, and the similarity of the trees, the share of their
+    nodes that are matched with each other, from 0 to 1. As in diff(),
+    an inserted node with a tail is updated too, to add the tail, but
+    the nodes of a subtree that's inserted whole are counted one by
+    one.
+
+    The trees are matched as simplematch() matches them, identical
+    subtrees first, but no edit script is worked out and no nodes are
+    serialized. Nothing is matched at all if the trees are equal.
+
+    The work is bounded: at most the given number of comparisons of
+    nodes are made (None for no limit), or a Budget may be given
+    instead. If it runs out, the nodes that are left are matched by
+    their position among their siblings, as they are when a Budget runs
+    out in diff(), and the Summary is approximate.
+    """
+
+    if getpath(_root(left_tree)) != getpath(_root(right_tree)):
+        raise ValueError('The trees have different roots')
+
+    if equal(left_tree, right_tree):
+        return Summary(0, 0, 0, 0, 1.0)
+
+    if budget is None:
+        budget = Budget(comparisons=comparisons)
+    else:
+        budget.start()
+    # Only the partners of nodes are counted, not the matches
+    context = MatchContext(left_tree, right_tree, _NoMatches(),
+                           budget=budget)
+    _budgeted(context,
+              lambda: _simplematch(context, match_threshold, hashed=True))
+    if budget.fallback == 'hashmatch':
+        # Only the subtrees compared so far are matched, so estimate the
+        # rest
+        _positionmatch(context)
+    left, right = context.left, context.right
+    left_partner, right_partner = context.left_partner, context.right_partner
+
+    # The roots are always matched with each other
+    if left_partner[0] > 0:
+        right_partner[left_partner[0]] = -1
+    if right_partner[0] > 0:
+        left_partner[right_partner[0]] = -1
+    context.add(0, 0)
+
+    # Nodes that have no partner are inserted or deleted. Of the rest,
+    # those whose values differ are updated and those whose parents
+    # aren't partners are moved.
+    inserted = sum(1 for j in range(len(right)) if right_partner[j] < 0)
+    deleted = sum(1 for i in range(len(left)) if left_partner[i] < 0)
+    updated = 0
+    moved = 0
+
+    # A node is inserted without its tail, so one with a tail is updated
+    # after it too, unless it's inside a subtree that's inserted whole
+    # (one with nothing beneath it matched), tails and all.
+    matched_below = [False] * len(right)
+    for j in range(len(right) - 1, 0, -1):
+        if matched_below[j] or right_partner[j] >= 0:
+            matched_below[right.parent[j]] = True
+    for j in range(1, len(right)):
+        if right_partner[j] >= 0 or right.tail[j] is None:
+            continue
+        parent = right.parent[j]
+        if right_partner[parent] >= 0 or matched_below[parent]:
+            updated += 1
+
+    for j in range(len(right)):
+        i = right_partner[j]
+        if i < 0:
+            continue
+        if left.text[i] != right.text[j] or left.tail[i] != right.tail[j] \
+                or left.attrib[i] != right.attrib[j]:
+            updated += 1
+        if j > 0 and left.parent[i] != right_partner[right.parent[j]]:
+            moved += 1
+
+    # Children that stay with the same parent are moved if they're out
+    # of order, leaving the longest common subsequence of them in place.
+    left_children = _children(left)
+    for j, right_children in _children(right).items():
+        i = right_partner[j]
+        if i < 0:
+            continue
+        right_kept = [n for n in right_children
+                      if right_partner[n] >= 0 and
+                      left.parent[right_partner[n]] == i]
+        left_kept = [n for n in left_children.get(i, [])
+                     if left_partner[n] >= 0 and
+                     right.parent[left_partner[n]] == j]
+        common = lcs(left_kept, right_kept,
+                     lambda l, r: left_partner[l] == r)
+        moved += len(right_kept) - len(common)
+
+    matched = len(right) - inserted
+    similarity = 2.0 * matched / (len(left) + len(right))
+    return Summary(inserted, updated, moved, deleted, similarity,
+                   budget.fallback is not None)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of diffs.
+
+An Instrumentation can be given to diff(), iterdiff(), xsldiff(),
+transform() and the match functions to find out where the time of a
+diff goes:
+
+    >>> instrument = Instrumentation()
+    >>> script = diff(left_root, right_root, instrument=instrument)
+    >>> instrument.timings['match'], instrument.counters['compare']
+
+It collects the time spent in each stage, counts of the work done in
+them, and the largest match set made. A progress function, called with
+the stage, the amount of it that's done and its total, reports on long
+diffs as they go. Without an Instrumentation none of this is done.
+"""
+
+from __future__ import unicode_literals
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+try:
+    from time import perf_counter as clock
+except ImportError:  # Python 2
+    from time import time as clock
+
+
+# The least number of seconds between calls of a progress function
+PROGRESS_INTERVAL = 1.0
+
+
+class Instrumentation(object):
+    """
+    The timings and counters of one or more diffs.
+
+    timings holds the seconds spent in each stage, in the order they
+    were first entered. Stages nest: 'match' includes 'index',
+    'hashmatch', 'leaves' and 'branches' (or 'chains' for fastmatch, and
+    'keys' first for a KeyMatch), or 'position' if a Budget ran out.
+    counters holds the number of text comparisons ('compare'), ratios
+    found in the cache ('ratio_cache'), ratios worked out, natively or
+    by difflib ('sequence_matcher'), LCS runs and the cells of their
+    edit graphs visited ('lcs', 'lcs_cells'), nodes matched by key
+    ('keyed'), paths and keys evaluated as XPath ('xpath') and actions
+    of each type ('insert', 'update', 'move', 'delete'). peak_matches is
+    the size of the largest match set.
+
+    If a progress function is given it's called with the stage, the
+    amount done and the total as stages go along, at most every interval
+    seconds and once more when a stage is done.
+    """
+
+    def __init__(self, progress=None, interval=PROGRESS_INTERVAL):
+        self.timings = OrderedDict()
+        self.counters = Counter()
+        self.peak_matches = 0
+        self.callback = progress
+        self.interval = interval
+        self._reported = None
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the stage with the given name. The times of repeated
+            stages add up. """
+        self.timings.setdefault(name, 0.0)
+        start = clock()
+        try:
+            yield
+        finally:
+            self.timings[name] += clock() - start
+
+    def count(self, name, n=1):
+        """ Add n to the given counter. """
+        self.counters[name] += n
+
+    def matches(self, size):
+        """ Note the size of a match set. """
+        if size > self.peak_matches:
+            self.peak_matches = size
+
+    def progress(self, stage, done, total):
+        """ Report that done of the total of the given stage are done. """
+        if self.callback is None:
+            return
+        now = clock()
+        if done < total and self._reported is not None and \
+                now - self._reported < self.interval:
+            return
+        self._reported = now
+        self.callback(stage, done, total)
+
+    def report(self):
+        """ Return the timings, counters and peak match set size as a
+            dict that can be dumped as JSON. """
+        return {'timings': dict(self.timings),
+                'counters': dict(self.counters),
+                'peak_matches': self.peak_matches}
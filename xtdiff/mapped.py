@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped documents.
+
+parse() reads a document from a memory-mapped file into a compact
+structure: a few flat arrays with an entry for each node, holding its
+parent, its place among its siblings and the byte offsets of the node
+and its text and tail in the file. Text is only decoded when it's asked
+for, and the nodes themselves are only created as they're visited.
+
+The nodes answer the parts of lxml's element API that diff() uses, so a
+mapped document can be diffed like a parsed one:
+
+    >>> left = mapped.parse('old.xml')
+    >>> right = mapped.parse('new.xml')
+    >>> actions = xtdiff.diff(left.getroot(), right.getroot())
+
+When a whole subtree is inserted, its INSERT carries the bytes of the
+subtree sliced from the file rather than a re-serialized copy. The
+TreeIndex diff() builds of a mapped document reads texts from the file
+too, and holds little more than a digest for each node.
+
+Parsing takes a small fraction of the file's size, but diffing doesn't:
+matching and building the edit script still keep some state for every
+node, a few hundred bytes each, however the documents were parsed. End
+to end, diffing mapped documents takes about two thirds of the memory
+diffing parsed ones does.
+
+lxml's iterparse() doesn't report where in the file each node is, so
+documents are parsed with expat, and they must be in an encoding that
+is a superset of ASCII, like UTF-8 or Latin-1.
+"""
+
+from __future__ import unicode_literals
+
+import codecs
+import mmap
+import re
+import xml.parsers.expat
+from array import array
+
+from lxml import etree
+
+from .tree import element_step, number_steps, is_element
+
+try:
+    unichr
+except NameError:  # Python 3
+    unichr = chr
+
+try:
+    array('q')
+    _OFFSET = 'q'
+except ValueError:  # Python 2
+    _OFFSET = 'l'
+
+
+# The number of bytes given to the parser at a time
+CHUNK_SIZE = 1 << 20
+
+# What expat names nodes other than elements
+_COMMENT = -1
+_PI = -2
+
+# Predefined entities, and the references and CDATA sections that can
+# appear in raw text
+_ENTITIES = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+_REFERENCE = re.compile(
+    r'<!\[CDATA\[(.*?)\]\]>|&(#x[0-9a-fA-F]+|#[0-9]+|\w+);', re.DOTALL)
+_NEWLINE = re.compile(r'\r\n?')
+
+
+def _unescape(match):
+    if match.group(1) is not None:
+        return match.group(1)
+    name = match.group(2)
+    if name.startswith('#x'):
+        return unichr(int(name[2:], 16))
+    if name.startswith('#'):
+        return unichr(int(name[1:]))
+    return _ENTITIES[name]
+
+
+def _qualify(name):
+    """ Return the tag and prefix for a name expat reports as
+        'uri local prefix', 'uri local' or 'local'. """
+    parts = name.split(' ')
+    if len(parts) == 1:
+        return name, None
+    tag = '{%s}%s' % (parts[0], parts[1])
+    return tag, parts[2] if len(parts) == 3 else None
+
+
+def _quote(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;') \
+                .replace('"', '&quot;')
+
+
+class MappedTree(object):
+    """
+    A document parsed from a memory-mapped file.
+
+    Nodes are numbered in document order, and the arrays are indexed by
+    node number: parent, the number of the node after the node's
+    subtree (after), the node's previous sibling or -1, its number of
+    children (count), its name or _COMMENT or _PI, and the byte offsets
+    where it starts and ends and its text and tail start and end, or -1
+    for text that's None.
+
+    Comments and processing instructions outside the root element are
+    left out.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:2] in (b'\xff\xfe', b'\xfe\xff') or \
+                self.map[:2] == b'\x00<' or self.map[:2] == b'<\x00':
+            self.close()
+            raise ValueError('%s is not in an ASCII-compatible encoding'
+                             % path)
+
+        self.encoding = 'utf-8'
+        self.names = []
+        self.parent = array('i')
+        self.after = array('i')
+        self.previous = array('i')
+        self.count = array('i')
+        self.name = array('i')
+        self.start = array(_OFFSET)
+        self.end = array(_OFFSET)
+        self.spans = {'text': (array(_OFFSET), array(_OFFSET)),
+                      'tail': (array(_OFFSET), array(_OFFSET))}
+        self.attribs = []
+        self.namespaces = {}
+        self.values = {}
+        self.texts = None
+        self.nodes = None
+
+        self._parse()
+        self.nodes = [None] * len(self.parent)
+
+    def _parse(self):
+        parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+        parser.namespace_prefixes = True
+        parser.ordered_attributes = True
+
+        names = {}
+        stack = []
+        last_child = []
+        pending_namespaces = {}
+        # The text being read: which of the node's texts it is and the
+        # node, and whether it has started yet
+        state = {'target': None, 'open': False}
+        empty = ()
+
+        def add(kind, offset):
+            i = len(self.parent)
+            parent = stack[-1] if len(stack) > 0 else -1
+            self.parent.append(parent)
+            self.after.append(i + 1)
+            self.previous.append(last_child[-1] if len(stack) > 0 else -1)
+            self.count.append(0)
+            self.name.append(kind)
+            self.start.append(offset)
+            self.end.append(offset)
+            for starts, ends in self.spans.values():
+                starts.append(-1)
+                ends.append(-1)
+            self.attribs.append(empty)
+            if len(stack) > 0:
+                self.count[parent] += 1
+                last_child[-1] = i
+            return i
+
+        def close(offset):
+            target = state['target']
+            if target is not None and state['open']:
+                kind, i = target
+                self.spans[kind][1][i] = offset
+            state['target'] = None
+            state['open'] = False
+
+        def characters(data):
+            target = state['target']
+            if target is None:
+                return
+            if not state['open']:
+                kind, i = target
+                self.spans[kind][0][i] = parser.CurrentByteIndex
+                state['open'] = True
+            if self.texts is not None:
+                self.texts.setdefault(target, []).append(data)
+
+        def start_cdata():
+            characters('')
+
+        def xml_declaration(version, encoding, standalone):
+            if encoding is not None:
+                self.encoding = encoding
+
+        def entity_declaration(*args):
+            # Text can't be decoded from the file on its own any more,
+            # so it's kept as it's read.
+            self.texts = {}
+
+        def start_namespace(prefix, uri):
+            pending_namespaces[prefix] = uri
+
+        def start_element(name, attrib):
+            offset = parser.CurrentByteIndex
+            close(offset)
+            symbol = names.get(name)
+            if symbol is None:
+                symbol = names[name] = len(self.names)
+                self.names.append(_qualify(name))
+            i = add(symbol, offset)
+            if len(attrib) > 0:
+                self.attribs[i] = tuple(
+                    (_qualify(attrib[k])[0], attrib[k + 1])
+                    for k in range(0, len(attrib), 2))
+            if len(pending_namespaces) > 0:
+                self.namespaces[i] = dict(pending_namespaces)
+                pending_namespaces.clear()
+            stack.append(i)
+            last_child.append(-1)
+            state['target'] = ('text', i)
+
+        def end_element(name):
+            offset = parser.CurrentByteIndex
+            close(offset)
+            i = stack.pop()
+            last_child.pop()
+            # An empty element's end is reported just past its tag. A
+            # start tag can only end in '/>' if it's empty.
+            empty_tag = len(self.parent) == i + 1 and \
+                self.spans['text'][0][i] < 0 and \
+                self.map[offset - 2:offset] == b'/>'
+            if not empty_tag:
+                offset = self.map.find(b'>', offset) + 1
+            self.end[i] = offset
+            self.after[i] = len(self.parent)
+            if len(stack) > 0:
+                state['target'] = ('tail', i)
+
+        def other(kind, value):
+            offset = parser.CurrentByteIndex
+            close(offset)
+            if len(stack) == 0:
+                return
+            i = add(kind, offset)
+            self.values[i] = value
+            state['target'] = ('tail', i)
+
+        parser.XmlDeclHandler = xml_declaration
+        parser.EntityDeclHandler = entity_declaration
+        parser.StartNamespaceDeclHandler = start_namespace
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = characters
+        parser.StartCdataSectionHandler = start_cdata
+        parser.CommentHandler = lambda data: other(_COMMENT, data)
+        parser.ProcessingInstructionHandler = \
+            lambda target, data: other(_PI, (target, data))
+
+        for offset in range(0, len(self.map), CHUNK_SIZE):
+            parser.Parse(self.map[offset:offset + CHUNK_SIZE], False)
+        parser.Parse(b'', True)
+
+        if self.texts is not None:
+            self.texts = dict((target, ''.join(pieces))
+                              for target, pieces in self.texts.items())
+        self.encoding = codecs.lookup(self.encoding).name
+
+    def close(self):
+        """ Unmap the file. The document's nodes can't be used after
+            this. """
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def node(self, i):
+        """ Return the node numbered i. """
+        node = self.nodes[i]
+        if node is None:
+            kind = self.name[i]
+            if kind == _COMMENT:
+                node = MappedComment(self, i)
+            elif kind == _PI:
+                node = MappedPI(self, i)
+            else:
+                node = MappedElement(self, i)
+            self.nodes[i] = node
+        return node
+
+    def getroot(self):
+        return self.node(0)
+
+    def getpath(self, node):
+        """ Return the XPath for the given element, as lxml's getpath()
+            would. """
+        steps = []
+        while node.getparent() is not None:
+            siblings = [n for n in node.getparent() if is_element(n)]
+            numbered = number_steps([element_step(n) for n in siblings])
+            steps.append(numbered[siblings.index(node)])
+            node = node.getparent()
+        steps.append(element_step(node))
+        return '/' + '/'.join(reversed(steps))
+
+    def text(self, kind, i):
+        """ Return the text or tail of the node numbered i. """
+        if self.texts is not None:
+            return self.texts.get((kind, i))
+        starts, ends = self.spans[kind]
+        start = starts[i]
+        if start < 0:
+            return None
+        text = self.map[start:ends[i]].decode(self.encoding)
+        if '\r' in text:
+            text = _NEWLINE.sub('\n', text)
+        if '&' in text or '<' in text:
+            text = _REFERENCE.sub(_unescape, text)
+        return text
+
+    def columns(self, nodes):
+        """ Return the positions, texts and tails of the given nodes, for
+            a TreeIndex of them. Texts and tails are decoded as they're
+            read, and positions are kept in an array, so the index holds
+            next to nothing for each node beyond its digest. """
+        numbers = array('i', (node.i for node in nodes))
+        return (_Positions(self, numbers), _Column(self, 'text', numbers),
+                _Column(self, 'tail', numbers))
+
+    def source(self, i):
+        """ Return the element numbered i as UTF-8 bytes that can be
+            parsed on their own. """
+        if self.texts is not None:
+            # The bytes may refer to entities declared in the document
+            return etree.tostring(_copy(self.node(i)), encoding='utf-8')
+
+        data = self.map[self.start[i]:self.end[i]]
+        if self.encoding not in ('utf-8', 'ascii'):
+            data = data.decode(self.encoding).encode('utf-8')
+
+        # Declare the namespaces it inherits
+        declarations = self._declarations(i)
+        if len(declarations) > 0:
+            name = re.match(br'<[^\s/>]+', data).end()
+            data = data[:name] + declarations + data[name:]
+        return data
+
+    def hash_source(self, i, hasher):
+        """ Update the given hash with the element numbered i as it is in
+            the file, along with the file's encoding and the namespaces
+            the element inherits, without copying it from the map. """
+        if self.texts is not None:
+            hasher.update(self.source(i))
+            return
+
+        hasher.update(self.encoding.encode('ascii'))
+        hasher.update(b'\0')
+        hasher.update(self._declarations(i))
+        hasher.update(b'\0')
+        view = memoryview(self.map)
+        try:
+            hasher.update(view[self.start[i]:self.end[i]])
+        finally:
+            if hasattr(view, 'release'):
+                view.release()
+
+    def _declarations(self, i):
+        """ Return the declarations, as UTF-8 bytes, of the namespaces the
+            element numbered i inherits. """
+        declared = self.namespaces.get(i, {})
+        inherited = dict((prefix, uri) for prefix, uri
+                         in self.node(i).nsmap.items()
+                         if prefix not in declared)
+        return ''.join(
+            ' xmlns%s="%s"' % ('' if prefix is None else ':' + prefix,
+                               _quote(uri))
+            for prefix, uri in sorted(inherited.items(),
+                                      key=lambda item: item[0] or '')
+        ).encode('utf-8')
+
+
+class _Positions(object):
+    """ The positions of nodes of a MappedTree in a list of them, looked
+        up by node like a dict. """
+
+    __slots__ = ('tree', 'positions')
+
+    def __init__(self, tree, numbers):
+        self.tree = tree
+        self.positions = array('i', [-1]) * len(tree.parent)
+        for position, number in enumerate(numbers):
+            self.positions[number] = position
+
+    def __getitem__(self, node):
+        position = -1
+        if getattr(node, 'tree', None) is self.tree:
+            position = self.positions[node.i]
+        if position < 0:
+            raise KeyError(node)
+        return position
+
+    def __contains__(self, node):
+        try:
+            self[node]
+        except KeyError:
+            return False
+        return True
+
+
+class _Column(object):
+    """ The text or tail of each of a list of nodes of a MappedTree,
+        decoded as it's read. """
+
+    __slots__ = ('tree', 'kind', 'numbers')
+
+    def __init__(self, tree, kind, numbers):
+        self.tree = tree
+        self.kind = kind
+        self.numbers = numbers
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, i):
+        return self.tree.text(self.kind, self.numbers[i])
+
+
+def _copy(node):
+    """ Return an lxml copy of the given mapped element. """
+    element = etree.Element(node.tag, node.attrib, nsmap=node.nsmap)
+    element.text = node.text
+    for child in node:
+        if is_element(child):
+            child_copy = _copy(child)
+        elif child.tag is etree.Comment:
+            child_copy = etree.Comment(child.text)
+        else:
+            child_copy = etree.PI(child.target, child.text)
+        child_copy.tail = child.tail
+        element.append(child_copy)
+    return element
+
+
+class MappedNode(object):
+    """ A node of a MappedTree. Like lxml, every node has a tag, text
+        and a tail, and can be iterated over for its children. """
+
+    __slots__ = ('tree', 'i')
+
+    def __init__(self, tree, i):
+        self.tree = tree
+        self.i = i
+
+    @property
+    def text(self):
+        return self.tree.text('text', self.i)
+
+    @property
+    def tail(self):
+        return self.tree.text('tail', self.i)
+
+    @property
+    def attrib(self):
+        return dict(self.tree.attribs[self.i])
+
+    def get(self, key, default=None):
+        for name, value in self.tree.attribs[self.i]:
+            if name == key:
+                return value
+        return default
+
+    def items(self):
+        return list(self.tree.attribs[self.i])
+
+    def __len__(self):
+        return self.tree.count[self.i]
+
+    def __iter__(self):
+        tree = self.tree
+        after = tree.after[self.i]
+        child = self.i + 1
+        while child < after:
+            yield tree.node(child)
+            child = tree.after[child]
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def getparent(self):
+        parent = self.tree.parent[self.i]
+        return self.tree.node(parent) if parent >= 0 else None
+
+    def getprevious(self):
+        previous = self.tree.previous[self.i]
+        return self.tree.node(previous) if previous >= 0 else None
+
+    def getnext(self):
+        parent = self.tree.parent[self.i]
+        after = self.tree.after[self.i]
+        if parent < 0 or after >= self.tree.after[parent]:
+            return None
+        return self.tree.node(after)
+
+    def getroottree(self):
+        return self.tree
+
+    def iter(self, tag=None):
+        """ Iterate over the node and its descendents in document order,
+            keeping those with the given tag, which may be etree.Element
+            for any element. """
+        return self._select(tag, self.i)
+
+    def iterdescendants(self, tag=None):
+        return self._select(tag, self.i + 1)
+
+    def _select(self, tag, start):
+        tree = self.tree
+        for i in range(start, tree.after[self.i]):
+            node = tree.node(i)
+            if tag is None or node.tag == tag or \
+                    tag is etree.Element and tree.name[i] >= 0:
+                yield node
+
+
+class MappedElement(MappedNode):
+    """ An element of a MappedTree. """
+
+    __slots__ = ()
+
+    @property
+    def tag(self):
+        return self.tree.names[self.tree.name[self.i]][0]
+
+    @property
+    def prefix(self):
+        return self.tree.names[self.tree.name[self.i]][1]
+
+    @property
+    def nsmap(self):
+        nsmap = {}
+        i = self.i
+        while i >= 0:
+            for prefix, uri in self.tree.namespaces.get(i, {}).items():
+                nsmap.setdefault(prefix, uri)
+            i = self.tree.parent[i]
+        return nsmap
+
+    def source(self):
+        """ Return the element, without its tail, as UTF-8 bytes sliced
+            from the file. """
+        return self.tree.source(self.i)
+
+    def hash_source(self, hasher):
+        """ Update the given hash with the element, without its tail, as
+            it is in the file. """
+        self.tree.hash_source(self.i, hasher)
+
+    def __repr__(self):
+        return '<MappedElement %s at %d>' % (self.tag, self.i)
+
+
+class MappedComment(MappedNode):
+    """ A comment in a MappedTree. """
+
+    __slots__ = ()
+
+    tag = staticmethod(etree.Comment)
+    prefix = None
+
+    @property
+    def text(self):
+        return self.tree.values[self.i]
+
+    def __str__(self):
+        return '<!--%s-->' % self.text
+
+
+class MappedPI(MappedNode):
+    """ A processing instruction in a MappedTree. """
+
+    __slots__ = ()
+
+    tag = staticmethod(etree.PI)
+    prefix = None
+
+    @property
+    def target(self):
+        return self.tree.values[self.i][0]
+
+    @property
+    def text(self):
+        return self.tree.values[self.i][1] or None
+
+    def __str__(self):
+        if self.text is None:
+            return '<?%s?>' % self.target
+        return '<?%s %s?>' % (self.target, self.text)
+
+
+def parse(path):
+    """ Return a MappedTree of the document in the file at the given
+        path. """
+    return MappedTree(path)
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Diffing many pairs of documents at once.
+
+diff() runs in a single process. diff_many() spreads a batch of document
+pairs over a pool of worker processes. lxml elements can't be pickled, so
+documents are sent to the workers as paths or serialized XML and parsed
+there. Edit scripts come back in the compact binary form of the
+serialize module.
+"""
+
+from __future__ import unicode_literals
+
+import codecs
+import hashlib
+from copy import deepcopy
+from multiprocessing import Pool
+
+from lxml import etree
+
+from .diff import INSERT, UPDATE, MOVE, THRESHOLD, Match
+from .diff import OrderedSet, MatchSet, simplematch, diff, editscript
+from .diff import getpath, lcs
+from .serialize import dumps, loads
+from .tree import element_step, is_element
+
+
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
+
+# Stands in for a tail that should be left as it is
+_KEEP = object()
+
+# The byte order marks XML as bytes may start with, and their encodings
+_BOMS = ((codecs.BOM_UTF8, 'utf-8'),
+         (codecs.BOM_UTF16_LE, 'utf-16-le'),
+         (codecs.BOM_UTF16_BE, 'utf-16-be'))
+
+
+def _source(document):
+    """ Return something that can be sent to a worker process for the
+        given document, which may be a path, XML as a string or bytes,
+        an element or an element tree. """
+    if hasattr(document, 'getroot'):
+        return etree.tostring(document.getroot())
+    if etree.iselement(document):
+        return etree.tostring(document)
+    return document
+
+
+def _is_document(source):
+    """ Return True if the given string or bytes hold XML rather than a
+        path: if the first character that isn't whitespace, after any
+        byte order mark, is '<'. """
+    if isinstance(source, bytes):
+        for bom, encoding in _BOMS:
+            if source.startswith(bom):
+                source = source[len(bom):].decode(encoding, 'replace')
+                break
+    else:
+        source = source.lstrip('\ufeff')
+    return source.lstrip()[:1] in ('<', b'<')
+
+
+def _parse(source):
+    """ Return the root element for something returned by _source(). """
+    if isinstance(source, (bytes, text_type)):
+        if not _is_document(source):
+            return etree.parse(source).getroot()
+        if isinstance(source, bytes):
+            return etree.fromstring(source)
+        # lxml won't parse a string with an encoding declaration, so
+        # it's parsed as UTF-8, whatever the declaration says
+        return etree.fromstring(source.encode('utf-8'),
+                                etree.XMLParser(encoding='utf-8'))
+    if not hasattr(source, '__fspath__'):
+        raise TypeError('Expected a path or XML, not %r' % (source,))
+    return etree.parse(source).getroot()
+
+
+def _diff_pair(job):
+    """ Diff a single pair in a worker process. """
+    index, left, right, match, match_threshold = job
+    script = diff(_parse(left), _parse(right), match=match,
+                  match_threshold=match_threshold)
+    return index, dumps(script)
+
+
+def diff_many(pairs, processes=None, chunksize=1, ordered=True,
+              match=simplematch, match_threshold=THRESHOLD):
+    """
+    Diff each of the given (left, right) pairs of documents, yielding an
+    (index, edit script) tuple for each pair.
+
+    Documents may be paths, XML as strings or bytes, elements or element
+    trees. A string or bytes whose first character other than whitespace,
+    after any byte order mark, is '<' is XML, otherwise it's a path. The
+    pairs are spread over a pool of the given number of processes (by
+    default one for each CPU), chunksize pairs at a time. If ordered is
+    True the results are yielded in the order of the pairs, otherwise as
+    they're finished. With a single process the pairs are diffed in
+    this one.
+
+    The match function must be one a worker process can import, like
+    simplematch or fastmatch, or a KeyMatch.
+    """
+
+    jobs = ((index, _source(left), _source(right), match, match_threshold)
+            for index, (left, right) in enumerate(pairs))
+
+    if processes == 1:
+        for job in jobs:
+            index, data = _diff_pair(job)
+            yield index, loads(data)
+        return
+
+    pool = Pool(processes)
+    try:
+        if ordered:
+            results = pool.imap(_diff_pair, jobs, chunksize)
+        else:
+            results = pool.imap_unordered(_diff_pair, jobs, chunksize)
+        for index, data in results:
+            yield index, loads(data)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _serialize(node):
+    """ Return the given element as bytes to send to a worker. """
+    return etree.tostring(node, with_tail=False)
+
+
+def _align(left_node, right_node):
+    """ Return pairs of the element children of the given nodes that
+        should be diffed with each other: those with the same tag and
+        id, then those that are identical, then those that are in the
+        same order with the same tag. """
+
+    left_children = [n for n in left_node if is_element(n)]
+    right_children = [n for n in right_node if is_element(n)]
+    pairs = {}
+    taken = set()
+
+    right_ids = {}
+    for right_child in right_children:
+        node_id = right_child.get('id')
+        if node_id is not None:
+            right_ids.setdefault((right_child.tag, node_id), right_child)
+    for left_child in left_children:
+        right_child = right_ids.get((left_child.tag, left_child.get('id')))
+        if right_child is not None and right_child not in taken:
+            pairs[left_child] = right_child
+            taken.add(right_child)
+
+    right_hashes = {}
+    for right_child in right_children:
+        if right_child not in taken:
+            digest = hashlib.sha1(_serialize(right_child)).digest()
+            right_hashes.setdefault(digest, []).append(right_child)
+    for left_child in left_children:
+        if left_child in pairs:
+            continue
+        digest = hashlib.sha1(_serialize(left_child)).digest()
+        candidates = right_hashes.get(digest)
+        if candidates:
+            right_child = candidates.pop(0)
+            pairs[left_child] = right_child
+            taken.add(right_child)
+
+    remaining = lcs([n for n in left_children if n not in pairs],
+                    [n for n in right_children if n not in taken],
+                    lambda l, r: l.tag == r.tag)
+    pairs.update(remaining)
+
+    return [(n, pairs[n]) for n in left_children if n in pairs]
+
+
+def _shallow(node):
+    """ Return a copy of the given element without its children. """
+    copy = etree.Element(node.tag, dict(node.attrib), nsmap=node.nsmap)
+    copy.text = node.text
+    copy.tail = node.tail
+    return copy
+
+
+def _skeleton(root, expand, stubs, whole):
+    """ Return a copy of the tree down to the given nodes to expand and
+        a dict mapping each node of the copy to its original. The
+        children of nodes to expand are copied. Stubs are copied without
+        their children, as are any other elements unless whole is True,
+        in which case they're copied with all of theirs. """
+
+    top = _shallow(root)
+    originals = {top: root}
+    stack = [(root, top)]
+    while len(stack) > 0:
+        node, copy = stack.pop()
+        for child in node:
+            if not is_element(child):
+                child_copy = deepcopy(child)
+            elif child in expand:
+                child_copy = _shallow(child)
+                stack.append((child, child_copy))
+            elif whole and child not in stubs:
+                child_copy = deepcopy(child)
+            else:
+                child_copy = _shallow(child)
+            copy.append(child_copy)
+            originals[child_copy] = child
+    return top, originals
+
+
+def _rebase(script, old_path, new_path, tail=_KEEP):
+    """ Return the actions of the given script with paths beneath
+        old_path moved beneath new_path. If a tail is given, it's kept
+        by any update of the node at old_path. """
+
+    def rebase(path):
+        if path == old_path or path.startswith(old_path + '/'):
+            return new_path + path[len(old_path):]
+        return path
+
+    for action in script:
+        if type(action) == INSERT:
+            yield action._replace(parent=rebase(action.parent))
+        elif type(action) == MOVE:
+            yield action._replace(path=rebase(action.path),
+                                  parent=rebase(action.parent))
+        elif type(action) == UPDATE:
+            if tail is not _KEEP and action.path == old_path:
+                action = action._replace(tail=tail)
+            yield action._replace(path=rebase(action.path))
+        else:
+            yield action._replace(path=rebase(action.path))
+
+
+def splitdiff(left_root, right_root, match=simplematch,
+              match_threshold=THRESHOLD, split=1, processes=None,
+              chunksize=1):
+    """
+    Return the edit script that transforms the left tree into the right
+    tree, diffing the sections of the trees in a pool of processes.
+
+    The sections are the elements at the given depth beneath the roots.
+    The children of each pair of matched nodes above that depth are
+    paired off by id, then by being identical, then in order by tag, and
+    each pair of sections is diffed on its own (see diff_many() for the
+    processes and chunksize). Their scripts come first, followed by the
+    actions that insert, move, update and delete the nodes above and
+    including the sections themselves. The depth must be at least 1.
+    """
+
+    if split < 1:
+        raise ValueError('split must be at least 1, not %r' % (split,))
+
+    script = OrderedSet()
+
+    # If the trees don't have the same signature, we can't transform
+    # the left into the right.
+    if getpath(left_root) != getpath(right_root):
+        return script
+
+    # Pair off the nodes down to the sections
+    above = [(left_root, right_root)]
+    sections = []
+    level = above
+    for depth in range(split):
+        pairs = []
+        for left_node, right_node in level:
+            pairs.extend(_align(left_node, right_node))
+        if depth == split - 1:
+            sections = pairs
+        else:
+            above.extend(pairs)
+        level = pairs
+
+    # Diff the sections. Nothing outside of a section is changed by its
+    # script, so each can be placed at its section's path as it is now.
+    results = diff_many(((_serialize(l), _serialize(r)) for l, r in sections),
+                        processes=processes, chunksize=chunksize,
+                        ordered=False, match=match,
+                        match_threshold=match_threshold)
+    section_scripts = [None] * len(sections)
+    for index, section_script in results:
+        section_scripts[index] = section_script
+    for (left_section, right_section), section_script in \
+            zip(sections, section_scripts):
+        script.update(_rebase(section_script,
+                              '/' + element_step(left_section),
+                              getpath(left_section),
+                              tail=left_section.tail))
+
+    # Then diff what's left. The sections become stubs, with the left
+    # stubs given the text and attributes their scripts gave them, and
+    # every node that's been paired off is matched.
+    expand = set(n for pair in above for n in pair)
+    stubs = set(n for pair in sections for n in pair)
+    left_skeleton, left_originals = _skeleton(left_root, expand, stubs,
+                                              False)
+    right_skeleton, right_originals = _skeleton(right_root, expand, stubs,
+                                                True)
+
+    partners = dict(above + sections)
+    right_copies = dict((original, copy) for copy, original
+                        in right_originals.items())
+    matches = MatchSet()
+    for left_copy, left_node in left_originals.items():
+        if left_node not in partners:
+            continue
+        right_copy = right_copies[partners[left_node]]
+        if left_node in stubs:
+            left_copy.text = right_copy.text
+            left_copy.attrib.clear()
+            left_copy.attrib.update(right_copy.attrib)
+        matches.add(Match(left_copy, right_copy))
+
+    script.update(_rebase(editscript(left_skeleton, right_skeleton, matches),
+                          '/' + element_step(left_root),
+                          getpath(left_root)))
+
+    return script
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Serializing edit scripts.
+
+Edit scripts can be written in a compact binary format with dumps() and
+dump_stream() and read back with loads() and iterloads(), or written as
+JSON for reading by people with dumps_json() and loads_json().
+
+The binary format is a header, MAGIC followed by a VERSION byte, and
+then a record for each action, ending with an END record. Each record
+starts with the action's code, and its fields follow as unsigned
+LEB128 varints:
+
+    INSERT  node, parent, index
+    UPDATE  path, text, tail, attrib
+    MOVE    path, parent, index
+    DELETE  path
+
+Integers are varints. Node is the length of the serialized node followed
+by its bytes. Text, tail, and the names and values of attributes are
+references to a table of strings that's built as they're read: 0 means
+None, 1 means a new string follows (its length and UTF-8 bytes) that is
+added to the table, and anything else is the table entry at that number
+less 2. Attrib is the number of attributes followed by each name and
+value, in order by name.
+
+A path is the number of steps it shares with the path before it, the
+number of steps that follow, and each of those steps as a string.
+Because edit scripts tend to work on the same parts of a tree one after
+another, most paths are only a step or two and most steps are already
+in the table.
+"""
+
+from __future__ import unicode_literals
+
+import json
+
+from .diff import INSERT, UPDATE, MOVE, DELETE, OrderedSet
+
+
+MAGIC = b'XTD'
+VERSION = 1
+
+# The action types, in the order of their codes, and the code for the
+# end of the script
+ACTIONS = (INSERT, UPDATE, MOVE, DELETE)
+ACTION_CODES = dict((action, code) for code, action in enumerate(ACTIONS))
+END = len(ACTIONS)
+
+if hasattr(memoryview, 'cast'):
+    def _view(data):
+        """ Return a view of the bytes of the given buffer. """
+        return memoryview(data).cast('B')
+else:  # Python 2
+    def _view(data):
+        """ Return a view of the bytes of the given buffer. """
+        return bytearray(data)
+
+
+class Writer(object):
+    """ Encodes actions in the binary format, keeping the table of
+        strings and the last path written. """
+
+    def __init__(self):
+        self.strings = {}
+        self.path = []
+
+    def header(self):
+        """ Return the bytes that start a script. """
+        return MAGIC + bytearray([VERSION])
+
+    def end(self):
+        """ Return the bytes that end a script. """
+        return bytearray([END])
+
+    def action(self, action):
+        """ Return the bytes of the record for the given action. """
+        out = bytearray()
+        self._int(out, ACTION_CODES[type(action)])
+        if type(action) == INSERT:
+            self._int(out, len(action.node))
+            out += action.node
+            self._path(out, action.parent)
+            self._int(out, action.index)
+        elif type(action) == UPDATE:
+            self._path(out, action.path)
+            self._string(out, action.text)
+            self._string(out, action.tail)
+            attrib = sorted(action.attrib)
+            self._int(out, len(attrib))
+            for name, value in attrib:
+                self._string(out, name)
+                self._string(out, value)
+        elif type(action) == MOVE:
+            self._path(out, action.path)
+            self._path(out, action.parent)
+            self._int(out, action.index)
+        else:
+            self._path(out, action.path)
+        return out
+
+    def _int(self, out, value):
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    def _string(self, out, value):
+        if value is None:
+            self._int(out, 0)
+            return
+        number = self.strings.get(value)
+        if number is not None:
+            self._int(out, number + 2)
+            return
+        self.strings[value] = len(self.strings)
+        encoded = value.encode('utf-8')
+        self._int(out, 1)
+        self._int(out, len(encoded))
+        out += encoded
+
+    def _path(self, out, path):
+        steps = path.split('/')
+        shared = 0
+        for step, previous in zip(steps, self.path):
+            if step != previous:
+                break
+            shared += 1
+        self._int(out, shared)
+        self._int(out, len(steps) - shared)
+        for step in steps[shared:]:
+            self._string(out, step)
+        self.path = steps
+
+
+class Reader(object):
+    """ Decodes actions in the binary format from a buffer. """
+
+    def __init__(self, data):
+        self.data = _view(data)
+        self.offset = 0
+        self.strings = []
+        self.path = []
+
+    def header(self):
+        """ Read the header, raising ValueError if it's not one this
+            module can read. """
+        if len(self.data) <= len(MAGIC) or \
+                bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError('Not an xtdiff edit script')
+        version = self.data[len(MAGIC)]
+        if version != VERSION:
+            raise ValueError('Unsupported edit script version %d' % version)
+        self.offset = len(MAGIC) + 1
+
+    def action(self):
+        """ Return the next action, or None at the end of the script. """
+        code = self._int()
+        if code == END:
+            return None
+        if code > END:
+            raise ValueError('Unknown action %d' % code)
+
+        action = ACTIONS[code]
+        if action == INSERT:
+            node = self._bytes(self._int())
+            return INSERT(node, self._path(), self._int())
+        elif action == UPDATE:
+            path = self._path()
+            text = self._string()
+            tail = self._string()
+            attrib = frozenset((self._string(), self._string())
+                               for i in range(self._int()))
+            return UPDATE(path, text, tail, attrib)
+        elif action == MOVE:
+            return MOVE(self._path(), self._path(), self._int())
+        return DELETE(self._path())
+
+    def _int(self):
+        data = self.data
+        value = 0
+        shift = 0
+        while True:
+            byte = data[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def _bytes(self, length):
+        start = self.offset
+        self.offset += length
+        if self.offset > len(self.data):
+            raise ValueError('Truncated edit script')
+        return bytes(self.data[start:self.offset])
+
+    def _string(self):
+        number = self._int()
+        if number == 0:
+            return None
+        if number == 1:
+            value = self._bytes(self._int()).decode('utf-8')
+            self.strings.append(value)
+            return value
+        return self.strings[number - 2]
+
+    def _path(self):
+        shared = self._int()
+        steps = self.path[:shared]
+        for i in range(self._int()):
+            steps.append(self._string())
+        self.path = steps
+        return '/'.join(steps)
+
+
+def dumps(script):
+    """ Return the given edit script in the binary format, as bytes. """
+    writer = Writer()
+    out = bytearray(writer.header())
+    for action in script:
+        out += writer.action(action)
+    out += writer.end()
+    return bytes(out)
+
+
+def dump_stream(script, stream):
+    """ Write the given edit script, which may be any iterable of actions,
+        to the given file-like object in the binary format, one action at
+        a time. """
+    writer = Writer()
+    stream.write(bytes(writer.header()))
+    for action in script:
+        stream.write(bytes(writer.action(action)))
+    stream.write(bytes(writer.end()))
+
+
+def iterloads(data):
+    """ Yield the actions of the edit script in the given buffer (bytes,
+        bytearray, memoryview or mmap) one at a time. The buffer isn't
+        copied. """
+    reader = Reader(data)
+    reader.header()
+    try:
+        action = reader.action()
+        while action is not None:
+            yield action
+            action = reader.action()
+    except IndexError:
+        raise ValueError('Truncated edit script')
+
+
+def loads(data):
+    """ Return the edit script in the given buffer. """
+    return OrderedSet(iterloads(data))
+
+
+def dumps_json(script, **kwargs):
+    """ Return the given edit script as JSON text. Any keyword arguments
+        are passed on to json.dumps(). """
+    actions = []
+    for action in script:
+        fields = action._asdict()
+        if type(action) == INSERT:
+            fields['node'] = action.node.decode('utf-8')
+        elif type(action) == UPDATE:
+            fields['attrib'] = dict(action.attrib)
+        fields['action'] = type(action).__name__
+        actions.append(fields)
+    return json.dumps(actions, sort_keys=True, **kwargs)
+
+
+def loads_json(text):
+    """ Return the edit script in the given JSON text. """
+    types = dict((action.__name__, action) for action in ACTIONS)
+    script = OrderedSet()
+    for fields in json.loads(text):
+        action = types[fields.pop('action')]
+        if action == INSERT:
+            fields['node'] = fields['node'].encode('utf-8')
+        elif action == UPDATE:
+            fields['attrib'] = frozenset(fields['attrib'].items())
+        script.add(action(**fields))
+    return script
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Text similarity.
+
+Texts are compared by the ratio difflib.SequenceMatcher gives them,
+and the upper bounds on it that it gives more cheaply. If the optional
+_similarity extension was built, the ratios come from it, many times
+faster, and otherwise from difflib. The extension works out exactly
+the same ratios as difflib, so which is used makes no difference to
+diffs. NATIVE says whether it's there.
+"""
+
+from __future__ import division, unicode_literals
+
+from difflib import SequenceMatcher
+
+
+def real_quick_ratio(a, b):
+    """ Return difflib.SequenceMatcher's real_quick_ratio() for the
+        given texts, an upper bound on their ratio that only looks at
+        their lengths. """
+    length = len(a) + len(b)
+    if length:
+        return 2.0 * min(len(a), len(b)) / length
+    return 1.0
+
+
+def python_quick_ratio(a, b):
+    """ Return difflib.SequenceMatcher's quick_ratio() for the given
+        texts, an upper bound on their ratio that only looks at the
+        characters they have in common. """
+    return SequenceMatcher(a=a, b=b).quick_ratio()
+
+
+def python_ratio(a, b, threshold=None):
+    """ Return difflib.SequenceMatcher's ratio() for the given texts. If
+        a threshold is given and real_quick_ratio() or quick_ratio()
+        already falls short of it, that bound is returned instead. """
+    if threshold is not None:
+        bound = real_quick_ratio(a, b)
+        if bound < threshold:
+            return bound
+    text_matcher = SequenceMatcher(a=a, b=b)
+    if threshold is not None:
+        bound = text_matcher.quick_ratio()
+        if bound < threshold:
+            return bound
+    return text_matcher.ratio()
+
+
+try:
+    from ._similarity import quick_ratio, ratio
+    NATIVE = True
+except ImportError:
+    quick_ratio, ratio = python_quick_ratio, python_ratio
+    NATIVE = False
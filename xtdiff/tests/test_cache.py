@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+from functools import partial
+from unittest import TestCase
+
+import lxml.etree as etree
+
+from ..cache import DiffCache, tree_digest
+from ..diff import diff, simplematch, PreparedTree, KeyMatch
+from ..mapped import parse
+from ..serialize import loads
+from ..xsl import xsldiff
+
+
+CALLS = []
+
+
+def counting_match(left_root, right_root, threshold):
+    CALLS.append((left_root, right_root))
+    return simplematch(left_root, right_root, threshold)
+
+
+class DiffCacheTestCase(TestCase):
+
+    left = '<root><foo>bar</foo><foo>first</foo></root>'
+    right = '<root><foo>first</foo><baz/></root>'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = DiffCache(os.path.join(self.directory, 'cache.db'))
+        del CALLS[:]
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_diff(self):
+        expected = diff(etree.fromstring(self.left),
+                        etree.fromstring(self.right))
+        for i in range(3):
+            script = self.cache.diff(etree.fromstring(self.left),
+                                     etree.fromstring(self.right),
+                                     match=counting_match)
+            self.assertEqual(expected, script)
+        self.assertEqual(1, len(CALLS))
+
+        data = self.cache.diff(etree.fromstring(self.left),
+                               etree.fromstring(self.right),
+                               match=counting_match, serialized=True)
+        self.assertEqual(expected, loads(data))
+        self.assertEqual(1, len(CALLS))
+
+    def test_persistent(self):
+        self.cache.diff(etree.fromstring(self.left),
+                        etree.fromstring(self.right), match=counting_match)
+        self.cache.close()
+        self.cache = DiffCache(os.path.join(self.directory, 'cache.db'))
+        self.cache.diff(etree.fromstring(self.left),
+                        etree.fromstring(self.right), match=counting_match)
+        self.assertEqual(1, len(CALLS))
+
+    def test_keys(self):
+        left = etree.fromstring(self.left)
+        right = etree.fromstring(self.right)
+        key = self.cache.key('diff', left, right)
+        self.assertEqual(key, self.cache.key(
+            'diff', PreparedTree(etree.fromstring(self.left)), right))
+        self.assertNotEqual(key, self.cache.key('diff', right, left))
+        self.assertNotEqual(key, self.cache.key('diff', left, right,
+                                                match_threshold=0.5))
+        self.assertNotEqual(key, self.cache.key('diff', left, right,
+                                                match=counting_match))
+        self.assertRaises(ValueError, self.cache.key, 'diff', left, right,
+                          lambda l, r, threshold: None)
+        # Key matches with different keys have different keys
+        self.assertNotEqual(
+            self.cache.key('diff', left, right, match=KeyMatch({'foo': 'a'})),
+            self.cache.key('diff', left, right, match=KeyMatch({'foo': 'b'})))
+        self.assertEqual(
+            self.cache.key('diff', left, right, match=KeyMatch({'foo': 'a'})),
+            self.cache.key('diff', left, right, match=KeyMatch({'foo': 'a'})))
+        # So do other callables configured differently
+        self.assertNotEqual(
+            self.cache.key('diff', left, right,
+                           match=partial(counting_match, threshold=0.5)),
+            self.cache.key('diff', left, right,
+                           match=partial(counting_match, threshold=0.6)))
+
+        def local_match(left_root, right_root, threshold):
+            return None
+        self.assertRaises(ValueError, self.cache.key, 'diff', left, right,
+                          local_match)
+        self.assertRaises(ValueError, self.cache.key, 'diff', left, right,
+                          partial(local_match, threshold=0.5))
+
+    def test_tree_digest(self):
+        digest = tree_digest(etree.fromstring('<a x="1" y="2"/>'))
+        self.assertEqual(digest,
+                         tree_digest(etree.fromstring("<a y='2' x='1'></a>")))
+        self.assertNotEqual(digest,
+                            tree_digest(etree.fromstring('<a x="1"/>')))
+        nested = etree.fromstring('<b><a x="1" y="2"/></b>')
+        self.assertNotEqual(digest, tree_digest(nested[0]))
+
+    def test_tree_digest_mapped(self):
+        def mapped_digest(name, data, select=lambda root: root):
+            path = os.path.join(self.directory, name)
+            with open(path, 'wb') as xml_file:
+                xml_file.write(data)
+            with parse(path) as tree:
+                return tree_digest(select(tree.getroot()))
+
+        data = b'<r xmlns:p="urn:p"><p:a x="1"/><b/></r>'
+        digest = mapped_digest('one.xml', data)
+        self.assertEqual(digest, mapped_digest('two.xml', data))
+        self.assertNotEqual(digest, mapped_digest(
+            'three.xml', b'<r xmlns:p="urn:p"><p:a x="2"/><b/></r>'))
+
+        # Mapped trees have their own keys
+        self.assertNotEqual(digest, tree_digest(etree.fromstring(data)))
+
+        # Inherited namespaces are part of an element's digest
+        self.assertNotEqual(
+            mapped_digest('four.xml', data, lambda root: root[0]),
+            mapped_digest('five.xml', data.replace(b'urn:p', b'urn:q'),
+                          lambda root: root[0]))
+
+    def test_xsldiff(self):
+        expected = etree.tostring(xsldiff(etree.fromstring(self.left),
+                                          etree.fromstring(self.right)))
+        for i in range(2):
+            xsl = self.cache.xsldiff(etree.fromstring(self.left),
+                                     etree.fromstring(self.right),
+                                     match=counting_match)
+            self.assertEqual(expected, etree.tostring(xsl))
+        self.assertEqual(1, len(CALLS))
+
+    def test_eviction(self):
+        self.cache.max_size = 100
+        self.cache.set('a', b'x' * 40)
+        time.sleep(0.01)
+        self.cache.set('b', b'x' * 40)
+        time.sleep(0.01)
+        self.assertEqual(b'x' * 40, self.cache.get('a'))
+        time.sleep(0.01)
+        self.cache.set('c', b'x' * 40)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 
+from copy import deepcopy
 from unittest import TestCase
 
 import lxml.etree as etree
 
 from ..diff import (INSERT, UPDATE, MOVE, DELETE, THRESHOLD,
-                    Match, simplematch as match, lcs,
+                    Match, MatchSet, simplematch as match, lcs,
+                    fastmatch, hashmatch, MatchContext,
+                    RatioCache, text_ratio,
                     common_descendents, compare, equal_match,
-                    matching_partner, diff,
-                    transform)
+                    matching_partner, diff, iterdiff,
+                    transform, equal, changed, summary, Summary,
+                    PreparedTree, Budget, BudgetExceeded, KeyMatch)
 
 
 class XDiffTestCase(TestCase):
@@ -23,6 +27,33 @@ class XDiffTestCase(TestCase):
         root_two = etree.fromstring('<foo><bar attr="omg"/><feh>woot</feh></foo>')
         self.assertEqual(1.0, common_descendents(root_one, root_two))
 
+    def test_common_descendents_context(self):
+        root_one = etree.fromstring('<foo><bar attr="omg"/><feh>woot</feh><baz><qux/></baz></foo>')
+        root_two = etree.fromstring('<foo><feh>woot</feh><baz><qux/></baz></foo>')
+        context = MatchContext(root_one, root_two)
+
+        # Nothing has been matched yet
+        self.assertEqual(0.0, common_descendents(root_one, root_two,
+                                                 context=context))
+
+        # Leaves beneath both nodes are common, the internal baz node
+        # doesn't count.
+        context.add(2, 1)
+        context.add(3, 2)
+        context.add(4, 3)
+        self.assertAlmostEqual(2.0 / 3, common_descendents(
+            root_one, root_two, context=context))
+
+        # Only qux is beneath the right baz, the feh match isn't common
+        self.assertAlmostEqual(1.0 / 3, common_descendents(
+            root_one, root_two[1], context=context))
+
+    def test_common_descendents_pairs(self):
+        # Without a context every equal pair of descendents is counted
+        root_one = etree.fromstring('<foo><feh>woot</feh></foo>')
+        root_two = etree.fromstring('<foo><feh>woot</feh><feh>woot</feh></foo>')
+        self.assertEqual(1.0, common_descendents(root_one, root_two))
+
     def test_compare(self):
         # Straight compare
         root_one = etree.fromstring('<foo>woot</foo>')
@@ -48,6 +79,47 @@ class XDiffTestCase(TestCase):
         root_two = etree.fromstring('<foo two="three" one="two">woohoot</foo>')
         self.assertTrue(compare(root_one, root_two) < THRESHOLD * 2)
 
+    def test_compare_threshold(self):
+        # Past the threshold the result is exact, short of it, it may be
+        # a bound but it's still short.
+        root_one = etree.fromstring('<foo>woot</foo>')
+        root_two = etree.fromstring('<foo>woohoot</foo>')
+        root_three = etree.fromstring('<foo>a much longer text than woot</foo>')
+        self.assertEqual(compare(root_one, root_two),
+                         compare(root_one, root_two, threshold=THRESHOLD))
+        self.assertTrue(compare(root_one, root_three, threshold=THRESHOLD)
+                        < THRESHOLD * 2)
+
+    def test_text_ratio_bound(self):
+        # The lengths alone rule this out
+        self.assertEqual(0.4, text_ratio('ab', 'abcdefgh', threshold=0.8))
+        self.assertEqual(0.4, text_ratio('ab', 'abcdefgh'))
+
+    def test_text_ratio_cache(self):
+        cache = RatioCache(maxsize=2)
+        ratio = text_ratio('woot', 'woohoot', cache=cache)
+        self.assertEqual((ratio, True), cache.get('woot', 'woohoot'))
+
+        # Bounds are remembered as bounds
+        text_ratio('ab', 'abcdefgh', threshold=0.8, cache=cache)
+        self.assertEqual((0.4, False), cache.get('ab', 'abcdefgh'))
+
+        # The oldest ratios are forgotten first
+        text_ratio('one', 'two', cache=cache)
+        text_ratio('three', 'four', cache=cache)
+        self.assertEqual(None, cache.get('woot', 'woohoot'))
+        self.assertNotEqual(None, cache.get('three', 'four'))
+
+    def test_text_ratio_cache_bound(self):
+        cache = RatioCache()
+        cache.set('ab', 'abcd', 0.5, exact=False)
+        # A bound that falls short of the threshold is enough
+        self.assertEqual(0.5, text_ratio('ab', 'abcd', threshold=0.8,
+                                         cache=cache))
+        # Otherwise the ratio is worked out, and remembered as exact
+        ratio = text_ratio('ab', 'abcd', threshold=0.4, cache=cache)
+        self.assertEqual((ratio, True), cache.get('ab', 'abcd'))
+
     def test_equal_match_mostly(self):
         # Mostly true — this matches our threshold.
         root_one = etree.fromstring('<foo>woot</foo>')
@@ -82,7 +154,60 @@ class XDiffTestCase(TestCase):
         xs = 'HUMAN'
         ys = 'CHIMPANZEE'
         self.assertEqual(lcs(xs, ys, lambda x, y: x == y),
-                         {('A', 'A'), ('N', 'N'), ('M', 'M'), ('H', 'H')})
+                         [('H', 'H'), ('M', 'M'), ('A', 'A'), ('N', 'N')])
+
+    def test_lcs_repeated(self):
+        self.assertEqual([(1, 1)] * 3,
+                         lcs([1, 1, 1], [1, 1, 1], lambda x, y: x == y))
+        self.assertEqual([('a', 'a'), ('b', 'b'), ('a', 'a')],
+                         lcs('abca', 'xabay', lambda x, y: x == y))
+
+    def test_lcs_ordered(self):
+        xs = 'ABCABBA'
+        ys = 'CBABAC'
+        common = lcs(list(enumerate(xs)), list(enumerate(ys)),
+                     lambda x, y: x[1] == y[1])
+        self.assertEqual(4, len(common))
+        x_positions = [x[0] for x, y in common]
+        y_positions = [y[0] for x, y in common]
+        self.assertEqual(sorted(x_positions), x_positions)
+        self.assertEqual(sorted(y_positions), y_positions)
+        self.assertTrue(all(x[1] == y[1] for x, y in common))
+
+    def test_lcs_empty(self):
+        self.assertEqual(0, len(lcs('', 'abc', lambda x, y: x == y)))
+        self.assertEqual(0, len(lcs('abc', 'xyz', lambda x, y: x == y)))
+
+    def test_lcs_long(self):
+        # This would have exceeded the recursion limit before
+        xs = list(range(10000))
+        ys = [y if y % 100 else -y - 1 for y in xs]
+        common = lcs(xs, ys, lambda x, y: x == y)
+        self.assertEqual(9900, len(common))
+
+    def test_lcs_dissimilar(self):
+        # The search gives up well before the N * D comparisons an exact
+        # answer would take, but still finds a common subsequence
+        calls = [0]
+
+        def equal(x, y):
+            calls[0] += 1
+            return x == y
+
+        xs = list(range(4000))
+        self.assertEqual([], lcs(xs, [-x - 1 for x in xs], equal))
+        self.assertLess(calls[0], 4000 * 200)
+
+        calls[0] = 0
+        ys = list(reversed(xs[:2000])) + xs[2000:]
+        common = lcs(xs, ys, equal)
+        self.assertLess(calls[0], 4000 * 200)
+        self.assertGreaterEqual(len(common), 2000)
+        self.assertTrue(all(x == y for x, y in common))
+        self.assertEqual(sorted(x for x, y in common),
+                         [x for x, y in common])
+        self.assertEqual([ys.index(y) for x, y in common],
+                         sorted(ys.index(y) for x, y in common))
 
     def test_matching_partner(self):
         matches = {Match('a', 'b'), Match('c', 'd'), }
@@ -90,6 +215,20 @@ class XDiffTestCase(TestCase):
         self.assertEqual(matching_partner(matches, 'b'), 'a')
         self.assertEqual(matching_partner(matches, 'd'), 'c')
 
+    def test_matching_partner_matchset(self):
+        matches = MatchSet([Match('a', 'b'), Match('c', 'd')])
+        self.assertEqual(matching_partner(matches, 'a'), 'b')
+        self.assertEqual(matching_partner(matches, 'b'), 'a')
+        self.assertEqual(matching_partner(matches, 'd'), 'c')
+        self.assertEqual(matching_partner(matches, 'e'), None)
+
+    def test_matchset_discard(self):
+        matches = MatchSet([Match('a', 'b'), Match('c', 'd')])
+        matches.discard(Match('a', 'b'))
+        self.assertEqual(matches.partner('a'), None)
+        self.assertEqual(matches.partner('b'), None)
+        self.assertEqual([Match('c', 'd')], list(matches))
+
     def test_match_direct(self):
         # Direct match
         root_one = etree.fromstring("<root><first><second>Child Node</second></first></root>")
@@ -105,11 +244,13 @@ class XDiffTestCase(TestCase):
         self.assertEqual(0, len(matches))
 
     def test_match_bottom_two(self):
-        # This should still match the bottom two nodes
+        # This should still match the bottom two nodes. The roots share
+        # their only leaf, so they're matched too.
         root_one = etree.fromstring("<root><first><second><third>Child Node</third></second></first></root>")
         root_two = etree.fromstring("<root><second><third>Child Node</third></second></root>")
         matches = match(root_one, root_two)
-        self.assertEqual(2, len(matches))
+        self.assertEqual(3, len(matches))
+        self.assertIs(matches.partner(root_one[0][0]), root_two[0])
 
     def test_match_nothing(self):
         root_one = etree.fromstring("<root><first><second>asdfghjkl</second></first></root>")
@@ -117,6 +258,48 @@ class XDiffTestCase(TestCase):
         matches = match(root_one, root_two)
         self.assertEqual(0, len(matches))
 
+    def test_hashmatch(self):
+        root_one = etree.fromstring("<root><a><b>One</b></a><c>Two</c></root>")
+        root_two = etree.fromstring("<root><c>Two</c><d/><a><b>One</b></a></root>")
+        matches = hashmatch(root_one, root_two)
+        self.assertEqual(
+            [(n.a.tag, n.b.tag) for n in matches],
+            [('a', 'a'), ('b', 'b'), ('c', 'c')])
+        self.assertIs(matches.partner(root_one[1]), root_two[0])
+
+    def test_hashmatch_duplicates(self):
+        # Identical subtrees are paired off in document order
+        root_one = etree.fromstring("<root><a>One</a><a>One</a></root>")
+        root_two = etree.fromstring("<root><a>One</a><b/><a>One</a></root>")
+        matches = hashmatch(root_one, root_two)
+        self.assertIs(matches.partner(root_one[0]), root_two[0])
+        self.assertIs(matches.partner(root_one[1]), root_two[2])
+
+    def test_match_one_to_one(self):
+        # Both left nodes are similar enough to the right node, but it
+        # can only be matched once.
+        root_one = etree.fromstring("<root><p>Hello world</p><p>Hello world!</p></root>")
+        root_two = etree.fromstring("<root><p>Hello world?</p></root>")
+        matches = match(root_one, root_two)
+        self.assertEqual([Match(root_one[0], root_two[0])], list(matches))
+
+    def test_match_ids(self):
+        root_one = etree.fromstring('<root><a id="x">one</a><a id="y">two</a></root>')
+        root_two = etree.fromstring('<root><a id="y">zzz</a><a id="x">qqq</a></root>')
+        matches = match(root_one, root_two)
+        self.assertEqual(3, len(matches))
+        self.assertIs(matches.partner(root_one[0]), root_two[1])
+        self.assertIs(matches.partner(root_one[1]), root_two[0])
+
+    def test_match_exact_subtrees(self):
+        # Identical subtrees are matched even though the nodes above
+        # them differ.
+        root_one = etree.fromstring("<root><first><second>Child Node</second></first></root>")
+        root_two = etree.fromstring("<root><other><second>Child Node</second></other></root>")
+        for matcher in (match, fastmatch):
+            matches = matcher(root_one, root_two)
+            self.assertIs(matches.partner(root_one[0][0]), root_two[0][0])
+
     def test_diff_nodiff(self):
         # These are the same, the edit script should be no different.
         root_one = etree.fromstring("<root><first><second>Child Node</second></first></root>")
@@ -160,6 +343,358 @@ class XDiffTestCase(TestCase):
         self.assertEqual(1, len(script))
         self.assertEqual({DELETE(path='/root/foo')}, script)
 
+    def test_diff_insert_subtree(self):
+        # The subtree is inserted once, not once for every node
+        root_one = etree.fromstring("<root></root>")
+        root_two = etree.fromstring("<root><a><b>A child Node</b></a></root>")
+        script = diff(root_one, root_two)
+        self.assertEqual(
+            [INSERT(node=b'<a><b>A child Node</b></a>', parent='/root',
+                    index=0)],
+            list(script))
+
+    def test_diff_insert_around_match(self):
+        # The new section is inserted on its own and the existing
+        # paragraph is moved into it.
+        root_one = etree.fromstring("<root><p>Lorem ipsum dolor</p></root>")
+        root_two = etree.fromstring("<root><sec><p>Lorem ipsum dolor</p></sec></root>")
+        script = diff(root_one, root_two)
+        self.assertEqual(
+            [INSERT(node=b'<sec/>', parent='/root', index=0),
+             MOVE(path='/root/p', parent='/root/sec', index=0)],
+            list(script))
+        result = transform(root_one, script)
+        self.assertEqual(etree.tostring(result), etree.tostring(root_two))
+
+    def test_diff_move_parent(self):
+        # The last paragraph of a moves to the start of b
+        root_one = etree.fromstring(
+            "<root><a><p>One</p><p>Two</p><p>Three</p><p>Four</p><p>Five</p></a>"
+            "<b><p>Six</p><p>Seven</p><p>Eight</p><p>Nine</p></b></root>")
+        root_two = etree.fromstring(
+            "<root><a><p>One</p><p>Two</p><p>Three</p><p>Four</p></a>"
+            "<b><p>Five</p><p>Six</p><p>Seven</p><p>Eight</p><p>Nine</p></b></root>")
+        script = diff(root_one, root_two)
+        self.assertEqual(
+            [MOVE(path='/root/a/p[5]', parent='/root/b', index=0)],
+            list(script))
+        result = transform(root_one, script)
+        self.assertEqual(etree.tostring(result), etree.tostring(root_two))
+
+    def test_diff_input_untouched(self):
+        root_one = etree.fromstring("<root><foo>bar</foo><foo>first</foo></root>")
+        root_two = etree.fromstring("<root><foo>first</foo><baz/></root>")
+        before = etree.tostring(root_one)
+        diff(root_one, root_two)
+        self.assertEqual(before, etree.tostring(root_one))
+
+    def test_iterdiff(self):
+        root_one = etree.fromstring(
+            "<root><a><p>One</p><p>Two</p></a><b><p>Three</p></b></root>")
+        root_two = etree.fromstring(
+            "<root><b><p>Three</p><p>Two!</p></b><c/><a/></root>")
+        script = diff(root_one, root_two)
+        self.assertEqual(list(script), list(iterdiff(root_one, root_two)))
+        self.assertIsInstance(list(script)[-1], DELETE)
+
+    def test_iterdiff_early(self):
+        root_one = etree.fromstring("<root><foo>bar</foo></root>")
+        root_two = etree.fromstring("<root><foo>baz</foo><new/></root>")
+        actions = iterdiff(root_one, root_two)
+        self.assertEqual(UPDATE('/root/foo', 'baz', None, frozenset()),
+                         next(actions))
+        actions.close()
+        self.assertIsNone(next(iterdiff(root_one, root_one), None))
+
+    def test_equal(self):
+        root_one = etree.fromstring(
+            '<root><a x="1" y="2">one<!--c--></a>tail<b/></root>')
+        root_two = etree.fromstring(
+            '<root><a y="2" x="1">one<!--c--></a>tail<b/></root>')
+        self.assertTrue(equal(root_one, root_two))
+        self.assertFalse(changed(root_one, root_two))
+        for other in ('<root><a x="1" y="2">one<!--d--></a>tail<b/></root>',
+                      '<root><a x="1" y="2">one<!--c--></a>tail<b>!</b></root>',
+                      '<root><a x="1" y="3">one<!--c--></a>tail<b/></root>',
+                      '<root><a x="1" y="2">one<!--c--></a><b/></root>',
+                      '<root><a x="1" y="2">one<!--c--></a>tail<c/></root>',
+                      '<root><a x="1" y="2">one<!--c--></a>tail</root>'):
+            self.assertFalse(equal(root_one, etree.fromstring(other)))
+            self.assertTrue(changed(root_one, etree.fromstring(other)))
+
+    def test_summary(self):
+        root_one = etree.fromstring(
+            "<root><p>One</p><p>Two</p><p>Three</p><p>Four</p></root>")
+        root_two = etree.fromstring(
+            "<root><p>Three</p><p>One</p><p>Two!</p><q/></root>")
+        result = summary(root_one, root_two)
+        self.assertEqual((1, 1, 1, 1), result[:4])
+        self.assertAlmostEqual(0.8, result.similarity)
+
+        # The same as the counts of diff()'s actions
+        script = diff(root_one, root_two)
+        self.assertEqual(
+            list(result[:4]),
+            [len([a for a in script if type(a) == action_type])
+             for action_type in (INSERT, UPDATE, MOVE, DELETE)])
+
+    def test_summary_tails(self):
+        # Inserted nodes with tails are updated to add them, except the
+        # ones inside a subtree that's inserted whole.
+        root_one = etree.fromstring(
+            "<root><a><p>One</p><p>Two</p><p>Three</p><p>Four</p></a>"
+            "<b>Five</b></root>")
+        root_two = etree.fromstring(
+            "<root><a><p>One</p><p>Two</p><q/>tail<p>Three</p><p>Four</p>"
+            "</a><new><n/>tail</new>tail<c><b>Five</b></c>tail</root>")
+        result = summary(root_one, root_two)
+        self.assertEqual((4, 3, 1, 0), result[:4])
+
+        # The same as the counts of diff()'s actions, but for the node
+        # inserted with its parent
+        script = diff(root_one, root_two)
+        self.assertEqual(
+            [result.inserted - 1] + list(result[1:4]),
+            [len([a for a in script if type(a) == action_type])
+             for action_type in (INSERT, UPDATE, MOVE, DELETE)])
+
+    def test_summary_budget(self):
+        root_one = etree.fromstring(
+            "<root><a><p>One</p><p>Two</p></a><b><p>Three</p>"
+            "<p>Four</p></b><c><p>Five</p></c></root>")
+        root_two = etree.fromstring(
+            "<root><a><p>One!</p><p>Two</p></a><b><p>Three?</p>"
+            "<p>Four</p></b><c><p>Six</p><q/></c></root>")
+        exact = summary(root_one, root_two, comparisons=None)
+        self.assertFalse(exact.approximate)
+        self.assertEqual(exact, summary(root_one, root_two))
+
+        # Out of comparisons, the rest are matched by position
+        result = summary(root_one, root_two, comparisons=1)
+        self.assertTrue(result.approximate)
+        self.assertEqual((1, 3, 0, 0), result[:4])
+        self.assertAlmostEqual(18.0 / 19, result.similarity)
+
+        # Out of time, even the identical subtrees are
+        result = summary(root_one, root_two, budget=Budget(seconds=-1))
+        self.assertTrue(result.approximate)
+        self.assertEqual((1, 3, 0, 0), result[:4])
+
+    def test_summary_equal(self):
+        root = etree.fromstring("<root><a>One</a></root>")
+        other = etree.fromstring("<root><a>One</a></root>")
+        self.assertEqual(Summary(0, 0, 0, 0, 1.0), summary(root, other))
+
+    def test_prepared(self):
+        base = etree.fromstring(
+            "<root><a><p>One</p><p>Two</p></a><b><p>Three</p></b></root>")
+        revisions = [etree.fromstring(xml) for xml in (
+            "<root><a><p>One!</p><p>Two</p></a><b><p>Three</p></b></root>",
+            "<root><b><p>Three</p><p>Two</p></b><a><p>One</p></a></root>",
+            "<root><a><p>One</p><p>Two</p><q/></a><b/></root>")]
+        before = etree.tostring(base)
+        prepared = PreparedTree(base)
+        for match_function in (match, fastmatch, hashmatch):
+            for revision in revisions:
+                expected = diff(base, revision, match=match_function)
+                self.assertEqual(expected, diff(prepared, revision,
+                                                match=match_function))
+                self.assertEqual(
+                    diff(revision, base, match=match_function),
+                    diff(revision, prepared, match=match_function))
+                self.assertEqual(expected, diff(prepared,
+                                                PreparedTree(revision),
+                                                match=match_function))
+        self.assertEqual(before, etree.tostring(base))
+        self.assertTrue(equal(prepared, base))
+        self.assertEqual(summary(base, revisions[0]),
+                         summary(prepared, revisions[0]))
+        self.assertEqual(list(diff(base, revisions[2])),
+                         list(iterdiff(prepared, revisions[2])))
+
+    budget_left = ('<root><a><p>One</p><p>Two</p></a>'
+                   '<b id="x"><p>Three</p></b><c><p>Four</p></c></root>')
+    budget_right = ('<root><a><p>One!</p><p>Two</p></a>'
+                    '<b id="x"><p>Three and more</p></b><c><p>Four</p></c>'
+                    '<d/></root>')
+
+    def assertBudgetedDiff(self, budget, fallback, match_function=match):
+        """ Assert that a diff within the budget falls back as expected
+            and still transforms the left tree into the right. """
+        left = etree.fromstring(self.budget_left)
+        right = etree.fromstring(self.budget_right)
+        script = diff(left, right, match=match_function, budget=budget)
+        self.assertEqual(fallback, script.fallback)
+        self.assertEqual(fallback, budget.fallback)
+        self.assertEqual(etree.tostring(right),
+                         etree.tostring(transform(left, script)))
+        return script
+
+    def test_budget(self):
+        for match_function in (match, fastmatch):
+            script = self.assertBudgetedDiff(Budget(comparisons=1000), None,
+                                             match_function)
+            self.assertEqual(diff(etree.fromstring(self.budget_left),
+                                  etree.fromstring(self.budget_right),
+                                  match=match_function), script)
+
+    def test_budget_comparisons(self):
+        for match_function in (match, fastmatch):
+            budget = Budget(comparisons=0)
+            script = self.assertBudgetedDiff(budget, 'hashmatch',
+                                             match_function)
+            self.assertEqual(1, budget.spent)
+            # Only identical subtrees were matched, so the changed ones
+            # are replaced.
+            self.assertIn(DELETE, set(type(action) for action in script))
+            self.assertTrue(len(script) > len(diff(
+                etree.fromstring(self.budget_left),
+                etree.fromstring(self.budget_right))))
+
+    def test_budget_deadline(self):
+        # Time is up before identical subtrees have all been matched, so
+        # everything is matched by position.
+        script = self.assertBudgetedDiff(Budget(seconds=-1), 'position')
+        self.assertEqual(set([INSERT, UPDATE]),
+                         set(type(action) for action in script))
+
+    def test_budget_custom_match(self):
+        def expensive_match(left_root, right_root, threshold, budget=None):
+            budget.spend(1000)
+
+        budget = Budget(comparisons=10)
+        self.assertBudgetedDiff(budget, 'hashmatch', expensive_match)
+
+    def test_budget_reused(self):
+        budget = Budget(comparisons=0)
+        self.assertBudgetedDiff(budget, 'hashmatch')
+        budget.comparisons = 1000
+        self.assertBudgetedDiff(budget, None)
+        self.assertTrue(0 < budget.spent <= 1000)
+        budget.comparisons = 0
+        self.assertTrue(summary(etree.fromstring(self.budget_left),
+                                etree.fromstring(self.budget_right),
+                                budget=budget).approximate)
+        self.assertEqual('hashmatch', budget.fallback)
+
+    def test_budget_spend(self):
+        budget = Budget(comparisons=2)
+        budget.spend(2)
+        self.assertRaises(BudgetExceeded, budget.spend)
+        self.assertRaises(BudgetExceeded, Budget(seconds=-1).check)
+        Budget(seconds=60).check()
+
+    def assertKeyedDiff(self, keys, left, right):
+        """ Assert that a diff with the given keys transforms the left
+            tree into the right, and return the matches and script. """
+        left_root = etree.fromstring(left)
+        right_root = etree.fromstring(right)
+        match_function = KeyMatch(keys)
+        matches = match_function(left_root, right_root)
+        script = diff(left_root, right_root, match=match_function)
+        self.assertTrue(equal(right_root,
+                              transform(deepcopy(left_root), script)))
+        return matches, script
+
+    def test_keymatch_attribute(self):
+        # The texts are too different for simplematch, but the labels
+        # are the same.
+        left = ('<root><s label="1"><p>Alpha beta</p></s>'
+                '<s label="2"><p>Gamma</p></s></root>')
+        right = ('<root><s label="2"><p>Something else</p></s>'
+                 '<s label="1"><p>Entirely new</p></s></root>')
+        matches, script = self.assertKeyedDiff({'s': 'label'}, left, right)
+        # Only the paragraphs are replaced
+        deleted = [action.path for action in script
+                   if type(action) == DELETE]
+        self.assertEqual(2, len(deleted))
+        self.assertTrue(all(path.endswith('/p[2]') for path in deleted))
+        self.assertEqual(set(['1', '2']),
+                         set(m.a.get('label') for m in matches
+                             if m.a.tag == 's'))
+        for m in matches:
+            if m.a.tag == 's':
+                self.assertEqual(m.a.get('label'), m.b.get('label'))
+
+    def test_keymatch_decisive(self):
+        # simplematch would match the sections, which have most of their
+        # paragraphs in common, but their keys differ.
+        paragraphs = '<p>One</p><p>Two</p><p>Three</p><p>Four</p>'
+        left = '<root><s><num>1</num>%s</s></root>' % paragraphs
+        right = '<root><s><num>9</num>%s</s></root>' % paragraphs
+        self.assertIn('s', [m.a.tag for m in match(
+            etree.fromstring(left), etree.fromstring(right))])
+        matches, script = self.assertKeyedDiff({'s': 'string(num)'},
+                                               left, right)
+        self.assertNotIn('s', [m.a.tag for m in matches])
+
+    def test_keymatch_xpath(self):
+        left = ('<root><s><num>1</num><p>One</p></s>'
+                '<s><num>2</num><p>Two</p></s></root>')
+        right = ('<root><s><num>2</num><p>Zwei</p></s>'
+                 '<s><num>1</num><p>Eins</p></s></root>')
+        matches, script = self.assertKeyedDiff({'s': 'string(num)'},
+                                               left, right)
+        pairs = [(m.a.findtext('num'), m.b.findtext('num'))
+                 for m in matches if m.a.tag == 's']
+        self.assertEqual([('1', '1'), ('2', '2')], sorted(pairs))
+
+    def test_keymatch_composite(self):
+        left = ('<root><p n="1" part="a">One</p><p n="1" part="b">Two</p>'
+                '</root>')
+        right = ('<root><p n="1" part="b">Two!</p><p n="1" part="a">One!</p>'
+                 '</root>')
+        matches, script = self.assertKeyedDiff({'*': ('part', '@n')},
+                                               left, right)
+        for m in matches:
+            self.assertEqual(m.a.get('part'), m.b.get('part'))
+
+    def test_keymatch_repeated(self):
+        # Repeated keys aren't decisive, so the paragraphs are matched
+        # by their text instead.
+        left = '<root><p n="1">Apples</p><p n="1">Oranges</p></root>'
+        right = '<root><p n="1">Oranges!</p><p n="1">Apples!</p></root>'
+        matches, script = self.assertKeyedDiff({'p': 'n'}, left, right)
+        for m in matches:
+            if m.a.tag == 'p':
+                self.assertEqual(m.a.text, m.b.text.rstrip('!'))
+        self.assertEqual(3, len(matches))
+
+    def test_keymatch_repeated_one_side(self):
+        # A key that's unique on one side but repeated on the other
+        # isn't decisive either way, so the near-identical sections match
+        left = ('<r><s label="1">Some long paragraph text</s>'
+                '<s label="2">Other</s></r>')
+        right = ('<r><s label="1">Some long paragraph text.</s>'
+                 '<s label="2">Other</s><s label="1">Something else</s></r>')
+        matches, script = self.assertKeyedDiff({'s': 'label'}, left, right)
+        self.assertEqual([UPDATE, INSERT], [type(a) for a in script])
+        self.assertEqual('/r/s[1]', list(script)[0].path)
+
+    def test_keymatch_name(self):
+        self.assertEqual("KeyMatch(p='n', s=('a', 'b'))",
+                         KeyMatch({'s': ('a', 'b'), 'p': 'n'}).__name__
+                         .replace("u'", "'"))
+
+    def test_keymatch_budget(self):
+        left = etree.fromstring(self.budget_left)
+        right = etree.fromstring(self.budget_right)
+        script = diff(left, right, match=KeyMatch({'b': 'id'}),
+                      budget=Budget(comparisons=0))
+        self.assertEqual('hashmatch', script.fallback)
+        # The keyed match was made before the budget ran out, so only
+        # the paragraph in b is replaced.
+        self.assertEqual(['/root/b/p[2]'],
+                         [action.path for action in script
+                          if type(action) == DELETE and
+                          action.path.startswith('/root/b')])
+
+    def test_budget_split(self):
+        self.assertRaises(ValueError, diff,
+                          etree.fromstring(self.budget_left),
+                          etree.fromstring(self.budget_right), split=1,
+                          budget=Budget(comparisons=10))
+
     def test_transform_update(self):
         root_one = etree.fromstring("<root><first>Some text</first></root>")
         root_two = etree.fromstring("<root><first>Some text more</first></root>")
@@ -182,6 +717,21 @@ class XDiffTestCase(TestCase):
         self.assertEqual(etree.tostring(result),
                          etree.tostring(root_two))
 
+    def test_transform_insert_tail(self):
+        # Inserted nodes are serialized without their tails, which are
+        # updated separately
+        root_one = etree.fromstring("<root><a/></root>")
+        for right in ("<root><first>A child</first> tail<a/></root>",
+                      "<root><first>A<a/></first> tail</root>"):
+            root_two = etree.fromstring(right)
+            script = list(diff(root_one, root_two))
+            for action in script:
+                if type(action) == INSERT:
+                    etree.fromstring(action.node)
+            result = transform(deepcopy(root_one), script)
+            self.assertEqual(etree.tostring(result),
+                             etree.tostring(root_two))
+
     def test_transform_move(self):
         root_one = etree.fromstring("<root><foo>bar</foo><foo>first</foo></root>")
         root_two = etree.fromstring("<root><foo>first</foo><foo>bar</foo></root>")
@@ -199,3 +749,37 @@ class XDiffTestCase(TestCase):
         result = transform(root_one, script)
         self.assertEqual(etree.tostring(result),
                          etree.tostring(root_two))
+
+    def test_transform_update_attrib(self):
+        root_one = etree.fromstring('<root><first a="1" b="2"/></root>')
+        root_two = etree.fromstring('<root><first a="3"/></root>')
+        script = {
+            UPDATE(path='/root/first', text=None, tail=None,
+                   attrib=frozenset([('a', '3')]))
+        }
+        result = transform(root_one, script)
+        self.assertEqual(etree.tostring(result),
+                         etree.tostring(root_two))
+
+    def test_transform_sequence(self):
+        # Each action's paths are those of the tree the actions before
+        # it left.
+        root_one = etree.fromstring('<root><a/><b><c/></b><a/></root>')
+        root_two = etree.fromstring('<root><b><a/></b><c/></root>')
+        script = [
+            MOVE(path='/root/a[2]', parent='/root/b', index=0),
+            MOVE(path='/root/b/c', parent='/root', index=2),
+            DELETE(path='/root/a'),
+        ]
+        result = transform(root_one, script)
+        self.assertEqual(etree.tostring(result),
+                         etree.tostring(root_two))
+
+    def test_transform_xpath(self):
+        # Paths getpath() wouldn't generate are evaluated as XPath
+        root_one = etree.fromstring('<root><a/><a><b/></a></root>')
+        root_two = etree.fromstring('<root><a/><a/></root>')
+        script = [DELETE(path='//b')]
+        result = transform(root_one, script)
+        self.assertEqual(etree.tostring(result),
+                         etree.tostring(root_two))
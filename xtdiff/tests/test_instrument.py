@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+import lxml.etree as etree
+
+from ..diff import diff, iterdiff, transform, fastmatch, lcs, UPDATE
+from ..instrument import Instrumentation
+from ..xsl import xsldiff
+
+
+LEFT = ('<root><a>one</a><b><c>some text here</c><d>two</d></b>'
+        '<e>three</e></root>')
+RIGHT = ('<root><b><c>some text there</c><d>two</d></b>'
+         '<e>three</e><f>four</f></root>')
+
+
+class InstrumentationTestCase(TestCase):
+
+    def trees(self):
+        return etree.fromstring(LEFT), etree.fromstring(RIGHT)
+
+    def test_diff(self):
+        instrument = Instrumentation()
+        script = diff(*self.trees(), instrument=instrument)
+
+        self.assertEqual(['match', 'index', 'hashmatch', 'leaves',
+                          'branches', 'editscript'],
+                         list(instrument.timings))
+        self.assertTrue(instrument.timings['match'] >=
+                        instrument.timings['leaves'])
+        counters = instrument.counters
+        self.assertTrue(counters['compare'] > 0)
+        self.assertTrue(counters['sequence_matcher'] > 0)
+        self.assertTrue(counters['lcs'] > 0)
+        self.assertEqual(len(script), sum(counters[name] for name in
+                                          ('insert', 'update', 'move',
+                                           'delete')))
+        self.assertEqual(1, counters['insert'])
+        self.assertEqual(1, counters['delete'])
+        # Everything but a and f is matched
+        self.assertEqual(5, instrument.peak_matches)
+
+    def test_same_script(self):
+        self.assertEqual(diff(*self.trees()),
+                         diff(*self.trees(), instrument=Instrumentation()))
+        self.assertEqual(diff(*self.trees(), match=fastmatch),
+                         diff(*self.trees(), match=fastmatch,
+                              instrument=Instrumentation()))
+
+    def test_fastmatch(self):
+        instrument = Instrumentation()
+        diff(*self.trees(), match=fastmatch, instrument=instrument)
+        self.assertIn('chains', instrument.timings)
+        self.assertTrue(instrument.counters['lcs_cells'] > 0)
+
+    def test_iterdiff(self):
+        instrument = Instrumentation()
+        first = next(iterdiff(*self.trees(), instrument=instrument))
+        self.assertEqual(UPDATE, type(first))
+        self.assertEqual(1, instrument.counters['update'])
+        self.assertEqual(0, instrument.counters['insert'])
+
+    def test_xsldiff(self):
+        instrument = Instrumentation()
+        xsldiff(*self.trees(), instrument=instrument)
+        self.assertIn('toxsl', instrument.timings)
+
+    def test_transform(self):
+        instrument = Instrumentation()
+        left, right = self.trees()
+        script = diff(left, right)
+        transform(left, script, instrument=instrument)
+        self.assertIn('transform', instrument.timings)
+        self.assertEqual(0, instrument.counters['xpath'])
+
+    def test_accumulates(self):
+        instrument = Instrumentation()
+        diff(*self.trees(), instrument=instrument)
+        compares = instrument.counters['compare']
+        diff(*self.trees(), instrument=instrument)
+        self.assertEqual(compares * 2, instrument.counters['compare'])
+
+    def test_progress(self):
+        reports = []
+        instrument = Instrumentation(
+            progress=lambda *report: reports.append(report), interval=0)
+        diff(*self.trees(), instrument=instrument)
+        stages = set(stage for stage, done, total in reports)
+        self.assertEqual(set(['leaves', 'branches', 'editscript']), stages)
+        for stage in stages:
+            self.assertEqual(
+                [(done, done) for s, done, total in reports
+                 if s == stage][-1],
+                [(done, total) for s, done, total in reports
+                 if s == stage][-1])
+        # Every right element is visited by the edit script
+        self.assertIn(('editscript', 6, 6), reports)
+
+    def test_progress_interval(self):
+        reports = []
+        instrument = Instrumentation(
+            progress=lambda *report: reports.append(report), interval=60)
+        for done in range(10):
+            instrument.progress('stage', done, 10)
+        instrument.progress('stage', 10, 10)
+        self.assertEqual([('stage', 0, 10), ('stage', 10, 10)], reports)
+
+    def test_lcs(self):
+        instrument = Instrumentation()
+        lcs('abcd', 'abcd', lambda x, y: x == y, instrument)
+        self.assertEqual(1, instrument.counters['lcs'])
+        self.assertEqual(4, instrument.counters['lcs_cells'])
+
+    def test_custom_match(self):
+        def match(left_root, right_root, threshold, instrument=None):
+            self.assertIsNotNone(instrument)
+            return fastmatch(left_root, right_root, threshold)
+
+        instrument = Instrumentation()
+        diff(*self.trees(), match=match, instrument=instrument)
+        self.assertIn('match', instrument.timings)
+
+    def test_report(self):
+        instrument = Instrumentation()
+        diff(*self.trees(), instrument=instrument)
+        report = instrument.report()
+        self.assertEqual(instrument.peak_matches, report['peak_matches'])
+        self.assertEqual(dict(instrument.counters), report['counters'])
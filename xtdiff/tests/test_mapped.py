@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import lxml.etree as etree
+
+from ..diff import diff, transform, INSERT
+from ..mapped import parse
+from ..tree import TreeIndex, is_element
+
+
+LEFT = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<root xmlns:x="urn:x" a="1&gt;"><!-- a comment --><first/>'
+    b'tail &amp; more&#10;\n'
+    b'<x:b x:y="2">  <![CDATA[<cdata>]]> text</x:b><?pi data?>after the pi'
+    b'<s id="1">\n<p>one</p><p>two \xe2\x98\x83</p></s></root>')
+
+RIGHT = (
+    b'<root xmlns:x="urn:x" a="1&gt;"><!-- a comment --><first k="v"/>'
+    b'tail &amp; more&#10;\n'
+    b'<s id="1">\n<p>two \xe2\x98\x83</p><p>one!</p>'
+    b'<x:q><x:z>new &lt;</x:z></x:q></s>'
+    b'<x:b x:y="2">  <![CDATA[<cdata>]]> text</x:b><?pi data?>after the pi'
+    b'</root>')
+
+
+class MappedTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.trees = []
+
+    def tearDown(self):
+        for tree in self.trees:
+            tree.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as xml_file:
+            xml_file.write(data)
+        return path
+
+    def parse(self, name, data):
+        tree = parse(self.write(name, data))
+        self.trees.append(tree)
+        return tree
+
+    def assertSameTree(self, data):
+        """ Assert that the mapped tree of the given document looks the
+            same as lxml's. """
+        path = self.write('same.xml', data)
+        expected = etree.parse(path).getroot()
+        tree = parse(path)
+        self.trees.append(tree)
+        actual = tree.getroot()
+
+        self.assertEqual(len(list(expected.iter())), len(list(actual.iter())))
+        for node, mapped_node in zip(expected.iter(), actual.iter()):
+            self.assertEqual(node.tag, mapped_node.tag)
+            self.assertEqual(node.text, mapped_node.text)
+            self.assertEqual(node.tail, mapped_node.tail)
+            self.assertEqual(len(node), len(mapped_node))
+            if is_element(node):
+                self.assertEqual(dict(node.attrib), mapped_node.attrib)
+                self.assertEqual(node.prefix, mapped_node.prefix)
+                self.assertEqual(node.nsmap, mapped_node.nsmap)
+                self.assertEqual(node.getroottree().getpath(node),
+                                 tree.getpath(mapped_node))
+            else:
+                self.assertEqual(str(node), str(mapped_node))
+
+    def test_tree(self):
+        self.assertSameTree(LEFT)
+        self.assertSameTree(RIGHT)
+
+    def test_navigation(self):
+        root = self.parse('left.xml', LEFT).getroot()
+        s = list(root.iter(tag='s'))[0]
+        self.assertIs(root, s.getparent())
+        self.assertEqual('1', s.get('id'))
+        self.assertEqual(['p', 'p'], [p.tag for p in s])
+        self.assertIs(s[0], s[1].getprevious())
+        self.assertIs(s[1], s[0].getnext())
+        self.assertIsNone(s[1].getnext())
+        self.assertEqual(['p', 'p'],
+                         [n.tag for n in s.iterdescendants(etree.Element)])
+
+    def test_line_endings(self):
+        self.assertSameTree(b'<root>one\r\ntwo\rthree&#13;</root>')
+
+    def test_entities(self):
+        # Declared entities can't be read from the file, so text is kept
+        self.assertSameTree(b'<!DOCTYPE root [<!ENTITY e "entity">]>'
+                            b'<root><a>an &e;</a>&e; tail</root>')
+
+    def test_encoding(self):
+        self.assertSameTree('<?xml version="1.0" encoding="ISO-8859-1"?>'
+                            '<root><a>caf\xe9</a></root>'.encode('latin-1'))
+
+    def test_source(self):
+        root = self.parse('right.xml', RIGHT).getroot()
+        q = list(root.iter(tag='{urn:x}q'))[0]
+        source = q.source()
+        self.assertEqual(b'<x:q xmlns:x="urn:x"><x:z>new &lt;</x:z></x:q>',
+                         source)
+        self.assertEqual('new <', etree.fromstring(source)[0].text)
+
+    def test_index(self):
+        # The index reads positions and texts from the mapped tree, and
+        # its digests are the same as for the parsed tree
+        root = self.parse('left.xml', LEFT).getroot()
+        index = TreeIndex(root)
+        expected = TreeIndex(etree.fromstring(LEFT))
+        self.assertEqual(list(expected.text), list(index.text))
+        self.assertEqual(list(expected.tail), list(index.tail))
+        self.assertEqual(expected.hashes, index.hashes)
+        for i, node in enumerate(index.nodes):
+            self.assertEqual(i, index.position[node])
+        other = self.parse('right.xml', RIGHT).getroot()
+        self.assertRaises(KeyError, lambda: index.position[other])
+        self.assertRaises(KeyError, lambda: index.position[root[0]])
+
+    def test_diff(self):
+        left = self.parse('left.xml', LEFT).getroot()
+        right = self.parse('right.xml', RIGHT).getroot()
+        left_root = etree.fromstring(LEFT)
+        right_root = etree.fromstring(RIGHT)
+
+        expected = diff(left_root, right_root)
+        script = diff(left, right)
+        self.assertEqual(len(expected), len(script))
+        for expected_action, action in zip(expected, script):
+            self.assertEqual(type(expected_action), type(action))
+            if type(action) != INSERT:
+                self.assertEqual(expected_action, action)
+
+    def test_transform(self):
+        left = b'<root><a>one</a><b><c>two</c></b></root>'
+        right = b'<root><b><c>two!</c><d x="1"><e/></d></b><f>new</f></root>'
+        script = diff(self.parse('left.xml', left).getroot(),
+                      self.parse('right.xml', right).getroot())
+        result = transform(etree.fromstring(left), script)
+        self.assertEqual(right, etree.tostring(result))
+
+    def test_not_ascii(self):
+        path = self.write('utf16.xml', '<root/>'.encode('utf-16'))
+        self.assertRaises(ValueError, parse, path)
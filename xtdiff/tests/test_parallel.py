@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import lxml.etree as etree
+
+from ..diff import diff, fastmatch, transform, KeyMatch
+from ..parallel import diff_many, _parse
+
+
+PAIRS = [
+    ('<root><foo>bar</foo></root>', '<root><foo>bar</foo><baz/></root>'),
+    ('<root><foo>bar</foo><foo>first</foo></root>',
+     '<root><foo>first</foo><foo>bar</foo></root>'),
+    ('<root><foo a="1">text</foo></root>',
+     '<root><foo a="2">other text</foo></root>'),
+    ('<root><foo/></root>', '<root></root>'),
+]
+
+
+class DiffManyTestCase(TestCase):
+
+    def setUp(self):
+        self.expected = [diff(etree.fromstring(left),
+                              etree.fromstring(right))
+                         for left, right in PAIRS]
+
+    def test_elements(self):
+        pairs = [(etree.fromstring(left), etree.fromstring(right))
+                 for left, right in PAIRS]
+        results = list(diff_many(pairs, processes=1))
+        self.assertEqual(list(range(len(PAIRS))), [i for i, s in results])
+        self.assertEqual(self.expected, [s for i, s in results])
+
+    def test_pool(self):
+        pairs = [(left.encode('utf-8'), right.encode('utf-8'))
+                 for left, right in PAIRS]
+        results = list(diff_many(pairs, processes=2, chunksize=2))
+        self.assertEqual(self.expected, [s for i, s in results])
+
+    def test_unordered(self):
+        pairs = [(etree.fromstring(left).getroottree(),
+                  etree.fromstring(right))
+                 for left, right in PAIRS]
+        results = dict(diff_many(pairs, processes=2, ordered=False,
+                                 match=fastmatch))
+        expected = [diff(etree.fromstring(left), etree.fromstring(right),
+                         match=fastmatch)
+                    for left, right in PAIRS]
+        self.assertEqual(expected, [results[i] for i in range(len(PAIRS))])
+
+    def test_keymatch(self):
+        match = KeyMatch({'foo': ('@a', 'string(.)')})
+        pairs = [(left.encode('utf-8'), right.encode('utf-8'))
+                 for left, right in PAIRS]
+        results = list(diff_many(pairs, processes=2, match=match))
+        expected = [diff(etree.fromstring(left), etree.fromstring(right),
+                         match=match)
+                    for left, right in PAIRS]
+        self.assertEqual(expected, [s for i, s in results])
+
+    def test_paths(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pairs = []
+            for i, (left, right) in enumerate(PAIRS):
+                paths = []
+                for side, xml in (('left', left), ('right', right)):
+                    path = os.path.join(directory, '%s%d.xml' % (side, i))
+                    with open(path, 'w') as xml_file:
+                        xml_file.write(xml)
+                    paths.append(path)
+                pairs.append(tuple(paths))
+            results = list(diff_many(pairs, processes=2))
+            self.assertEqual(self.expected, [s for i, s in results])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_strings(self):
+        pairs = [(' \n' + left, right) for left, right in PAIRS]
+        results = list(diff_many(pairs, processes=1))
+        self.assertEqual(self.expected, [s for i, s in results])
+
+        # Whatever encoding is declared
+        root = _parse(u'<?xml version="1.0" encoding="latin-1"?><r>\xe9</r>')
+        self.assertEqual(u'\xe9', root.text)
+
+    def test_byte_order_marks(self):
+        pairs = [(codecs.BOM_UTF8 + left.encode('utf-8'),
+                  codecs.BOM_UTF16_LE + (' ' + right).encode('utf-16-le'))
+                 for left, right in PAIRS]
+        results = list(diff_many(pairs, processes=1))
+        self.assertEqual(self.expected, [s for i, s in results])
+        root = _parse(codecs.BOM_UTF16_BE + u'<r>\xe9</r>'.encode('utf-16-be'))
+        self.assertEqual(u'\xe9', root.text)
+
+    def test_not_a_path(self):
+        self.assertRaises(TypeError, _parse, 1)
+        self.assertRaises(IOError, _parse, 'missing.xml')
+
+
+class SplitDiffTestCase(TestCase):
+
+    left = ('<root><s id="1">one<p>first</p><p>second</p></s> tail'
+            '<s id="2"><p>third</p><t><p>fourth</p></t></s><s><p/></s></root>')
+    right = ('<root><s id="2"><p>third!</p><t><p>fourth</p><p/></t>'
+             '</s><s id="1" a="b">two<p>second</p></s> other tail<u/></root>')
+
+    def assertSplitDiff(self, **kwargs):
+        left_root = etree.fromstring(self.left)
+        right_root = etree.fromstring(self.right)
+        script = diff(left_root, right_root, **kwargs)
+        result = transform(etree.fromstring(self.left), script)
+        # Updated attributes don't keep their order, so compare the
+        # canonical forms
+        self.assertEqual(etree.tostring(right_root, method='c14n'),
+                         etree.tostring(result, method='c14n'))
+        # The left tree is untouched
+        self.assertEqual(self.left.encode('utf-8'), etree.tostring(left_root))
+
+    def test_split(self):
+        self.assertSplitDiff(split=1, processes=1)
+
+    def test_split_depth(self):
+        self.assertSplitDiff(split=2, processes=1)
+
+    def test_split_invalid(self):
+        left_root = etree.fromstring(self.left)
+        right_root = etree.fromstring(self.right)
+        for split in (0, -1):
+            self.assertRaises(ValueError, diff, left_root, right_root,
+                              split=split)
+
+    def test_split_pool(self):
+        self.assertSplitDiff(split=1, processes=2, match=fastmatch)
+
+    def test_split_keymatch(self):
+        self.assertSplitDiff(split=1, processes=2,
+                             match=KeyMatch({'s': 'id', 'p': 'string(.)'}))
+
+    def test_split_namespaces(self):
+        self.left = ('<r xmlns="urn:x" xmlns:p="urn:p"><p:s><a/></p:s>'
+                     '<s><b>1</b></s></r>')
+        self.right = ('<r xmlns="urn:x" xmlns:p="urn:p"><s><b>2</b><c/></s>'
+                      '<p:s><a/><a/></p:s><t/></r>')
+        self.assertSplitDiff(split=1, processes=1)
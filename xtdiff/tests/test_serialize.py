@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import io
+from unittest import TestCase
+
+import lxml.etree as etree
+
+from ..diff import INSERT, UPDATE, MOVE, DELETE, diff
+from ..serialize import dumps, loads, iterloads, dump_stream
+from ..serialize import dumps_json, loads_json, MAGIC
+
+
+SCRIPT = [
+    INSERT(node=b'<first>A child Node</first>', parent='/root', index=0),
+    UPDATE(path='/root/first', text='Some text more ☃', tail=None,
+           attrib=frozenset([('a', '1'), ('b', '☃')])),
+    MOVE(path='/root/foo[2]', parent='/root/bar/baz', index=130),
+    DELETE(path='/root/bar/baz/foo[1]'),
+    DELETE(path='/root/bar/baz'),
+    UPDATE(path='/root/bar', text=None, tail='', attrib=frozenset()),
+]
+
+
+class SerializeTestCase(TestCase):
+
+    def test_round_trip(self):
+        data = dumps(SCRIPT)
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertEqual(SCRIPT, list(loads(data)))
+
+    def test_buffers(self):
+        data = dumps(SCRIPT)
+        self.assertEqual(SCRIPT, list(iterloads(bytearray(data))))
+        self.assertEqual(SCRIPT, list(iterloads(memoryview(data))))
+
+    def test_stream(self):
+        stream = io.BytesIO()
+        dump_stream(iter(SCRIPT), stream)
+        self.assertEqual(dumps(SCRIPT), stream.getvalue())
+
+    def test_compact(self):
+        # Repeated steps and paths are only written once
+        delete = DELETE(path='/root/body/section[2]/div/paragraph[12]')
+        move = MOVE(path='/root/body/section[1]/div/paragraph[12]',
+                    parent='/root/body/section[2]/div', index=3)
+        once = len(dumps([delete, move]))
+        twice = len(dumps([delete, move, delete, move]))
+        self.assertTrue(twice - once < 20)
+        self.assertEqual([delete, move, delete, move],
+                         list(iterloads(dumps([delete, move, delete, move]))))
+
+    def test_diff(self):
+        left = etree.fromstring('<root><a>one</a><b x="1"/><c/></root>')
+        right = etree.fromstring('<root><b x="2"/><a>two</a><d/></root>')
+        script = diff(left, right)
+        self.assertEqual(script, loads(dumps(script)))
+
+    def test_errors(self):
+        data = dumps(SCRIPT)
+        self.assertRaises(ValueError, loads, b'XML' + data[3:])
+        self.assertRaises(ValueError, loads, data[:3] + b'\x09' + data[4:])
+        self.assertRaises(ValueError, loads, data[:-5])
+        # Shorter than the header
+        for short in (b'', b'XT', MAGIC):
+            self.assertRaises(ValueError, loads, short)
+
+    def test_json(self):
+        text = dumps_json(SCRIPT)
+        self.assertEqual(SCRIPT, list(loads_json(text)))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import random
+from difflib import SequenceMatcher
+from unittest import TestCase, skipUnless
+
+from .. import similarity
+from ..diff import text_ratio, THRESHOLD
+
+
+def texts(seed=0, count=300):
+    """ Yield pairs of random texts, some of them edits of each other,
+        with lengths either side of where difflib starts treating
+        popular characters as junk. """
+    rand = random.Random(seed)
+    alphabets = ['ab', 'abc ', 'the quick brown fox',
+                 u'αβγ \U0001f600x',
+                 ''.join(chr(i) for i in range(32, 127))]
+    lengths = [0, 1, 2, 5, 20, 199, 200, 201, 350]
+    for i in range(count):
+        alphabet = rand.choice(alphabets)
+        a = ''.join(rand.choice(alphabet)
+                    for j in range(rand.choice(lengths)))
+        if a and rand.random() < 0.5:
+            b = list(a)
+            for j in range(rand.randint(1, len(a) // 5 + 1)):
+                b.insert(rand.randrange(len(b) + 1), rand.choice(alphabet))
+                del b[rand.randrange(len(b))]
+            b = ''.join(b)
+        else:
+            b = ''.join(rand.choice(alphabet)
+                        for j in range(rand.choice(lengths)))
+        yield a, b
+
+
+class SimilarityTestCase(TestCase):
+
+    def test_python_ratio(self):
+        for a, b in texts(count=50):
+            matcher = SequenceMatcher(a=a, b=b)
+            self.assertEqual(matcher.ratio(),
+                             similarity.python_ratio(a, b))
+            self.assertEqual(matcher.quick_ratio(),
+                             similarity.python_quick_ratio(a, b))
+            self.assertEqual(matcher.real_quick_ratio(),
+                             similarity.real_quick_ratio(a, b))
+
+    def test_python_ratio_threshold(self):
+        a = 'some text here'
+        for b in ('some text here', 'some text there', 'xyz', '',
+                  'some other text entirely'):
+            ratio = SequenceMatcher(a=a, b=b).ratio()
+            score = similarity.python_ratio(a, b, threshold=0.9)
+            # Bounds below the threshold come back in place of ratios
+            if score >= 0.9:
+                self.assertEqual(ratio, score)
+            else:
+                self.assertTrue(ratio <= score)
+
+    def test_text_ratio(self):
+        for a, b in texts(count=50):
+            ratio = SequenceMatcher(a=a, b=b).ratio()
+            self.assertEqual(ratio, text_ratio(a, b))
+            # Anything that could pass the threshold is exact
+            score = text_ratio(a, b, threshold=THRESHOLD)
+            if score >= THRESHOLD:
+                self.assertEqual(ratio, score)
+            else:
+                self.assertTrue(ratio <= score)
+
+    @skipUnless(similarity.NATIVE, 'the extension is not built')
+    def test_native_ratio(self):
+        for a, b in texts():
+            matcher = SequenceMatcher(a=a, b=b)
+            self.assertEqual(matcher.ratio(), similarity.ratio(a, b))
+            self.assertEqual(matcher.quick_ratio(),
+                             similarity.quick_ratio(a, b))
+
+    @skipUnless(similarity.NATIVE, 'the extension is not built')
+    def test_native_threshold(self):
+        for a, b in texts(seed=1):
+            for threshold in (0.0, 0.3, THRESHOLD, 0.9, 1.0):
+                self.assertEqual(
+                    similarity.python_ratio(a, b, threshold),
+                    similarity.ratio(a, b, threshold))
+
+    @skipUnless(similarity.NATIVE, 'the extension is not built')
+    def test_native_types(self):
+        self.assertRaises(TypeError, similarity.ratio, b'abc', 'abc')
+        self.assertRaises(TypeError, similarity.ratio, 'abc', 'abc', 'x')
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import random
+import time
+from unittest import TestCase
+
+import lxml.etree as etree
+
+from ..diff import diff
+from ..tree import TreeIndex, WorkingCopy, PathIndex, number_steps
+
+
+class TreeIndexTestCase(TestCase):
+
+    def test_document_order(self):
+        root = etree.fromstring('<root><a><b/><!--c--><c/></a><d/></root>')
+        index = TreeIndex(root)
+        self.assertEqual(['root', 'a', 'b', 'c', 'd'],
+                         [n.tag for n in index.nodes])
+        self.assertEqual([-1, 0, 1, 1, 0], list(index.parent))
+        self.assertEqual([5, 4, 3, 4, 5], list(index.end))
+        self.assertEqual([2, 3], list(index.descendents(1)))
+        self.assertEqual(2, index.size(1))
+
+    def test_postorder(self):
+        root = etree.fromstring('<root><a><b/><c/></a><d><e/></d></root>')
+        index = TreeIndex(root)
+        self.assertEqual(['b', 'c', 'a', 'e', 'd', 'root'],
+                         [index.nodes[i].tag for i in index.postorder])
+        self.assertEqual(['b', 'c', 'e'],
+                         [index.nodes[i].tag for i in index.leaves])
+        self.assertEqual(['a', 'd', 'root'],
+                         [index.nodes[i].tag for i in index.branches])
+
+    def test_leaf_count(self):
+        root = etree.fromstring('<root><a><b/><c/></a><d><e/></d></root>')
+        index = TreeIndex(root)
+        self.assertEqual([3, 2, 0, 0, 1, 0], list(index.leaf_count))
+        self.assertEqual(['b', 'c'], [index.nodes[i].tag for i in
+                                      index.descendent_leaves(1)])
+        self.assertEqual(['e'], [index.nodes[i].tag for i in
+                                 index.descendent_leaves(4)])
+        self.assertEqual([], list(index.descendent_leaves(2)))
+
+    def test_chains(self):
+        root = etree.fromstring('<root><a><b/></a><b/><a/></root>')
+        index = TreeIndex(root)
+        self.assertEqual([1, 4], index.chain('a'))
+        self.assertEqual([2, 3], index.chain('b'))
+        self.assertEqual([], index.chain('c'))
+
+    def test_identical_subtrees(self):
+        root = etree.fromstring(
+            '<root><a x="1"><b>text</b></a><a x="1"><b>text</b></a></root>')
+        index = TreeIndex(root)
+        self.assertEqual(index.hashes[1], index.hashes[3])
+        self.assertEqual(index.hashes[2], index.hashes[4])
+        self.assertNotEqual(index.hashes[0], index.hashes[1])
+
+    def test_different_subtrees(self):
+        root_one = etree.fromstring('<root><a x="1"><b>text</b> tail</a></root>')
+        variations = [
+            '<root><a x="2"><b>text</b> tail</a></root>',
+            '<root><a x="1"><b>text!</b> tail</a></root>',
+            '<root><a x="1"><b>text</b> tail!</a></root>',
+            '<root><a x="1"><c>text</c> tail</a></root>',
+            '<root><a x="1"><b>text</b><!--c--> tail</a></root>',
+        ]
+        left_hash = TreeIndex(root_one).hashes[0]
+        for variation in variations:
+            right_hash = TreeIndex(etree.fromstring(variation)).hashes[0]
+            self.assertNotEqual(left_hash, right_hash, variation)
+
+
+class WorkingCopyTestCase(TestCase):
+
+    def test_untouched(self):
+        root = etree.fromstring('<root><a><b/></a></root>')
+        working = WorkingCopy(root)
+        node = working.node(root[0][0])
+        self.assertEqual('b', node.tag)
+        self.assertEqual('/root/a/b', working.path(node))
+        # Nodes beside the path to the node aren't shadowed
+        self.assertEqual(None, node.children)
+
+    def test_move(self):
+        root = etree.fromstring('<root><a/><b/><a/></root>')
+        working = WorkingCopy(root)
+        a = working.node(root[2])
+        self.assertEqual('/root/a[2]', working.path(a))
+        working.insert(working.node(root[1]), 0, a)
+        self.assertEqual('/root/b/a', working.path(a))
+        self.assertEqual('/root/a', working.path(working.node(root[0])))
+        # The tree itself is untouched
+        self.assertEqual(b'<root><a/><b/><a/></root>', etree.tostring(root))
+
+    def test_insert_remove(self):
+        root = etree.fromstring('<root><a/></root>')
+        working = WorkingCopy(root)
+        node = working.new_node(etree.fromstring('<a><c/></a>'))
+        working.insert(working.root, 0, node)
+        self.assertEqual('/root/a[1]', working.path(node))
+        working.remove(working.node(root[0]))
+        self.assertEqual('/root/a', working.path(node))
+        self.assertEqual(1, len(working.children(working.root)))
+
+    def test_update(self):
+        root = etree.fromstring('<root><a x="1">text</a></root>')
+        working = WorkingCopy(root)
+        node = working.node(root[0])
+        working.update(node, 'new', None, {'x': '2'})
+        self.assertEqual('new', node.text)
+        self.assertEqual({'x': '2'}, node.attrib)
+        self.assertEqual('text', root[0].text)
+
+    def test_steps_kept(self):
+        # Steps are kept up to date as siblings come and go, rather than
+        # worked out again
+        root = etree.fromstring(
+            '<root xmlns:p="urn:p"><a/><b/><a/><p:c/><a/></root>')
+        working = WorkingCopy(root)
+        shapes = ['<a/>', '<b/>', '<c xmlns="urn:d"/>', '<p:c xmlns:p="urn:p"/>']
+        random.seed(0)
+        for i in range(200):
+            children = working.children(working.root)
+            elements = [n for n in children if n.is_element]
+            if len(elements) > 0:
+                working.path(elements[0])
+            table = working.steps[working.root]
+            choice = random.random()
+            if choice < 0.4 and len(elements) > 0:
+                working.remove(random.choice(elements))
+            else:
+                if choice < 0.6 and len(elements) > 0:
+                    node = random.choice(elements)
+                else:
+                    node = working.new_node(
+                        etree.fromstring(random.choice(shapes)))
+                index = random.randint(0, len(children))
+                anchor = children[index] if index < len(children) else None
+                working.insert(working.root, index, node)
+                # Like lxml, the node is placed before the anchor
+                children = working.children(working.root)
+                if anchor is None:
+                    self.assertIs(node, children[-1])
+                elif anchor is not node:
+                    self.assertIs(anchor, children[children.index(node) + 1])
+            self.assertIs(table, working.steps[working.root])
+
+            elements = [n for n in working.children(working.root)
+                        if n.is_element]
+            expected = ['/root/' + step for step in
+                        number_steps([n.step for n in elements])]
+            self.assertEqual(expected, [working.path(n) for n in elements])
+
+    def test_wide_parent(self):
+        # Deleting or inserting each of many siblings with tails takes
+        # time in proportion to their number
+        many = etree.fromstring(
+            '<root>%s</root>' % ''.join('<p>%d</p>\n' % i
+                                        for i in range(4000)))
+        few = etree.fromstring('<root><q/></root>')
+        start = time.time()
+        self.assertEqual(4001, len(diff(many, few)))
+        self.assertEqual(8001, len(diff(few, many)))
+        self.assertLess(time.time() - start, 5)
+
+    def test_path_namespaces(self):
+        root = etree.fromstring(
+            '<root xmlns="urn:d" xmlns:p="urn:p"><a/><!--c--><p:b/>'
+            '<p:b/></root>')
+        working = WorkingCopy(root)
+        tree = root.getroottree()
+        for element in root.iter(tag=etree.Element):
+            self.assertEqual(tree.getpath(element),
+                             working.path(working.node(element)))
+
+
+class PathIndexTestCase(TestCase):
+
+    def test_getpath(self):
+        root = etree.fromstring(
+            '<root xmlns:p="urn:p"><a/><!--c--><a><p:b/></a><c/>'
+            '<d xmlns="urn:d"><e/><e/></d></root>')
+        tree = root.getroottree()
+        paths = PathIndex(root)
+        # The second time around the steps come from the index
+        for i in range(2):
+            for element in root.iter(tag=etree.Element):
+                self.assertIs(element, paths.find(tree.getpath(element)))
+
+    def test_missing(self):
+        root = etree.fromstring('<root><a/><a/></root>')
+        paths = PathIndex(root)
+        for i in range(2):
+            self.assertIsNone(paths.find('/root/d'))
+            self.assertIsNone(paths.find('/root/a[3]'))
+            self.assertIsNone(paths.find('/other'))
+            self.assertIsNone(paths.find('//a'))
+            self.assertIsNone(paths.find('/root/a[last()]'))
+
+    def test_changed(self):
+        root = etree.fromstring('<root><a/><b/></root>')
+        paths = PathIndex(root)
+        b = paths.find('/root/b')
+        self.assertIs(b, paths.find('/root/b'))
+        root.insert(0, etree.Element('b'))
+        paths.changed(root)
+        self.assertIs(b, paths.find('/root/b[2]'))
+        self.assertIs(b, paths.find('/root/b[2]'))
@@ -4,7 +4,8 @@ from unittest import TestCase, skip
 
 import lxml.etree as etree
 
-from ..xsl import xsldiff
+from ..diff import diff, INSERT, DELETE
+from ..xsl import xsldiff, toxsl, toxslt, find_template, _xslt_cache
 
 
 class XDiffXSLTestCase(TestCase):
@@ -80,3 +81,44 @@ class XDiffXSLTestCase(TestCase):
 
         self.assertEqual(etree.tostring(result),
                          etree.tostring(root_two))
+
+    def test_toxslt(self):
+        root_one = etree.fromstring("<root></root>")
+        root_two = etree.fromstring("<root><first>A child Node</first></root>")
+        transform = toxslt(diff(root_one, root_two))
+        result = transform(root_one)
+        self.assertEqual(etree.tostring(result),
+                         etree.tostring(root_two))
+
+    def test_toxsl_insert_tail(self):
+        root_one = etree.fromstring("<root></root>")
+        root_two = etree.fromstring("<root><first>A child</first> tail</root>")
+        result = etree.XSLT(xsldiff(root_one, root_two))(root_one)
+        # XXX: Tails aren't updated yet, see update()
+        self.assertEqual(etree.tostring(result.getroot()[0], with_tail=False),
+                         etree.tostring(root_two[0], with_tail=False))
+
+    def test_toxslt_cache(self):
+        script = [DELETE(path='/root/foo')]
+        self.assertIs(toxslt(script), toxslt(list(script)))
+        self.assertIsNot(toxslt(script),
+                         toxslt([DELETE(path='/root/bar')]))
+
+    def test_toxslt_generator(self):
+        root_one = etree.fromstring("<root><foo/><bar/></root>")
+        root_two = etree.fromstring("<root><foo/></root>")
+        script = diff(root_one, root_two)
+        _xslt_cache.clear()
+        for actions in (iter(script), script):
+            result = toxslt(actions)(root_one)
+            self.assertEqual(etree.tostring(result),
+                             etree.tostring(root_two))
+
+    def test_find_template(self):
+        script = [
+            INSERT(node=b'<a/>', parent='/root', index=0),
+            DELETE(path='/root/foo'),
+        ]
+        xsl = toxsl(script)
+        self.assertEqual('/root/foo', find_template(xsl, '/root/foo').get('match'))
+        self.assertIsNone(find_template(xsl, '/root/bar'))
@@ -0,0 +1,604 @@
+# -*- coding: utf-8 -*-
+"""
+Tree indexing for xtdiff.
+
+The matching algorithms need to ask the same structural questions about
+a tree over and over: what are a node's descendents, where is it in
+document order, is its subtree identical to some other subtree. A
+TreeIndex answers those questions from a single pass over the tree
+instead of re-walking it with XPath each time.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import re
+from array import array
+from bisect import bisect_left
+
+from lxml import etree
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
+
+
+def is_element(node):
+    """ Return True if the given lxml node is an element, rather than a
+        comment, processing instruction or entity. """
+    return isinstance(node.tag, string_types)
+
+
+def _encode(value):
+    """ Return a (possibly None) string value as bytes to be hashed.
+        Values are length-prefixed so that adjacent values can't run
+        together. """
+    if value is None:
+        return b'-'
+    return ('%d:%s' % (len(value), value)).encode('utf-8')
+
+
+def element_step(element):
+    """ Return the name of the element in an XPath step, the way lxml's
+        getpath() names it. """
+    if element.prefix is not None:
+        return '%s:%s' % (element.prefix, etree.QName(element.tag).localname)
+    if element.tag.startswith('{'):
+        # An element in a default namespace can't be named without a
+        # prefix, so any element matches.
+        return '*'
+    return element.tag
+
+
+def number_steps(steps):
+    """ Given the names of the steps to a list of sibling elements, in
+        order, return the steps with the positions getpath() adds to
+        any name that more than one of the siblings matches. """
+
+    # Count the siblings each step matches
+    counts = {}
+    for step in steps:
+        counts[step] = counts.get(step, 0) + 1
+    counts['*'] = len(steps)
+
+    # A '*' step matches every element, so its position is the
+    # element's index.
+    seen = {}
+    numbered = []
+    for index, step in enumerate(steps):
+        seen[step] = seen.get(step, 0) + 1
+        if counts[step] > 1:
+            position = index + 1 if step == '*' else seen[step]
+            step = '%s[%d]' % (step, position)
+        numbered.append(step)
+    return numbered
+
+
+class TreeIndex(object):
+    """
+    A compact snapshot of an element tree in document order.
+
+    Every element beneath (and including) the root is given an integer
+    position in document order, and everything the matching algorithms
+    need to know about it is held in flat lists and arrays indexed by
+    that position, so they can work on integers rather than lxml nodes.
+    Because a node's descendents directly follow it in document order,
+    the descendents of the node at position i are the nodes at positions
+    [i + 1, end[i]).
+
+    Tags are interned as integers in a table of symbols, which can be
+    shared between indexes so that their tags can be compared directly.
+    Attributes are held as sorted tuples of items.
+
+    The index also holds a SHA-1 digest of every subtree, computed
+    bottom-up from each node's tag, attributes and text and the digests
+    of its children, so that identical subtrees have identical hashes, the
+    nodes in postorder, the leaves in document order and the other nodes
+    (branches) in postorder, the number of leaves among each node's
+    descendents, and the chain of nodes with each tag.
+    """
+
+    __slots__ = ('root', 'symbols', 'nodes', 'position', 'parent', 'end',
+                 'tags', 'text', 'tail', 'attrib', 'ids', 'hashes',
+                 'postorder', 'leaves', 'branches', 'leaf_count',
+                 'chains')
+
+    def __init__(self, root, symbols=None):
+        self.root = root
+        self.symbols = symbols if symbols is not None else {}
+
+        # Elements in document order
+        self.nodes = list(root.iter(tag=etree.Element))
+        size = len(self.nodes)
+
+        # Their positions, texts and tails. Mapped documents (see the
+        # mapped module) read these from their files as they're needed
+        # rather than holding them in memory.
+        columns = getattr(root.getroottree(), 'columns', None)
+        if columns is not None:
+            self.position, self.text, self.tail = columns(self.nodes)
+        else:
+            self.position = dict((node, i)
+                                 for i, node in enumerate(self.nodes))
+            self.text = [node.text for node in self.nodes]
+            self.tail = [node.tail for node in self.nodes]
+
+        self.parent = array('i', [-1]) * size
+        self.end = array('i', range(1, size + 1))
+        self.tags = array('i', [0]) * size
+        self.attrib = [()] * size
+        self.ids = [None] * size
+        self.chains = {}
+
+        position = self.position
+        for i, node in enumerate(self.nodes):
+            if i > 0:
+                self.parent[i] = position[node.getparent()]
+            tag = self.symbols.setdefault(node.tag, len(self.symbols))
+            self.tags[i] = tag
+            self.chains.setdefault(tag, []).append(i)
+            if len(node.attrib) > 0:
+                self.attrib[i] = tuple(sorted(node.attrib.items()))
+                self.ids[i] = node.get('id')
+
+        # Children follow their parents, so going backwards we'll have
+        # seen every descendent of a node before the node itself.
+        self.hashes = [None] * size
+        self.leaf_count = array('i', [0]) * size
+        for i in range(size - 1, -1, -1):
+            parent = self.parent[i]
+            if parent >= 0:
+                if self.end[i] > self.end[parent]:
+                    self.end[parent] = self.end[i]
+                self.leaf_count[parent] += self.leaf_count[i] or 1
+            self.hashes[i] = self._hash(i)
+
+        # Postorder, where every node follows all of its descendents
+        self.postorder = array('i')
+        stack = []
+        for i in range(size):
+            while len(stack) > 0 and self.end[stack[-1]] <= i:
+                self.postorder.append(stack.pop())
+            stack.append(i)
+        while len(stack) > 0:
+            self.postorder.append(stack.pop())
+
+        self.leaves = array('i', (i for i in range(size)
+                                  if self.is_leaf(i)))
+        self.branches = array('i', (i for i in self.postorder
+                                    if not self.is_leaf(i)))
+
+    def _hash(self, i):
+        """ Hash the node at position i. The hashes of its element
+            children must already have been computed. """
+        node = self.nodes[i]
+        hasher = hashlib.sha1(_encode(node.tag))
+        for name, value in self.attrib[i]:
+            hasher.update(_encode(name))
+            hasher.update(_encode(value))
+        hasher.update(_encode(self.text[i]))
+
+        # Element children contribute their subtree hashes, anything
+        # else (comments, processing instructions) its text. Tail text
+        # belongs to the parent, so it's included here.
+        for child in node:
+            if is_element(child):
+                hasher.update(self.hashes[self.position[child]])
+            else:
+                hasher.update(_encode('%s' % child))
+            hasher.update(_encode(child.tail))
+
+        return hasher.digest()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def is_leaf(self, i):
+        """ Return True if the node at position i has no element
+            children. """
+        return self.end[i] == i + 1
+
+    def descendents(self, i):
+        """ Return the positions of the descendents of the node at
+            position i. """
+        return range(i + 1, self.end[i])
+
+    def descendent_leaves(self, i):
+        """ Return the positions of the leaves among the descendents of
+            the node at position i. """
+        leaves = self.leaves
+        start = bisect_left(leaves, i + 1)
+        return leaves[start:start + self.leaf_count[i]]
+
+    def chain(self, tag):
+        """ Return the positions of the nodes with the given tag, which
+            may be a tag or its symbol, in document order. """
+        if not isinstance(tag, int):
+            tag = self.symbols.get(tag)
+        return self.chains.get(tag, [])
+
+    def size(self, i):
+        """ Return the number of descendents of the node at position
+            i. """
+        return self.end[i] - i - 1
+
+
+# Stands in for a value of a ShadowNode that's the same as its element's
+_UNCHANGED = object()
+
+
+class ShadowNode(object):
+    """
+    A node of a WorkingCopy.
+
+    A shadow node stands in for an lxml node. Until it's changed, its
+    tag, text, tail and attributes are read from that node, and until
+    they're needed its children aren't created.
+    """
+
+    __slots__ = ('element', 'parent', 'partner', 'inserted', 'children',
+                 'is_element', '_step', '_text', '_tail', '_attrib')
+
+    def __init__(self, element, parent=None, partner=None, inserted=False):
+        self.element = element
+        self.parent = parent
+        self.partner = partner
+        self.inserted = inserted
+        self.children = None
+        self.is_element = is_element(element)
+        self._step = None
+        self._text = _UNCHANGED
+        self._tail = _UNCHANGED
+        self._attrib = _UNCHANGED
+
+    @property
+    def tag(self):
+        return self.element.tag
+
+    @property
+    def text(self):
+        if self._text is _UNCHANGED:
+            return self.element.text
+        return self._text
+
+    @property
+    def tail(self):
+        if self._tail is _UNCHANGED:
+            return self.element.tail
+        return self._tail
+
+    @property
+    def attrib(self):
+        if self._attrib is _UNCHANGED:
+            return self.element.attrib
+        return self._attrib
+
+    @property
+    def step(self):
+        """ The name of this node in an XPath step, the way lxml's
+            getpath() names it. """
+        if self._step is None:
+            self._step = element_step(self.element)
+        return self._step
+
+
+class WorkingCopy(object):
+    """
+    A lightweight, mutable overlay of an element tree.
+
+    The working copy can be changed like the tree it overlays, by
+    inserting, moving, updating and removing nodes, but the tree itself
+    is never modified. Nodes are only shadowed as they're touched, so
+    the parts of the tree that don't change cost next to nothing.
+
+    An optional dict of partners, keyed on the elements of the tree, is
+    used to give every shadow node its partner.
+    """
+
+    def __init__(self, root, partners=None):
+        self.partners = partners if partners is not None else {}
+        self.root = ShadowNode(root, partner=self.partners.get(root))
+        self.root_path = root.getroottree().getpath(root)
+        self.shadows = {root: self.root}
+
+        # The XPath steps of the children of each node, kept up to date
+        # as the node's children change.
+        self.steps = {}
+
+    def node(self, element):
+        """ Return the shadow node for an element of the tree. """
+        node = self.shadows.get(element)
+        if node is None:
+            # Shadow the children of each ancestor down to the element
+            ancestors = []
+            while node is None:
+                ancestors.append(element)
+                element = element.getparent()
+                node = self.shadows.get(element)
+            for element in reversed(ancestors):
+                self.children(node)
+                node = self.shadows[element]
+        return node
+
+    def new_node(self, element, deep=True):
+        """ Return a new shadow node to insert, as a copy of the given
+            element. The copy includes the element's children if deep is
+            True. Like a node parsed on its own, it has no tail. """
+        node = ShadowNode(element, partner=element, inserted=deep)
+        node._tail = None
+        if not deep:
+            node.children = []
+        return node
+
+    def children(self, node):
+        """ Return the list of the given node's children, including any
+            comments or processing instructions. """
+        if node.children is None:
+            if node.inserted:
+                # The children of a copy are matched with their originals
+                node.children = [
+                    ShadowNode(child, node,
+                               child if is_element(child) else None, True)
+                    for child in node.element]
+            else:
+                node.children = []
+                for child in node.element:
+                    shadow = ShadowNode(child, node,
+                                        self.partners.get(child))
+                    self.shadows[child] = shadow
+                    node.children.append(shadow)
+        return node.children
+
+    def index(self, node):
+        """ Return the index of the node in its parent. """
+        return _index(self.children(node.parent), node)
+
+    def insert(self, parent, index, node):
+        """ Insert the node into the parent at the given index, moving it
+            if it's already in the tree. Like lxml, the node is placed
+            before the child that's currently at the index. """
+        children = self.children(parent)
+        anchor = children[index] if index < len(children) else None
+        if anchor is node:
+            return
+
+        if node.parent is not None:
+            # Taking the node from before the index moves the anchor
+            # back one place
+            same_parent = node.parent is parent
+            if self.remove(node) < index and same_parent:
+                index -= 1
+        if anchor is None:
+            index = len(children)
+        children.insert(index, node)
+        node.parent = parent
+
+        steps = self.steps.get(parent)
+        if steps is not None and node.is_element:
+            steps.insert(children, index)
+
+    def remove(self, node):
+        """ Remove the node from its parent, returning the index it was
+            at. """
+        children = self.children(node.parent)
+        index = _index(children, node)
+        del children[index]
+
+        steps = self.steps.get(node.parent)
+        if steps is not None and node.is_element:
+            steps.remove(children, index, node)
+        node.parent = None
+        return index
+
+    def update(self, node, text, tail, attrib):
+        """ Set the text, tail and attributes of the node. """
+        node._text = text
+        node._tail = tail
+        node._attrib = dict(attrib)
+
+    def path(self, node):
+        """ Return the XPath for the node, as lxml's getpath() would for
+            the equivalent tree. """
+        steps = []
+        while node is not self.root:
+            steps.append(self._steps(node.parent).step(node))
+            node = node.parent
+        steps.append(self.root_path)
+        return '/'.join(reversed(steps))
+
+    def _steps(self, parent):
+        """ Return the StepTable of the parent's element children. """
+        steps = self.steps.get(parent)
+        if steps is None:
+            steps = self.steps[parent] = StepTable(
+                [n for n in self.children(parent) if n.is_element])
+        return steps
+
+
+def _index(children, node):
+    """ Return the index of the node in the list of children. Edit
+        scripts mostly work on the last child, so that's tried first. """
+    if len(children) > 0 and children[-1] is node:
+        return len(children) - 1
+    return children.index(node)
+
+
+class StepTable(object):
+    """
+    The XPath steps of a node's element children, as number_steps()
+    gives them, kept up to date as children are inserted and removed.
+
+    Each child is known by its name and its position among the siblings
+    with that name, or among all the element siblings if its name is
+    '*'. Inserting or removing a child only changes the positions of the
+    siblings after it that share its name, and of those named '*'. Edit
+    scripts insert siblings from first to last and delete them from last
+    to first, so there usually aren't any.
+    """
+
+    __slots__ = ('names', 'positions', 'counts')
+
+    def __init__(self, children):
+        self.names = {}
+        self.positions = {}
+        self.counts = {'*': 0}
+        for child in children:
+            name = self.names[child] = child.step
+            self.counts['*'] += 1
+            if name != '*':
+                self.counts[name] = self.counts.get(name, 0) + 1
+            self.positions[child] = self.counts[name]
+
+    def step(self, child):
+        """ Return the step to the given child. """
+        name = self.names[child]
+        if self.counts[name] > 1:
+            return '%s[%d]' % (name, self.positions[child])
+        return name
+
+    def insert(self, children, index):
+        """ Add the element at the given index of the list of children,
+            which it has just been inserted into. """
+        child = children[index]
+        name = self.names[child] = child.step
+
+        # Its position follows that of the nearest sibling before it
+        # with the same name. A '*' position also counts the other
+        # elements in between.
+        position = 1
+        for k in range(index - 1, -1, -1):
+            sibling = children[k]
+            if sibling not in self.names:
+                continue
+            if self.names[sibling] == name:
+                position += self.positions[sibling]
+                break
+            if name == '*':
+                position += 1
+        self.positions[child] = position
+
+        self.counts['*'] += 1
+        if name != '*':
+            self.counts[name] = self.counts.get(name, 0) + 1
+        self._shift(children, index + 1, name, 1)
+
+    def remove(self, children, index, child):
+        """ Forget the given element, which has just been removed from
+            the given index of the list of children. """
+        name = self.names.pop(child)
+        del self.positions[child]
+        self.counts['*'] -= 1
+        if name != '*':
+            self.counts[name] -= 1
+        self._shift(children, index, name, -1)
+
+    def _shift(self, children, start, name, offset):
+        """ Move the positions of the siblings from start on that share
+            the name, or are named '*', by offset. """
+        names = self.names
+        for k in range(start, len(children)):
+            sibling = children[k]
+            sibling_name = names.get(sibling)
+            if sibling_name == name or sibling_name == '*':
+                self.positions[sibling] += offset
+
+
+# A step of the XPaths getpath() generates: an optional prefix, a local
+# name or *, and an optional position.
+_STEP = re.compile(r'^(?:[^\W\d][\w.-]*:)?(?:[^\W\d][\w.-]*|\*)(?:\[\d+\])?$',
+                   re.UNICODE)
+
+
+# The number of a node's children there are for each time they have to
+# be looked up before the PathIndex names them all
+REINDEX_RATIO = 16
+
+
+class PathIndex(object):
+    """
+    Resolves the XPaths that lxml's getpath() generates against a tree
+    that's being changed.
+
+    Rather than evaluating each path as an XPath expression over the
+    whole tree, the path is followed down from the root one step at a
+    time. Once a node's children have been looked up often enough
+    without changing in between, the steps to them are kept in a dict.
+    Changes to a node's children must be reported with changed().
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.root_step = element_step(root)
+        self.steps = {}
+        self.lookups = {}
+
+        # Roughly how many children each node has. Each change only
+        # adds or takes away one, so they're only counted once.
+        self.sizes = {}
+
+    def find(self, path):
+        """ Return the element at the given path, or None if there isn't
+            one or the path isn't one getpath() would generate. """
+        names = path.split('/')
+        if len(names) < 2 or names[0] != '' or names[1] != self.root_step:
+            return None
+
+        node = self.root
+        for i in range(2, len(names)):
+            steps = self._steps(node)
+            if steps is None:
+                # Let lxml find the rest of the way
+                return self._xpath(node, names[i:])
+            node = steps.get(names[i])
+            if node is None:
+                return None
+        return node
+
+    def changed(self, node):
+        """ Forget the steps to the children of the given node, because
+            they've changed. """
+        self.steps.pop(node, None)
+        self.lookups.pop(node, None)
+
+    def _xpath(self, node, names):
+        """ Return the element at the given steps beneath the node. """
+        for name in names:
+            if _STEP.match(name) is None:
+                return None
+
+        path = '/'.join(names)
+        namespaces = None
+        if ':' in path:
+            namespaces = dict((prefix, namespace) for prefix, namespace
+                              in node.nsmap.items() if prefix is not None)
+        try:
+            children = node.xpath(path, namespaces=namespaces)
+        except etree.XPathEvalError:
+            return None
+        return children[0] if len(children) > 0 else None
+
+    def _steps(self, node):
+        """ Return a dict of the steps to the node's element children, or
+            None if they haven't been looked up enough to be worth
+            naming. """
+        steps = self.steps.get(node)
+        if steps is not None:
+            return steps
+
+        # Naming all of the children costs about as much as having lxml
+        # find one of them a few dozen times over, so until they've been
+        # looked up enough times without changing we let lxml find them.
+        size = self.sizes.get(node)
+        if size is None:
+            size = self.sizes[node] = len(node)
+        lookups = self.lookups.get(node, 0)
+        if lookups < size // REINDEX_RATIO + 1:
+            self.lookups[node] = lookups + 1
+            return None
+
+        children = [n for n in node if is_element(n)]
+        self.sizes[node] = len(children)
+        steps = self.steps[node] = dict(zip(
+            number_steps([element_step(n) for n in children]), children))
+        return steps
@@ -14,7 +14,9 @@ information." In ACM SIGMOD Record, vol. 25, no. 2, pp. 493-504. ACM,
 
 from __future__ import unicode_literals
 
+import hashlib
 import re
+from collections import OrderedDict
 
 from lxml import etree
 
@@ -27,6 +29,47 @@ XSL_NAMESPACE = 'http://www.w3.org/1999/XSL/Transform'
 XSL = '{%s}' % XSL_NAMESPACE
 NSMAP = {'xsl': XSL_NAMESPACE}
 
+# The number of compiled stylesheets toxslt() keeps
+XSLT_CACHE_SIZE = 128
+
+# Compiled stylesheets by the fingerprint of their edit script
+_xslt_cache = OrderedDict()
+
+# The template indexes of the stylesheets toxsl() is building
+_template_indexes = {}
+
+
+class TemplateIndex(object):
+    """ An index of the templates of a stylesheet by their match
+        patterns. Templates are indexed as they're appended to the
+        stylesheet. """
+
+    def __init__(self, xsl):
+        self.xsl = xsl
+        self.templates = {}
+        self.indexed = 0
+
+    def get(self, match):
+        """ Return the first template with the given match pattern, or
+            None """
+        for template in self.xsl[self.indexed:]:
+            self.templates.setdefault(template.get('match'), template)
+        self.indexed = len(self.xsl)
+        return self.templates.get(match)
+
+
+def find_template(xsl, match):
+    """ Return the first template in the stylesheet with the given match
+        pattern, or None. """
+    index = _template_indexes.get(xsl)
+    if index is not None:
+        return index.get(match)
+
+    templates = xsl.xpath('//*[@match="{}"]'.format(match))
+    if len(templates) > 0:
+        return templates[0]
+    return None
+
 
 def insert(action, xsl):
     """
@@ -116,10 +159,8 @@ def move(action, xsl):
 
     # Find out if the parent already has a template match. If so, we'll
     # append to that.
-    parent_matches = xsl.xpath('//*[@match="{}"]'.format(action.parent))
-    if len(parent_matches) > 0:
-        parent = parent_matches[0]
-    else:
+    parent = find_template(xsl, action.parent)
+    if parent is None:
         parent = etree.SubElement(xsl, XSL + 'template', nsmap=NSMAP)
 
     parent.set('match', action.parent)
@@ -184,26 +225,66 @@ def toxsl(script, insert=insert, update=update, move=move,
     match_all_apply.set('select', '@* | node()')
     match_all_apply.set('name', 'identity')
 
-    # Create transformations for each action
-    for action in script:
-        if type(action) == INSERT:
-            insert(action, xsl)
-
-        elif type(action) == UPDATE:
-            update(action, xsl)
+    # Create transformations for each action. While we do, templates
+    # are looked up in an index rather than searched for.
+    transforms = {INSERT: insert, UPDATE: update, MOVE: move,
+                  DELETE: delete}
+    _template_indexes[xsl] = TemplateIndex(xsl)
+    try:
+        for action in script:
+            transform = transforms.get(type(action))
+            if transform is not None:
+                transform(action, xsl)
+    finally:
+        del _template_indexes[xsl]
 
-        elif type(action) == MOVE:
-            move(action, xsl)
+    return xsl
 
-        elif type(action) == DELETE:
-            delete(action, xsl)
 
-    return xsl
+def fingerprint(script):
+    """ Return a digest that identifies the given edit script. """
+    hasher = hashlib.sha1()
+    for action in script:
+        fields = list(action)
+        if type(action) == UPDATE:
+            # Attributes are a set, so put them in a reliable order
+            fields[3] = sorted(action.attrib)
+        hasher.update(repr((type(action).__name__, fields)).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def toxslt(script, insert=insert, update=update, move=move,
+           delete=delete):
+    """ Return the given edit script as a compiled etree.XSLT. Compiled
+        stylesheets are cached by the script's fingerprint, so applying
+        the same script to many documents only compiles it once. """
+
+    # The script is read twice, so generators are read into a list
+    script = list(script)
+    key = (fingerprint(script), insert, update, move, delete)
+    xslt = _xslt_cache.pop(key, None)
+    if xslt is None:
+        xslt = etree.XSLT(toxsl(script, insert=insert, update=update,
+                                move=move, delete=delete))
+        if len(_xslt_cache) >= XSLT_CACHE_SIZE:
+            _xslt_cache.popitem(last=False)
+
+    # The most recently used stylesheets are kept the longest
+    _xslt_cache[key] = xslt
+    return xslt
 
 
 def xsldiff(left_tree, right_tree, match=simplematch,
-            match_threshold=THRESHOLD):
-    """ Simple wrapper around toxsl(diff()) """
-
-    return toxsl(diff(left_tree, right_tree, match=match,
-                      match_threshold=match_threshold))
+            match_threshold=THRESHOLD, instrument=None, budget=None):
+    """ Simple wrapper around toxsl(diff()). An optional Instrumentation
+        is given to diff() and times toxsl() as the 'toxsl' stage. An
+        optional Budget is given to diff(), and its fallback says which
+        fallback was used. """
+
+    script = diff(left_tree, right_tree, match=match,
+                  match_threshold=match_threshold, instrument=instrument,
+                  budget=budget)
+    if instrument is None:
+        return toxsl(script)
+    with instrument.stage('toxsl'):
+        return toxsl(script)